@@ -1,11 +1,75 @@
+import time
+
+# Début du chargement de l'add-on (budget de temps d'import, voir load_stats)
+_load_started = time.perf_counter()
+
+import functools
+import hashlib
 import html
+import json
+import os
 import re
-from aqt import gui_hooks
+import sys
+import threading
+import traceback
+from collections import OrderedDict, deque
+
+from aqt import gui_hooks, mw
+from aqt.utils import showInfo, showWarning
 
+# Moteur de notation sans dépendance à aqt (voir core.py); ce fichier n'en est que l'adaptateur Anki.
+# core n'importe le client HTTP qu'au premier appel réseau (warm-up du reviewer ou première analyse).
+from . import core
+from .core import (
+    ANALYSIS_CACHE_SCHEMA,
+    DEFAULT_CONFIG,
+    HISTORY_SCHEMA,
+    LANGUAGES,
+    PROVIDERS,
+    SUGGESTION_TO_EASE,
+    _configured_routes,
+    _get_provider_settings,
+    aggregate_part_results,
+    analysis_digest,
+    analysis_model_tag,
+    analyze_answer_with_ai,
+    analyze_via_daemon,
+    budget_level,
+    cache_lookup,
+    cache_store,
+    compare_code_texts,
+    cancel_probes,
+    clean_html_content,
+    cloze_answers,
+    export_analysis_cache,
+    extract_code_text,
+    format_probe_result,
+    generate_rubric,
+    get_api_keys,
+    history_insert,
+    import_analysis_cache,
+    is_cacheable,
+    local_score,
+    myers_diff,
+    part_question,
+    prewarm_connection,
+    probe_providers,
+    record_usage,
+    shutdown_cpu_pool,
+    split_answer_parts,
+    submit_cpu_task,
+)
 
 ai_analysis_cache = {}
 is_analyzing = {}
 analysis_results = {}
+# Suggestion IA affichée pour la carte courante (card_id, cache_key, suggestion, score)
+pending_suggestion = {}
+auto_answered = set()
+# Début de chaque analyse en cours (time.monotonic), pour l'échéance d'affichage
+analysis_started = {}
+# Question nettoyée par carte, préparée au warm-up: (card_id, note_mod) -> texte
+question_context_cache = {}
 
 # translations and label helpers
 # Map your config["language"] key -> labels
@@ -77,51 +141,185 @@ def _labels_from_config(config: dict) -> dict:
     return {"expected": lbl_expected, "provided": lbl_provided}
 
 
-def extract_code_text(html_or_text: str) -> str:
-    """
-    Extract readable code from HTML or plaintext while preserving newlines/indentation.
-    - Prefers the content inside <pre> blocks if present (common in highlighter output).
-    - Strips tags/spans/line-numbering, unescapes entities.
-    - Falls back to a generic HTML strip that keeps line breaks.
-    """
-    if not html_or_text:
-        return ""
-    s = html_or_text.replace('\r\n', '\n').replace('\r', '\n')
-
-    # Prefer <pre> blocks (e.g., hilite.me wraps code in <pre> inside a table) [hilite.me](http://hilite.me/)
-    pre_blocks = re.findall(r'<pre[^>]*>(.*?)</pre>', s, flags=re.IGNORECASE | re.DOTALL)
-    if pre_blocks:
-        parts = []
-        for block in pre_blocks:
-            block = re.sub(r'<br\s*/?>', '\n', block, flags=re.IGNORECASE)
-            block = re.sub(r'<[^>]+>', '', block)  # strip spans/etc. inside pre
-            block = html.unescape(block)
-            block = '\n'.join(ln.rstrip() for ln in block.split('\n'))
-            parts.append(block.strip('\n'))
-        text = '\n\n'.join(parts)
-
-        # Optional: drop leading line numbers if most lines start with digits
-        lines = text.split('\n')
-        if lines and sum(1 for ln in lines if re.match(r'^\s*\d+\b', ln)) >= max(3, len(lines)//2):
-            lines = [re.sub(r'^\s*\d+\b\s*', '', ln) for ln in lines]
-            text = '\n'.join(lines)
-    else:
-        # Generic HTML → text with preserved line breaks
-        s = re.sub(r'<script.*?</script>', '', s, flags=re.IGNORECASE | re.DOTALL)
-        s = re.sub(r'<style.*?</style>', '', s, flags=re.IGNORECASE | re.DOTALL)
-        # Block-level to newline
-        s = re.sub(r'</?(p|div|br|li|tr|td|th|blockquote|h[1-6]|ul|ol|pre|table)[^>]*>', '\n', s, flags=re.IGNORECASE)
-        s = re.sub(r'<[^>]+>', '', s)  # remove remaining tags
-        text = html.unescape(s)
-
-    # Normalize blank lines
-    text = re.sub(r'\n{3,}', '\n\n', text).strip()
-    return text
-
-# imports near the top
-import re, html
-from aqt import gui_hooks
+# Style du textarea (aussi utilisé hors reviewer, ex. aperçu, d'où le style en ligne)
+TYPEANS_STYLE = (
+    "width:96%;min-height:180px;"
+    "font-family: ui-monospace, SFMono-Regular, Menlo, Monaco, Consolas, 'Liberation Mono', monospace;"
+    "font-size:16px; line-height:1.4; tab-size:2;"
+)
 
+# Composant unique de conversion/câblage du champ typeans, injecté une fois dans le reviewer.
+# window.akiTypeAns() est idempotent: il convertit l'input si besoin, câble Entrée/Ctrl+Entrée
+# une seule fois, et si le champ n'est pas encore dans le DOM observe #qa brièvement puis se déconnecte.
+TYPEANS_COMPONENT_JS = """
+<script>
+(function(){
+  if (window.akiTypeAns) return;
+  var STYLE = %(style)s;
+  var observer = null, timer = null;
+
+  function onEnter(e){
+    if (e.key !== 'Enter') return;
+    e.stopImmediatePropagation(); e.stopPropagation();  // Entrée seule = nouvelle ligne
+    if (e.ctrlKey || e.metaKey) {
+      e.preventDefault();
+      if (e.type === 'keydown' && typeof pycmd === 'function') pycmd('ans');
+    }
+  }
+  function wire(ta){
+    if (ta.dataset.mlReady) return false;
+    ta.dataset.mlReady = '1';
+    ['keydown','keypress','keyup'].forEach(function(t){ ta.addEventListener(t, onEnter, true); });
+    return true;
+  }
+  function convert(inp){
+    var ta = document.createElement('textarea');
+    for (var i=0; i<inp.attributes.length; i++){
+      var a = inp.attributes[i];
+      if (a.name === 'type' || a.name === 'value') continue;
+      try { ta.setAttribute(a.name, a.value); } catch(_){}
+    }
+    ta.value = inp.value || ''; ta.rows = 10; ta.spellcheck = false;
+    ta.setAttribute('style', STYLE);
+    inp.parentNode.replaceChild(ta, inp);
+    try { ta.focus(); ta.setSelectionRange(ta.value.length, ta.value.length); } catch(_){}
+    return ta;
+  }
+  function stop(){
+    if (observer) { observer.disconnect(); observer = null; }
+    if (timer) { clearTimeout(timer); timer = null; }
+  }
+  function upgrade(){
+    var e = document.getElementById('typeans');
+    if (!e) return false;
+    var t0 = performance.now();
+    if (e.tagName.toLowerCase() !== 'textarea') e = convert(e);
+    if (wire(e) && typeof pycmd === 'function') {
+      pycmd('aki_typeans:' + (performance.now() - t0).toFixed(3));
+    }
+    return true;
+  }
+  window.akiTypeAns = function(){
+    stop();
+    if (upgrade()) return;
+    observer = new MutationObserver(function(){ if (upgrade()) stop(); });
+    observer.observe(document.getElementById('qa') || document.body, {childList: true, subtree: true});
+    timer = setTimeout(stop, 2000);
+  };
+})();
+</script>
+""" % {"style": json.dumps(TYPEANS_STYLE)}
+
+# Temps de chargement de l'add-on (ms), comparé à load_time_budget_ms
+load_stats = {"import_ms": 0.0}
+
+# Détecteur de blocages du thread principal: chaque hook / callback instrumenté est chronométré.
+# Un thread de surveillance (démarré au premier appel) capture la pile du thread principal
+# si un appel dépasse le seuil; le temps passé par carte est cumulé pour les statistiques.
+stall_state = {"enabled": True, "threshold_ms": 100.0, "depth": 0, "call": None, "watchdog": None}
+stall_event = threading.Event()
+main_thread_stats = {}  # nom -> {"count", "total_ms", "max_ms", "stalls"}
+card_main_thread_ms = OrderedDict()  # card_id -> ms cumulés sur le thread principal
+recent_stalls = deque(maxlen=20)  # {"name", "ms", "card_id", "stack"}
+MAIN_THREAD_CARDS_KEPT = 200
+
+def configure_stall_detector(config):
+    stall_state["enabled"] = bool(config.get("stall_detector", True))
+    stall_state["threshold_ms"] = float(config.get("stall_threshold_ms", 100))
+
+def _stall_watchdog():
+    """Attend un appel en cours; s'il dépasse le seuil, capture la pile du thread principal"""
+    main_ident = threading.main_thread().ident
+    while True:
+        stall_event.wait()
+        # Effacé avant de lire l'appel: un appel qui démarre ensuite ré-arme l'événement et n'est pas perdu
+        stall_event.clear()
+        call = stall_state["call"]
+        if call is None:
+            continue
+        time.sleep(max(0.0, call["start"] + stall_state["threshold_ms"] / 1000 - time.perf_counter()))
+        if stall_state["call"] is call and call["stack"] is None:
+            frame = sys._current_frames().get(main_ident)
+            if frame is not None:
+                call["stack"] = "".join(traceback.format_stack(frame)[-12:])
+        # Attendre la fin de cet appel avant de surveiller le suivant
+        while stall_state["call"] is call:
+            time.sleep(0.01)
+
+def _current_card_id():
+    card = getattr(getattr(mw, "reviewer", None), "card", None)
+    return getattr(card, "id", None)
+
+def main_thread_timed(name):
+    """Décorateur: chronomètre les appels sur le thread principal (hors threads de fond)"""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not stall_state["enabled"] or threading.current_thread() is not threading.main_thread():
+                return fn(*args, **kwargs)
+            outermost = stall_state["depth"] == 0
+            stall_state["depth"] += 1
+            start = time.perf_counter()
+            if outermost:
+                stall_state["call"] = {"name": name, "start": start, "stack": None}
+                if stall_state["watchdog"] is None:
+                    stall_state["watchdog"] = threading.Thread(target=_stall_watchdog, name="aki-stall-watchdog", daemon=True)
+                    stall_state["watchdog"].start()
+                stall_event.set()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                elapsed_ms = (time.perf_counter() - start) * 1000
+                stall_state["depth"] -= 1
+                _record_main_thread_call(name, elapsed_ms, outermost)
+
+        return wrapper
+    return decorate
+
+def _record_main_thread_call(name, elapsed_ms, outermost):
+    entry = main_thread_stats.setdefault(name, {"count": 0, "total_ms": 0.0, "max_ms": 0.0, "stalls": 0})
+    entry["count"] += 1
+    entry["total_ms"] += elapsed_ms
+    entry["max_ms"] = max(entry["max_ms"], elapsed_ms)
+    if not outermost:
+        return
+    call, stall_state["call"] = stall_state["call"], None
+    card_id = _current_card_id()
+    if card_id is not None:
+        card_main_thread_ms[card_id] = card_main_thread_ms.pop(card_id, 0.0) + elapsed_ms
+        if len(card_main_thread_ms) > MAIN_THREAD_CARDS_KEPT:
+            card_main_thread_ms.popitem(last=False)
+    if elapsed_ms >= stall_state["threshold_ms"]:
+        entry["stalls"] += 1
+        stack = (call or {}).get("stack")
+        if not stack:
+            # Pile non capturée pendant le blocage: celle de la fin de l'appel, signalée comme telle
+            stack = "(stack at the end of the call, not during the stall)\n" + "".join(traceback.format_stack()[-12:-2])
+        recent_stalls.append({"name": name, "ms": elapsed_ms, "card_id": card_id, "stack": stack})
+        print(f"Main-thread stall: {name} took {elapsed_ms:.0f} ms (card {card_id})\n{stack}")
+
+def format_main_thread_stats():
+    """Lignes de statistiques du thread principal (par hook et par carte)"""
+    lines = []
+    if card_main_thread_ms:
+        per_card = list(card_main_thread_ms.values())
+        lines.append(f"Main thread per card: avg {sum(per_card) / len(per_card):.1f} ms, "
+                     f"max {max(per_card):.1f} ms over {len(per_card)} cards")
+    for name, entry in sorted(main_thread_stats.items(), key=lambda item: -item[1]["total_ms"]):
+        avg = entry["total_ms"] / entry["count"]
+        stalls = f", {entry['stalls']} stalls" if entry["stalls"] else ""
+        lines.append(f"  {name}: {entry['count']} calls, avg {avg:.1f} ms, max {entry['max_ms']:.1f} ms{stalls}")
+    if recent_stalls:
+        last = recent_stalls[-1]
+        lines.append(f"Stalls over {stall_state['threshold_ms']:.0f} ms: {len(recent_stalls)} recent; "
+                     f"last: {last['name']} {last['ms']:.0f} ms")
+        lines.append(last["stack"].rstrip())
+    return lines
+
+# Coût du câblage du champ par carte, mesuré côté webview (ms)
+typeans_stats = {"count": 0, "total_ms": 0.0, "max_ms": 0.0}
+
+@main_thread_timed("card_will_show:textarea")
 def _to_textarea_on_question(text: str, card, kind: str) -> str:
     if not kind or "Question" not in kind:
         return text
@@ -131,72 +329,45 @@ def _to_textarea_on_question(text: str, card, kind: str) -> str:
 
     def repl(m):
         attrs = m.group('attrs')
-        # strip type= and value= on textarea
+        # strip type=, value= and style= on textarea
         attrs = re.sub(r'\stype\s*=\s*(?:"|\')?[^"\'>\s]+(?:"|\')?', '', attrs, flags=re.I)
         attrs = re.sub(r'\svalue\s*=\s*(?:"|\').*?(?:"|\')', '', attrs, flags=re.I|re.S)
-        return (
-            f'<textarea{attrs} rows="10" spellcheck="false" '
-            'style="width:96%;min-height:180px;'
-            "font-family: ui-monospace, SFMono-Regular, Menlo, Monaco, Consolas, 'Liberation Mono', monospace;"
-            'font-size:16px; line-height:1.4; tab-size:2;"></textarea>'
-            '<script>(function(){'
-            'function wireTA(ta){ if(!ta||ta.dataset.mlReady) return; ta.dataset.mlReady="1";'
-            'function onEnter(e){ if(e.key==="Enter"){'
-            ' if(e.ctrlKey||e.metaKey){ e.stopImmediatePropagation(); e.stopPropagation(); e.preventDefault();'
-            '  if(typeof pycmd==="function") pycmd("ans");'
-            ' } else { e.stopImmediatePropagation(); e.stopPropagation(); /* let default newline happen */ }'
-            '} }'
-            "['keydown','keypress','keyup'].forEach(function(t){ ta.addEventListener(t,onEnter,true); });"
-            '}'
-            'var ta=document.getElementById("typeans"); if(ta) wireTA(ta);'
-            '})();</script>'
-        )
+        attrs = re.sub(r'\sstyle\s*=\s*(?:"[^"]*"|\'[^\']*\')', '', attrs, flags=re.I)
+        return f'<textarea{attrs} rows="10" spellcheck="false" style="{TYPEANS_STYLE}"></textarea>'
 
-    new_text, replaced = pat.subn(repl, text)
+    new_text = pat.sub(repl, text, count=1)
 
-    # Fallback if no match (timing/DOM variants)
-    if replaced == 0:
-        new_text += """
-<script>
-(function(){
-  function wireTA(ta){
-    if(!ta||ta.dataset.mlReady) return; ta.dataset.mlReady="1";
-    function onEnter(e){
-      if(e.key==='Enter'){
-        if(e.ctrlKey||e.metaKey){
-          e.stopImmediatePropagation(); e.stopPropagation(); e.preventDefault();
-          if (typeof pycmd==='function') pycmd('ans');
-        } else {
-          e.stopImmediatePropagation(); e.stopPropagation(); // allow newline
-        }
-      }
-    }
-    ['keydown','keypress','keyup'].forEach(function(t){ ta.addEventListener(t,onEnter,true); });
-  }
-  function swap(){
-    var e=document.getElementById('typeans'); if(!e) return;
-    if(e.tagName.toLowerCase()!=='textarea'){
-      var ta=document.createElement('textarea');
-      for(var i=0;i<e.attributes.length;i++){ var a=e.attributes[i]; try{ ta.setAttribute(a.name,a.value);}catch(_){} }
-      ta.value=e.value||''; ta.rows=10; ta.spellcheck=false;
-      ta.style.width='96%'; ta.style.minHeight='180px';
-      ta.style.fontFamily='ui-monospace, SFMono-Regular, Menlo, Monaco, Consolas, "Liberation Mono", monospace';
-      ta.style.fontSize='16px'; ta.style.lineHeight='1.4'; ta.style.tabSize='2';
-      e.parentNode.replaceChild(ta,e); e=ta;
-    }
-    wireTA(e);
-  }
-  swap();
-  var mo=new MutationObserver(function(){ swap(); });
-  mo.observe(document.documentElement||document.body,{childList:true,subtree:true});
-})();
-</script>
-"""
-    return new_text
+    # Un seul appel au composant du reviewer (conversion si le regex n'a rien trouvé, câblage des touches)
+    return new_text + '<script>window.akiTypeAns && window.akiTypeAns();</script>'
 
+def record_typeans_timing(message):
+    """Enregistre la durée de mise à niveau du champ envoyée par le composant JS"""
+    try:
+        ms = float(message.split(":", 1)[1])
+    except (IndexError, ValueError):
+        return
+    typeans_stats["count"] += 1
+    typeans_stats["total_ms"] += ms
+    typeans_stats["max_ms"] = max(typeans_stats["max_ms"], ms)
+
+def format_stats():
+    """Statistiques du moteur complétées par celles du reviewer"""
+    lines = [core.format_stats(get_config()), f"Add-on load: {load_stats['import_ms']:.1f} ms (budget {get_config().get('load_time_budget_ms', DEFAULT_CONFIG['load_time_budget_ms'])} ms)"]
+    if typeans_stats["count"]:
+        avg = typeans_stats["total_ms"] / typeans_stats["count"]
+        lines.append(f"Typed-answer upgrade: {typeans_stats['count']} cards, avg {avg:.2f} ms, max {typeans_stats['max_ms']:.2f} ms")
+    lines.extend(format_main_thread_stats())
+    if get_config().get("history_enabled", True):
+        lines.extend(format_token_usage())
+    return "\n".join(lines)
+
+@main_thread_timed("card_will_show:diff")
 def _code_friendly_diff_on_answer(text: str, card, kind: str) -> str:
     if not kind or "Answer" not in kind:
         return text
+    # Dans le reviewer, la règle fait partie de la feuille de style injectée une seule fois
+    if kind == "reviewAnswer":
+        return text
     return """
 <style>
 .typeGood, .typeBad, .typeMissed {
@@ -207,11 +378,13 @@ def _code_friendly_diff_on_answer(text: str, card, kind: str) -> str:
 """ + text
 
 
+@main_thread_timed("webview_will_set_content")
 def inject_multiline_type_input(web_content, context):
     """
     Injecte CSS/JS dans le reviewer pour:
     - convertir l'input {{type:...}} en textarea multi-ligne
     - améliorer l'affichage des diffs Anki (.typeGood/Bad/Missed) pour le code
+    - fournir la feuille de style unique de l'analyse IA (classes aki-*)
     """
     try:
         # Limiter au reviewer
@@ -248,12 +421,40 @@ body.nightMode, body.night-mode, .nightMode, .night-mode, .isDark, [data-theme="
   }
 }
 
+/* Diffs Anki lisibles pour le code */
+.typeGood, .typeBad, .typeMissed {
+  white-space: pre-wrap !important;
+  font-family: ui-monospace, SFMono-Regular, Menlo, Monaco, Consolas, "Liberation Mono", monospace !important;
+}
+
 /* Styles des blocs de comparaison */
+.ak-compare { display: flex; gap: 12px; margin: 12px 0; }
+.ak-compare .ak-col { flex: 1; min-width: 0; }
 .ak-compare .ak-label {
   font-weight: 700;
   margin-bottom: 6px;
   color: var(--ak-code-label) !important;
 }
+.ak-diff { border: 1px solid var(--ak-code-border); border-radius: 8px; background: var(--ak-code-bg); color: var(--ak-code-fg); margin: 0 0 12px 0; overflow: auto;
+  font-family: ui-monospace, SFMono-Regular, Menlo, Monaco, Consolas, "Liberation Mono", monospace; font-size: 13px; }
+.ak-diff-head { margin-bottom: 0; }
+.ak-diff-pending { color: var(--ak-code-label); font-style: italic; font-size: 13px; margin: 0 0 12px 0; }
+.ak-drow { display: grid; grid-template-columns: 2.5em 1fr 2.5em 1fr; }
+.ak-drow code { white-space: pre-wrap; word-break: break-word; padding: 0 6px; font-family: inherit; background: none; }
+.ak-ln { color: #8b949e; text-align: right; padding-right: 4px; user-select: none; }
+.ak-ddelete code:nth-of-type(1), .ak-dreplace code:nth-of-type(1) { background: rgba(244,67,54,0.12); }
+.ak-dinsert code:nth-of-type(2), .ak-dreplace code:nth-of-type(2) { background: rgba(76,175,80,0.14); }
+.ak-drow del { background: rgba(244,67,54,0.35); text-decoration: none; }
+.ak-drow ins { background: rgba(76,175,80,0.4); text-decoration: none; }
+.ak-tk-kw { color: #cf222e; font-weight: 600; }
+.ak-tk-str { color: #0a3069; }
+.ak-tk-com { color: #6e7781; font-style: italic; }
+.ak-tk-num { color: #0550ae; }
+body.nightMode .ak-tk-kw, body.night-mode .ak-tk-kw, [data-theme="dark"] .ak-tk-kw { color: #ff7b72; }
+body.nightMode .ak-tk-str, body.night-mode .ak-tk-str, [data-theme="dark"] .ak-tk-str { color: #a5d6ff; }
+body.nightMode .ak-tk-com, body.night-mode .ak-tk-com, [data-theme="dark"] .ak-tk-com { color: #8b949e; }
+body.nightMode .ak-tk-num, body.night-mode .ak-tk-num, [data-theme="dark"] .ak-tk-num { color: #79c0ff; }
+.ak-fold { color: #8b949e; text-align: center; cursor: pointer; padding: 2px 0; border-top: 1px dashed var(--ak-code-border); border-bottom: 1px dashed var(--ak-code-border); }
 .ak-compare .ak-pre {
   white-space: pre-wrap !important;
   padding: 10px;
@@ -264,84 +465,425 @@ body.nightMode, body.night-mode, .nightMode, .night-mode, .isDark, [data-theme="
   overflow: auto;
   font-family: ui-monospace, SFMono-Regular, Menlo, Monaco, Consolas, "Liberation Mono", monospace !important;
 }
+
+/* Analyse IA: paliers de score / suggestion */
+.aki-again { --aki-c: #f44336; --aki-bg: #ffebee; }
+.aki-hard  { --aki-c: #ff9800; --aki-bg: #fff3e0; }
+.aki-good  { --aki-c: #4caf50; --aki-bg: #e8f5e8; }
+.aki-easy  { --aki-c: #2196f3; --aki-bg: #e3f2fd; }
+
+.aki-root { font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif; max-width: 800px; margin: 0 auto; }
+.aki-anki { background: #f8f9fa; padding: 15px; border-radius: 8px; margin-bottom: 20px; border-left: 4px solid #6c757d; }
+
+.aki-loading { background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); border-radius: 16px; padding: 25px; margin: 20px 0; text-align: center; color: white; }
+.aki-loading-row { display: inline-flex; align-items: center; gap: 12px; margin-bottom: 8px; }
+.aki-loading-title { font-size: 18px; font-weight: 600; }
+.aki-loading p { color: rgba(255,255,255,0.9); margin: 0; font-size: 14px; }
+.aki-loading p.aki-loading-note { color: rgba(255,255,255,0.7); margin-top: 10px; font-size: 12px; font-style: italic; }
+.aki-spinner { width: 26px; height: 26px; border: 3px solid rgba(255,255,255,0.35); border-top-color: #fff; border-radius: 50%; animation: aki_spin 0.9s linear infinite; }
+@keyframes aki_spin { to { transform: rotate(360deg); } }
+
+.aki-card { background: var(--aki-bg); border: 2px solid var(--aki-c); border-radius: 16px; padding: 25px; margin: 20px 0; box-shadow: 0 8px 32px rgba(0,0,0,0.1); }
+.aki-head { display: flex; align-items: center; margin-bottom: 20px; }
+.aki-title { display: flex; align-items: center; flex: 1; }
+.aki-title h3 { color: var(--aki-c); margin: 0; font-size: 22px; font-weight: 700; }
+.aki-avatar { background: var(--aki-c); width: 48px; height: 48px; border-radius: 50%; display: flex; align-items: center; justify-content: center; margin-right: 15px; font-size: 20px; box-shadow: 0 4px 12px rgba(0,0,0,0.15); }
+.aki-score { background: var(--aki-c); color: white; padding: 12px 20px; border-radius: 25px; font-weight: bold; font-size: 18px; box-shadow: 0 4px 15px rgba(0,0,0,0.2); }
+.aki-question { background: rgba(255,255,255,0.9); border: 2px solid #e0e0e0; border-radius: 12px; padding: 15px; margin-bottom: 15px; }
+.aki-question h4 { color: #2c3e50; margin: 0 0 8px 0; font-size: 16px; font-weight: 700; }
+.aki-question p { color: #34495e; margin: 0; line-height: 1.4; font-size: 14px; font-style: italic; }
+.aki-tips { margin-bottom: 20px; padding: 15px; background: rgba(255,255,255,0.7); border-radius: 12px; border-left: 4px solid var(--aki-c); }
+.aki-tips h4 { color: #2c3e50; margin: 0 0 10px 0; font-size: clamp(15px, 4vw, 17px); font-weight: 700; text-transform: uppercase; letter-spacing: 1px; }
+.aki-tips p { color: #34495e; margin: 0; line-height: 1.6; font-size: clamp(14px, 4vw, 16px); }
+.aki-suggest { background: var(--aki-bg); border: 2px solid var(--aki-c); border-radius: 12px; padding: 16px; }
+.aki-suggest-row { display: flex; align-items: center; justify-content: space-between; }
+.aki-suggest-label { color: #2c3e50; font-weight: 700; font-size: 16px; }
+.aki-badge { background: var(--aki-c); color: white; padding: 10px 18px; border-radius: 20px; font-weight: bold; font-size: 15px; box-shadow: 0 3px 10px rgba(0,0,0,0.2); }
+.aki-badge[role="button"] { cursor: pointer; }
+.aki-parts { margin-bottom: 20px; padding: 15px; background: rgba(255,255,255,0.7); border-radius: 12px; }
+.aki-parts h4 { color: #2c3e50; margin: 0 0 10px 0; font-size: 15px; font-weight: 700; }
+.aki-parts li { color: #34495e; margin: 4px 0; line-height: 1.4; }
+.aki-part-score { font-weight: bold; margin-right: 6px; }
+.aki-hint { text-align: right; color: #2c3e50; font-size: 12px; margin-top: 8px; opacity: 0.8; }
 </style>
-<script>
-(function(){
-  function upgradeTypeAnswer(){
-    var inp = document.getElementById('typeans');
-    if (!inp || inp.tagName.toLowerCase() === 'textarea') return;
+""" + TYPEANS_COMPONENT_JS
+
+# Coloration syntaxique légère: détection du langage + tokenizer regex, résultat mis en cache par empreinte
+_C_COMMENT = r"//[^\n]*|/\*[\s\S]*?\*/"
+_C_STRING = r'"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\''
+HIGHLIGHT_LANGUAGES = {
+    "python": {
+        "comment": r"#[^\n]*",
+        "string": r'"""[\s\S]*?"""|\'\'\'[\s\S]*?\'\'\'|' + _C_STRING,
+        "keywords": set("and as assert async await break class continue def del elif else except False finally for from "
+                        "global if import in is lambda None nonlocal not or pass raise return self True try while with yield".split()),
+        "signals": [r"^\s*(def|class)\s+\w+.*:\s*$", r"^\s*(import|from)\s+\w+", r"\bself\b", r"\belif\b", r"\bprint\("],
+    },
+    "javascript": {
+        "comment": _C_COMMENT,
+        "string": _C_STRING + r"|`(?:\\.|[^`\\])*`",
+        "keywords": set("async await break case catch class const continue default delete do else export extends false "
+                        "finally for function if import in instanceof let new null return switch this throw true try "
+                        "typeof undefined var void while yield".split()),
+        "signals": [r"\bfunction\b", r"=>", r"\b(const|let)\s+\w+\s*=", r"\bconsole\.log\b", r"\bdocument\."],
+    },
+    "clike": {
+        "comment": _C_COMMENT,
+        "string": _C_STRING,
+        "keywords": set("abstract bool boolean break case catch char class const continue default do double else enum "
+                        "extends false final float for if implements import include int interface long new null "
+                        "private protected public return short static struct super switch this throw true try "
+                        "unsigned void while".split()),
+        "signals": [r"^\s*#include\b", r"\b(public|private|static)\s", r"\bint\s+main\s*\(", r"\bSystem\.out\.", r";\s*$"],
+    },
+    "sql": {
+        "comment": r"--[^\n]*",
+        "string": r"'(?:''|[^'])*'",
+        "keywords": set("select from where insert into values update set delete create table alter drop join left right "
+                        "inner outer on group by order having limit as and or not null is in distinct count primary key".split()),
+        "ignore_case": True,
+        "signals": [r"(?i)\bselect\b[\s\S]*\bfrom\b", r"(?i)\binsert\s+into\b", r"(?i)\bcreate\s+table\b", r"(?i)\bwhere\b"],
+    },
+    "shell": {
+        "comment": r"#[^\n]*",
+        "string": _C_STRING,
+        "keywords": set("if then else elif fi for in do done while case esac function echo export sudo cd ls grep cat".split()),
+        "signals": [r"^\s*\$\s", r"^\s*(sudo|echo|export|cd)\s", r"\|\s*grep\b", r"^#!/bin/"],
+    },
+}
+_highlight_patterns = {}
+highlight_cache = OrderedDict()
+HIGHLIGHT_CACHE_SIZE = 256
 
-    // Cloner les attributs de l’input vers un textarea
-    var ta = document.createElement('textarea');
-    for (var i=0; i<inp.attributes.length; i++){
-      var a = inp.attributes[i];
-      try { ta.setAttribute(a.name, a.value); } catch(e){}
-    }
-    ta.value = inp.value || '';
-    ta.rows = 10;
-    ta.spellcheck = false;
+def detect_code_language(text):
+    """Devine le langage d'un extrait de code (chaîne vide si rien de probant)"""
+    if not text or len(text) < 8:
+        return ""
+    sample = text[:4000]
+    best, best_score = "", 0
+    for lang, spec in HIGHLIGHT_LANGUAGES.items():
+        score = sum(1 for sig in spec["signals"] if re.search(sig, sample, flags=re.MULTILINE))
+        if score > best_score:
+            best, best_score = lang, score
+    return best if best_score >= 2 else ""
+
+def _highlight_pattern(lang):
+    if lang not in _highlight_patterns:
+        spec = HIGHLIGHT_LANGUAGES[lang]
+        _highlight_patterns[lang] = re.compile(
+            f"(?P<com>{spec['comment']})|(?P<str>{spec['string']})|(?P<num>\\b\\d+(?:\\.\\d+)?\\b)|(?P<word>[A-Za-z_]\\w*)"
+        )
+    return _highlight_patterns[lang]
 
-    inp.parentNode.replaceChild(ta, inp);
+def highlight_code_lines(text, lang):
+    """
+    Retourne le code coloré en HTML, une entrée par ligne (les spans sont refermés à chaque
+    fin de ligne pour permettre l'alignement du diff). Résultat mis en cache par empreinte.
+    """
+    if lang not in HIGHLIGHT_LANGUAGES:
+        return [html.escape(line) for line in text.split("\n")]
+    digest = hashlib.sha1(f"{lang}\0{text}".encode("utf-8")).hexdigest()
+    cached = highlight_cache.get(digest)
+    if cached is not None:
+        highlight_cache.move_to_end(digest)
+        return cached
+
+    spec = HIGHLIGHT_LANGUAGES[lang]
+    ignore_case = spec.get("ignore_case", False)
+    lines = [[]]
+
+    def emit(segment, css_class=None):
+        for i, part in enumerate(segment.split("\n")):
+            if i:
+                lines.append([])
+            if part:
+                esc = html.escape(part)
+                lines[-1].append(f'<span class="ak-tk-{css_class}">{esc}</span>' if css_class else esc)
+
+    pos = 0
+    for m in _highlight_pattern(lang).finditer(text):
+        if m.start() > pos:
+            emit(text[pos:m.start()])
+        kind = m.lastgroup
+        token = m.group()
+        if kind == "word":
+            word = token.lower() if ignore_case else token
+            emit(token, "kw" if word in spec["keywords"] else None)
+        else:
+            emit(token, kind)
+        pos = m.end()
+    emit(text[pos:])
+
+    result = tuple("".join(parts) for parts in lines)
+    highlight_cache[digest] = result
+    if len(highlight_cache) > HIGHLIGHT_CACHE_SIZE:
+        highlight_cache.popitem(last=False)
+    return result
+
+def _intraline_html(left, right):
+    """Marque les caractères différents de deux lignes appariées"""
+    if len(left) + len(right) > 1000:
+        return f'<del>{html.escape(left)}</del>', f'<ins>{html.escape(right)}</ins>'
+    ops = myers_diff(left, right, max_d=200)
+    out_left, out_right = [], []
+    for tag, ch in ops:
+        esc = html.escape(ch)
+        if tag == "equal":
+            out_left.append(esc)
+            out_right.append(esc)
+        elif tag == "delete":
+            out_left.append(f"<del>{esc}</del>")
+        else:
+            out_right.append(f"<ins>{esc}</ins>")
+    # Regrouper les balises adjacentes pour alléger le DOM
+    join = lambda parts: "".join(parts).replace("</del><del>", "").replace("</ins><ins>", "")
+    return join(out_left), join(out_right)
+
+def _diff_row_html(row, left_lines=None, right_lines=None):
+    tag, ln_exp, left, ln_prov, right = row
+    if tag == "replace":
+        left_html, right_html = _intraline_html(left, right)
+    else:
+        # Lignes colorées (si disponibles), sinon texte échappé
+        if left is None:
+            left_html = ""
+        else:
+            left_html = left_lines[ln_exp - 1] if left_lines else html.escape(left)
+        if right is None:
+            right_html = ""
+        else:
+            right_html = right_lines[ln_prov - 1] if right_lines else html.escape(right)
+    return (f'<div class="ak-drow ak-d{tag}">'
+            f'<span class="ak-ln">{ln_exp or ""}</span><code>{left_html}</code>'
+            f'<span class="ak-ln">{ln_prov or ""}</span><code>{right_html}</code></div>')
 
-    try {
-      ta.focus();
-      ta.setSelectionRange(ta.value.length, ta.value.length);
-    } catch(e){}
-
-    // Ctrl/Cmd+Entrée => montrer la réponse
-    ta.addEventListener('keydown', function(e){
-      if ((e.ctrlKey || e.metaKey) && e.key === 'Enter') {
-        if (typeof pycmd === 'function') pycmd('ans');
-        e.preventDefault();
-      }
-    });
-  }
+# Déplie un bloc replié: le contenu est dans un <template>, non rendu tant qu'il n'est pas demandé
+_UNFOLD_JS = "var t=this.nextElementSibling;t.replaceWith(t.content);this.remove();"
 
-  if (document.readyState === 'loading') {
-    document.addEventListener('DOMContentLoaded', upgradeTypeAnswer);
-  } else {
-    upgradeTypeAnswer();
-  }
-})();
-</script>
-"""
+def _fold_html(rows_html, label):
+    return f'<div class="ak-fold" onclick="{_UNFOLD_JS}">{label}</div><template>{"".join(rows_html)}</template>'
 
-# Activer l’injection au chargement
-from aqt import gui_hooks
-gui_hooks.webview_will_set_content.append(inject_multiline_type_input)
+def _unchanged_html(rows_html):
+    # Une seule ligne ne vaut pas un repli
+    if len(rows_html) == 1:
+        return rows_html[0]
+    return _fold_html(rows_html, f"⋯ {len(rows_html)} unchanged lines")
+
+def render_code_diff(rows, context=3, max_rows=400, left_lines=None, right_lines=None):
+    """
+    HTML compact du diff: les zones inchangées au-delà de `context` lignes sont repliées,
+    et au-delà de `max_rows` lignes visibles le reste est rendu à la demande.
+    """
+    changed = [i for i, row in enumerate(rows) if row[0] != "equal"]
+    visible = set()
+    for i in changed:
+        visible.update(range(max(0, i - context), min(len(rows), i + context + 1)))
+    if not changed:
+        visible.update(range(min(len(rows), context)))
+
+    row_html = lambda r: _diff_row_html(r, left_lines, right_lines)
+    parts = []
+    hidden = []
+    shown = 0
+    for i, row in enumerate(rows):
+        if i in visible and shown < max_rows:
+            if hidden:
+                parts.append(_unchanged_html(hidden))
+                hidden = []
+            parts.append(row_html(row))
+            shown += 1
+        elif i in visible:
+            # Trop de lignes: le reste du diff est rendu à la demande
+            remaining = [row_html(r) for r in rows[i:]]
+            hidden_html = [_unchanged_html(hidden)] if hidden else []
+            parts.append(_fold_html(hidden_html + remaining, f"⋯ {len(rows) - i} more lines"))
+            hidden = []
+            break
+        else:
+            hidden.append(row_html(row))
+    if hidden:
+        parts.append(_unchanged_html(hidden))
+    return "".join(parts)
+
+# Comparaisons de code déjà calculées (extraction + diff), par empreinte des deux réponses;
+# False = calcul en échec ou hors délai
+code_compare_results = OrderedDict()
+code_compare_pending = {}  # empreinte -> tâche en cours (run_cpu_task)
+CODE_COMPARE_CACHE_SIZE = 32
+# Différences au plus pour un diff calculé pendant le rendu (au-delà: bloc supprimé puis inséré)
+SYNC_DIFF_MAX_D = 200
+
+def _should_offload_diff(expected, provided, config):
+    """
+    Diff hors du thread principal si le texte est long, ou s'il a assez de lignes pour que le diff
+    atteigne SYNC_DIFF_MAX_D: son coût est (N + M)·D, et D ne dépasse pas N + M.
+    """
+    if len(expected) + len(provided) >= int(config.get("cpu_offload_min_chars", 4000)):
+        return True
+    # Lignes estimées sur le HTML brut (sauts de ligne et balises de bloc), sans l'extraction du code
+    lines = sum(len(re.findall(r"\n|<br|<div|<p\b|<li", text, re.IGNORECASE)) + 1 for text in (expected, provided))
+    return lines > SYNC_DIFF_MAX_D
+
+def run_cpu_task(name, args, on_done, config, timeout_ms=None):
+    """
+    Exécute core.CPU_TASKS[name](*args) hors du thread principal (pool de processus ou threads).
+    on_done(result, error) est appelé une seule fois, sur le thread principal: avec le résultat,
+    l'exception levée, TimeoutError après timeout_ms ou CancelledError après cancel_cpu_task.
+    Retourne la tâche, à passer à cancel_cpu_task.
+    """
+    future = submit_cpu_task(name, args, config)
+    handle = {"future": future, "done": False}
+
+    def deliver(result, error):
+        if handle["done"]:
+            return
+        handle["done"] = True
+        on_done(result, error)
+
+    def on_future_done(f):
+        if f.cancelled():
+            from concurrent.futures import CancelledError
+            outcome = (None, CancelledError())
+        else:
+            error = f.exception()
+            outcome = (None if error else f.result(), error)
+        mw.taskman.run_on_main(lambda: deliver(*outcome))
+
+    def on_timeout():
+        # Une tâche déjà démarrée ne peut pas être interrompue: son résultat tardif sera ignoré
+        future.cancel()
+        deliver(None, TimeoutError(f"{name} took longer than {timeout_ms} ms"))
+
+    handle["deliver"] = deliver
+    future.add_done_callback(on_future_done)
+    if timeout_ms:
+        from aqt.qt import QTimer
+        QTimer.singleShot(int(timeout_ms), on_timeout)
+    return handle
+
+def cancel_cpu_task(handle):
+    """Annule une tâche de run_cpu_task; son callback reçoit CancelledError"""
+    from concurrent.futures import CancelledError
+    handle["future"].cancel()
+    handle["deliver"](None, CancelledError())
+
+def _start_code_compare(key, expected, provided, config):
+    """Calcule en arrière-plan la comparaison d'un gros bloc de code, puis rafraîchit le verso"""
+    if key in code_compare_pending:
+        return
+
+    def on_done(result, error):
+        code_compare_pending.pop(key, None)
+        if error is not None:
+            print(f"Code diff failed: {error!r}")
+        code_compare_results[key] = result if error is None else False
+        if len(code_compare_results) > CODE_COMPARE_CACHE_SIZE:
+            code_compare_results.popitem(last=False)
+        refresh_ai_analysis()
 
-def _code_compare_block(expected: str, provided: str, lang_hint: str, labels: dict) -> str:
-    exp_text = extract_code_text(expected)
-    prov_text = extract_code_text(provided)
+    code_compare_pending[key] = run_cpu_task("compare_code_texts", (expected, provided), on_done, config,
+                                             timeout_ms=config.get("cpu_task_timeout_ms", 10000))
+
+def _code_compare_block(expected: str, provided: str, lang_hint: str, labels: dict, context: int = 3, max_rows: int = 400,
+                        highlight: bool = True, config=None) -> str:
+    key = hashlib.sha1(f"{expected}\0{provided}".encode("utf-8")).hexdigest()
+    computed = code_compare_results.get(key)
+    if computed is None:
+        # Gros blocs: diff calculé hors du thread principal, le verso est rafraîchi à la fin
+        if config and _should_offload_diff(expected, provided, config):
+            _start_code_compare(key, expected, provided, config)
+            return '<div class="ak-diff-pending">Computing code diff...</div>'
+        computed = compare_code_texts(expected, provided, max_d=SYNC_DIFF_MAX_D)
+    if computed is False:
+        return '<div class="ak-diff-pending">Code diff unavailable</div>'
+    exp_text, prov_text, rows = computed
     le = labels.get("expected", "Expected")
     lp = labels.get("provided", "Your answer")
+    # Langage deviné sur la réponse attendue (plus fiable que la saisie)
+    lang_hint = lang_hint or (detect_code_language(exp_text) if highlight else "")
+    left_lines = right_lines = None
+    if lang_hint in HIGHLIGHT_LANGUAGES:
+        left_lines = highlight_code_lines(exp_text, lang_hint)
+        right_lines = highlight_code_lines(prov_text, lang_hint)
     return f"""
-    <div class="ak-compare" style="display:flex; gap:12px; margin:12px 0;">
-      <div style="flex:1; min-width:0;">
-        <div class="ak-label">{html.escape(le)}</div>
-        <pre class="ak-pre"><code class="language-{lang_hint}">{html.escape(exp_text)}</code></pre>
-      </div>
-      <div style="flex:1; min-width:0;">
-        <div class="ak-label">{html.escape(lp)}</div>
-        <pre class="ak-pre"><code class="language-{lang_hint}">{html.escape(prov_text)}</code></pre>
-      </div>
+    <div class="ak-compare ak-diff-head">
+      <div class="ak-col"><div class="ak-label">{html.escape(le)}</div></div>
+      <div class="ak-col"><div class="ak-label">{html.escape(lp)}</div></div>
     </div>
+    <div class="ak-diff language-{lang_hint}">{render_code_diff(rows, context=context, max_rows=max_rows, left_lines=left_lines, right_lines=right_lines)}</div>
     """
 
+# Boutons Anki reçus avant la fin de l'analyse de la carte (mode différé, réponse rapide):
+# card_id -> ease ou None tant que l'analyse est en cours; appliqués après son enregistrement
+pending_answers = {}
+# Ligne d'historique de l'analyse de la révision en cours: card_id -> id, ou None si cette révision
+# n'en a pas (erreur, note locale, cache mémoire); le bouton n'est enregistré que sur cette ligne
+review_analysis_rows = {}
+answered_lock = threading.Lock()
+
+def _flush_pending_answer(card_id):
+    """Fin de l'analyse (thread de fond): enregistre le bouton choisi entre-temps, s'il y en a un"""
+    with answered_lock:
+        ease = pending_answers.pop(card_id, None)
+        analysis_id = review_analysis_rows.pop(card_id, None) if ease else None
+    if ease and analysis_id:
+        try:
+            record_anki_answer(card_id, ease, analysis_id)
+        except Exception as e:
+            print(f"Error recording Anki answer in history: {e}")
+
+def show_deferred_feedback(result, question_text, config):
+    """Notification compacte du résultat IA d'une carte déjà notée (mode différé)"""
+    from aqt.utils import tooltip
+    texts = get_ui_texts(config.get("language", "english"))
+    suggestion = result.get("review_suggestion", "Good")
+    _, score_icon = _score_tier(result.get("score", 5))
+    suggestion_icon = SUGGESTION_STYLES.get(suggestion, SUGGESTION_STYLES["Good"])[1]
+    if result.get("local"):
+        title = texts.get("local_analysis", "Local comparison (AI unavailable)")
+    else:
+        title = texts.get("ai_analysis", "AI Analysis")
+    question = question_text[:80] + "…" if len(question_text) > 80 else question_text
+    tips = str(result.get("tips", ""))
+    tips = tips[:200] + "…" if len(tips) > 200 else tips
+    tooltip(
+        f'<b>{html.escape(title)}: {score_icon} {result.get("score", 5)}/10 · {suggestion_icon} '
+        f'{html.escape(texts.get("suggestions", {}).get(suggestion, suggestion))}</b>'
+        f'<br><i>{html.escape(question)}</i><br>{html.escape(tips)}',
+        period=int(config.get("deferred_toast_ms", 8000)),
+        parent=mw,
+    )
+
+@main_thread_timed("reviewer_will_compare_answer")
 def store_ai_analysis(expected_provided_tuple, type_pattern):
     """
     Lance l'analyse IA en arrière-plan pour ne pas bloquer l'UI,
-    afin que le verso s'affiche tout de suite avec un spinner.
+    afin que le verso s'affiche tout de suite avec un spinner
+    (ou, en mode différé, sans attendre: le résultat est notifié à son arrivée).
     """
     true_answer = expected_provided_tuple[0] or ""
     user_answer = expected_provided_tuple[1] or ""
 
     question_text = get_current_question()
     cache_key = f"{hash(question_text)}_{hash(true_answer)}_{hash(user_answer)}"
+    card = getattr(mw.reviewer, "card", None)
+    config = get_config()
+    rubric = get_card_rubric(card, config)
+    # Paquet d'origine: une carte révisée dans un paquet filtré garde son paquet dans l'historique
+    card_info = (card.id, card.nid, card.odid or card.did) if card is not None else None
+    # Trous de la carte lus sur la note (thread principal): parties d'une réponse cloze
+    cloze_parts = _card_cloze_answers(card)
+
+    deferred = config.get("feedback_mode", "inline") == "deferred"
 
     # Déjà en cache
     if cache_key in ai_analysis_cache:
         print(f"Using cached analysis for {cache_key}")
+        if card_info:
+            with answered_lock:
+                review_analysis_rows[card_info[0]] = None
+        if deferred:
+            show_deferred_feedback(ai_analysis_cache[cache_key], question_text, config)
         return expected_provided_tuple
 
     # Analyse déjà en cours
@@ -349,39 +891,72 @@ def store_ai_analysis(expected_provided_tuple, type_pattern):
         print(f"Analysis already in progress for {cache_key}")
         return expected_provided_tuple
 
+    if card_info:
+        with answered_lock:
+            pending_answers[card_info[0]] = None
+            review_analysis_rows[card_info[0]] = None
+
     # Marquer en cours
     is_analyzing[cache_key] = True
     analysis_results[cache_key] = None
+    analysis_started[cache_key] = time.monotonic()
     print(f"Starting background AI analysis for key: {cache_key}")
 
     # Tâche de fond
     def task():
         try:
             print("Calling AI API for analysis (background)...")
-            return analyze_answer_with_ai(question_text, true_answer, user_answer)
+            start = time.perf_counter()
+            parts = None
+            if config.get("part_grading", True):
+                parts = split_answer_parts(true_answer, user_answer, cloze_parts=cloze_parts,
+                                           lines=config.get("part_grading_lines", False),
+                                           max_parts=int(config.get("part_grading_max_parts", 8)))
+            if parts:
+                result = grade_answer_parts(question_text, parts, rubric, config)
+            else:
+                result = grade_answer(question_text, true_answer, user_answer, rubric, config)
         except Exception as e:
             print(f"AI Analysis Error (bg): {e}")
-            return {"score": 5, "tips": f"Analysis error: {str(e)}", "review_suggestion": "Good"}
+            if card_info:
+                _flush_pending_answer(card_info[0])
+            return {"score": 5, "tips": f"Analysis error: {str(e)}", "review_suggestion": "Good", "error": True}
+        # Historique (hors thread principal); les résultats d'erreur et locaux n'y entrent pas
+        if card_info and config.get("history_enabled", True) and not result.get("error") and not result.get("local"):
+            try:
+                analysis_id = record_analysis(*card_info, result, (time.perf_counter() - start) * 1000)
+                with answered_lock:
+                    review_analysis_rows[card_info[0]] = analysis_id
+            except Exception as e:
+                print(f"Error recording analysis history: {e}")
+        if card_info:
+            _flush_pending_answer(card_info[0])
+        return result
 
     # Callback: reçoit un Future
+    @main_thread_timed("analysis_done")
     def on_done(fut):
         try:
             result = fut.result()
         except Exception as e:
             print(f"Background task failed: {e}")
-            result = {"score": 5, "tips": f"Analysis error: {str(e)}", "review_suggestion": "Good"}
+            result = {"score": 5, "tips": f"Analysis error: {str(e)}", "review_suggestion": "Good", "error": True}
         finally:
             # Toujours dé-marquer l'état d'analyse
             is_analyzing[cache_key] = False
+            analysis_started.pop(cache_key, None)
 
         # Stocker le résultat (un dict, pas un Future)
         ai_analysis_cache[cache_key] = result
         analysis_results[cache_key] = result
         print(f"AI analysis completed (bg) for {cache_key}")
 
-        # Rafraîchir l'affichage
+        # Rafraîchir l'affichage (ou notifier, en mode différé: l'utilisateur est souvent déjà sur la carte suivante)
         try:
-            refresh_ai_analysis()
+            if deferred:
+                show_deferred_feedback(result, question_text, config)
+            else:
+                refresh_ai_analysis()
         except Exception as e:
             print(f"Refresh error after AI analysis: {e}")
 
@@ -391,34 +966,27 @@ def store_ai_analysis(expected_provided_tuple, type_pattern):
     # Laisser l'UI afficher le verso avec spinner
     return expected_provided_tuple
 
-def clean_html_content(html_content):
-    """
-    Nettoie le contenu HTML pour extraire le texte brut, 
-    en supprimant les balises HTML, le CSS et le JavaScript.
-    """
-    if not html_content:
-        return ""
-    
-    # 1. Supprimer les blocs de script et de style
-    # L'option re.DOTALL permet au '.' de correspondre aussi aux sauts de ligne
-    text = re.sub(r'<script.*?</script>', '', html_content, flags=re.DOTALL)
-    text = re.sub(r'<style.*?</style>', '', text, flags=re.DOTALL)
-    
-    # 2. Supprimer les balises HTML restantes
-    text = re.sub(r'<[^>]+>', '', text)
-    
-    # 3. Remplacer les entités HTML communes
-    text = text.replace('&nbsp;', ' ')
-    text = text.replace('&lt;', '<')
-    text = text.replace('&gt;', '>')
-    text = text.replace('&amp;', '&')
-    text = text.replace('&quot;', '"')
-    
-    # 4. Nettoyer les espaces multiples et les sauts de ligne
-    text = re.sub(r'\s+', ' ', text).strip()
-    
-    return text
+def _is_cloze_card(card):
+    """Carte d'un type de note cloze (les trous sont joints par ", " dans la réponse attendue)"""
+    try:
+        return card is not None and card.note_type()["type"] == 1  # MODEL_CLOZE
+    except Exception:
+        return False
 
+def _card_cloze_answers(card):
+    """Réponses des trous de la carte (champ de {{type:cloze:...}}, ordinal de la carte), ou None"""
+    if not _is_cloze_card(card):
+        return None
+    try:
+        match = re.search(r"\{\{type:cloze:(.+?)\}\}", card.template()["qfmt"])
+        if not match:
+            return None
+        return cloze_answers(card.note()[match.group(1)], card.ord + 1)
+    except Exception as e:
+        print(f"Error reading cloze deletions: {e}")
+        return None
+
+@main_thread_timed("get_current_question")
 def get_current_question():
     """
     **NOUVELLE FONCTION: Récupère le contenu de la question de la carte actuelle**
@@ -426,12 +994,18 @@ def get_current_question():
     try:
         if hasattr(mw, 'reviewer') and mw.reviewer and hasattr(mw.reviewer, 'card') and mw.reviewer.card:
             card = mw.reviewer.card
+
+            # Déjà préparée par le warm-up ou un rendu précédent
+            key = _question_context_key(card)
+            if key in question_context_cache:
+                return question_context_cache[key]
             
             # Récupérer le contenu de la question (front de la carte)
             question_html = card.question()
             
             # Nettoyer le HTML pour extraire le texte
             question_text = clean_html_content(question_html)
+            _store_question_context(key, question_text)
             
             print(f"Current question extracted: {question_text[:100]}...")
             return question_text
@@ -444,77 +1018,176 @@ def get_current_question():
 
 
 
+def _question_context_key(card):
+    """Clé du contexte de question: change si la note est modifiée"""
+    return (card.id, card.note().mod)
+
+def _store_question_context(key, question_text):
+    if len(question_context_cache) > 200:
+        question_context_cache.clear()
+    question_context_cache[key] = question_text
+
+def _upcoming_card_ids(limit):
+    """Identifiants des prochaines cartes à réviser (planificateur v3, sinon recherche)"""
+    try:
+        queued = mw.col.sched.get_queued_cards(fetch_limit=limit)
+        return [entry.card.id for entry in queued.cards]
+    except Exception:
+        return list(mw.col.find_cards("deck:current is:due"))[:limit]
+
+def warm_up_session():
+    """
+    Préchauffe la session de révision à l'ouverture du reviewer:
+    config, index des grilles, connexion au fournisseur et contexte des prochaines cartes.
+    """
+    config = get_config()
+    if not config.get("enabled", True) or not getattr(mw, "col", None):
+        return
+    if config.get("provider") == "auto":
+        routes = _configured_routes(config)
+    else:
+        routes = [r for r in [_get_provider_settings(config)] if r[2]]
+    urls = [PROVIDERS[provider]["url"].format(model=model) for provider, model, _ in routes]
+    limit = int(config.get("warmup_due_cards", 10))
+    # La collection n'est lue que sur le thread principal: la tâche ne reçoit que des chaînes
+    upcoming = []
+    try:
+        for cid in _upcoming_card_ids(limit) if limit > 0 else []:
+            card = mw.col.get_card(cid)
+            key = _question_context_key(card)
+            question_html = card.question() if key not in question_context_cache else None
+            expected = _type_answer_text(card) if config.get("syntax_highlight", True) else ""
+            upcoming.append((key, question_html, expected))
+    except Exception as e:
+        print(f"Error listing upcoming cards: {e}")
+
+    def task():
+        load_rubrics()
+        if config.get("history_enabled", True):
+            _seed_token_usage()
+        for url in urls:
+            prewarm_connection(url)
+        prepared = 0
+        for key, question_html, expected in upcoming:
+            if question_html is not None:
+                _store_question_context(key, clean_html_content(question_html))
+                prepared += 1
+            # Réponse attendue colorée à l'avance (cache par empreinte)
+            if expected:
+                expected = extract_code_text(expected)
+                lang = detect_code_language(expected)
+                if lang:
+                    highlight_code_lines(expected, lang)
+        return prepared
+
+    def on_done(fut):
+        try:
+            print(f"Session warm-up done ({fut.result()} questions prepared)")
+        except Exception as e:
+            print(f"Session warm-up failed: {e}")
+
+    mw.taskman.run_in_background(task, on_done)
+
+# Classes CSS par palier de score / suggestion (couleurs dans la feuille de style injectée)
+SCORE_TIERS = [(3, "aki-again", "❌"), (5, "aki-hard", "⚠️"), (8, "aki-good", "✅"), (10, "aki-easy", "🌟")]
+SUGGESTION_STYLES = {
+    "Again": ("aki-again", "🔄"),
+    "Hard": ("aki-hard", "🔥"),
+    "Good": ("aki-good", "👍"),
+    "Easy": ("aki-easy", "😎"),
+}
+
+# Fragments HTML déjà rendus, par clé d'analyse
+rendered_fragments = {}
+
+def _score_tier(score):
+    for limit, css_class, icon in SCORE_TIERS:
+        if score <= limit:
+            return css_class, icon
+    return SCORE_TIERS[-1][1], SCORE_TIERS[-1][2]
+
+@main_thread_timed("reviewer_will_render_compared_answer")
 def render_enhanced_comparison(output, initial_expected, initial_provided, type_pattern):
     """
-    Améliore l'affichage de la comparaison avec l'analyse IA
+    Améliore l'affichage de la comparaison avec l'analyse IA.
+    Le balisage est compact (classes de la feuille de style injectée une fois dans le reviewer)
+    et le fragment IA est mis en cache par clé d'analyse.
     """
     config = get_config()
     language = config.get("language", "english")
     texts = get_ui_texts(language)
-    labels = get_compare_labels(config)
     show_anki = config.get("show_anki_compare", True)
     show_code = config.get("show_code_compare", True)
     
     # Skip if AI is disabled
     if not config.get("enabled", True):
         return output
+
+    # Retour différé: comparaison d'Anki seule, le résultat IA arrive en notification (voir store_ai_analysis)
+    if config.get("feedback_mode", "inline") == "deferred":
+        cleanup_old_cache_entries()
+        return output
     
     # **MODIFIÉ: Inclure la question dans la clé de cache**
     question_text = get_current_question()
     cache_key = f"{hash(question_text)}_{hash(initial_expected)}_{hash(initial_provided)}"
     print(f"Rendering comparison for key: {cache_key}")
     
+    anki_section = f'<div class="aki-anki">{output}</div>' if show_anki else ""
+
     # Vérification simplifiée - si l'analyse est en cours, afficher un message simple
     if is_analyzing.get(cache_key, False) and cache_key not in ai_analysis_cache:
+        elapsed_ms = (time.monotonic() - analysis_started.get(cache_key, time.monotonic())) * 1000
+        display_deadline_ms = float(config.get("display_deadline_ms", DEFAULT_CONFIG["display_deadline_ms"]))
+        if elapsed_ms >= display_deadline_ms:
+            # Échéance d'affichage dépassée: estimation locale, remplacée par le résultat IA dès son
+            # arrivée (on_done de store_ai_analysis rafraîchit le verso), donc sans sondage
+            print(f"Display deadline passed for {cache_key}, showing provisional local result")
+            provisional = local_score(initial_expected, initial_provided, language, provisional=True)
+            fragment = _render_analysis_fragment(provisional, question_text, initial_expected, initial_provided,
+                                                 config, texts, False, "")
+            return f'<div class="aki-root">{anki_section}{fragment}</div>'
         print(f"Analysis in progress for {cache_key}, showing simple loading message")
-        # Message de chargement simple sans JavaScript compliqué
-        # Dans render_enhanced_comparison, remplacer le spinner_output par :
-        spinner_output = f"""
-        <div style="font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif; max-width: 800px; margin: 0 auto;">
-
-            <!-- Comparaison par défaut d'Anki -->
-            <div style="background: #f8f9fa; padding: 15px; border-radius: 8px; margin-bottom: 20px; border-left: 4px solid #6c757d;">
-                {output}
-            </div>
-
-            <!-- Bloc chargement -->
-            <div style="background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); border: none; border-radius: 16px; padding: 25px; margin: 20px 0; text-align: center; color: white; position: relative; overflow: hidden;">
-                <div style="display: inline-flex; align-items: center; gap: 12px; margin-bottom: 8px;">
-                    <div style="width: 26px; height: 26px; border: 3px solid rgba(255,255,255,0.35); border-top-color: #fff; border-radius: 50%; animation: aki_spin 0.9s linear infinite;"></div>
-                    <div style="font-size: 18px; font-weight: 600;">{texts['analyzing']}</div>
-                </div>
-                <p style="color: rgba(255,255,255,0.9); margin: 0; font-size: 14px;">
-                    {texts['please_wait']}
-                </p>
-                <p style="color: rgba(255,255,255,0.7); margin-top: 10px; font-size: 12px; font-style: italic;">
-                    Actualisation automatique...
-                </p>
-            </div>
-
-            <!-- Style + auto-refresh doux -->
-            <style>
-            @keyframes aki_spin {{ to {{ transform: rotate(360deg); }} }}
-            </style>
-            <script>
-            // Relance un rafraîchissement du verso pendant l'analyse.
-            // Sans boucle infinie: on appelle 1 fois à T+1.2s; si encore en cours, le même bloc se ré-affichera et relancera ce timeout.
-            setTimeout(function() {{
-                if (typeof pycmd === 'function') {{
-                pycmd('refresh_ai_analysis');
-                }}
-            }}, 1200);
-            </script>
-        </div>
-        """
-        return spinner_output
+        # Relance un rafraîchissement du verso pendant l'analyse, au plus tard à l'échéance d'affichage.
+        # Sans boucle infinie: on appelle 1 fois; si encore en cours, le même bloc se ré-affichera et relancera ce timeout.
+        refresh_ms = int(min(1200, display_deadline_ms - elapsed_ms)) + 20
+        return f"""<div class="aki-root">{anki_section}<div class="aki-loading"><div class="aki-loading-row"><div class="aki-spinner"></div><div class="aki-loading-title">{texts['analyzing']}</div></div><p>{texts['please_wait']}</p><p class="aki-loading-note">Actualisation automatique...</p></div><script>setTimeout(function(){{if(typeof pycmd==='function')pycmd('refresh_ai_analysis');}},{refresh_ms});</script></div>"""
     
     # Récupérer l'analyse IA stockée avec debug
     ai_analysis = analysis_results.get(cache_key) or ai_analysis_cache.get(cache_key)
     print(f"Retrieved analysis for {cache_key}: {ai_analysis is not None}")
     
+    # Mémoriser la suggestion pour l'application en un raccourci
+    if ai_analysis:
+        _remember_suggestion(cache_key, ai_analysis, config)
+
+    apply_mode = config.get("apply_suggestion_mode", "off")
+    shortcut = config.get("apply_suggestion_shortcut", "A")
+    can_apply = apply_mode != "off" and pending_suggestion.get("cache_key") == cache_key
+    fragment_key = (cache_key, language, show_code, can_apply, shortcut)
+
+    # Fragment déjà rendu pour cette analyse (rafraîchissements, retour sur la carte)
+    fragment = rendered_fragments.get(fragment_key) if ai_analysis else None
+    if fragment is None:
+        fragment = _render_analysis_fragment(ai_analysis, question_text, initial_expected, initial_provided,
+                                             config, texts, can_apply, shortcut)
+        # Pas de mise en cache tant que le diff de code est en cours de calcul
+        if ai_analysis and "ak-diff-pending" not in fragment:
+            rendered_fragments[fragment_key] = fragment
+
+    enhanced_output = f'<div class="aki-root">{anki_section}{fragment}</div>'
+    print(f"Rendered {len(enhanced_output)} chars for {cache_key}")
+    
+    # Nettoyer les caches plus prudemment
+    cleanup_old_cache_entries()
+    
+    return enhanced_output
+
+def _render_analysis_fragment(ai_analysis, question_text, initial_expected, initial_provided, config, texts, can_apply, shortcut):
+    """Construit le bloc comparaison code + analyse IA (sans la sortie d'Anki)"""
     # Si l'analyse n'est pas disponible, utiliser des valeurs par défaut
     if not ai_analysis:
-        print(f"No analysis available for {cache_key}, using defaults")
+        print("No analysis available, using defaults")
         ai_analysis = {
             "score": 5, 
             "tips": texts.get('ai_not_available', 'AI analysis not available'), 
@@ -523,114 +1196,147 @@ def render_enhanced_comparison(output, initial_expected, initial_provided, type_
     
     # Déterminer les couleurs selon le score
     score = ai_analysis.get('score', 5)
-    if score <= 3:
-        score_color = "#f44336"  # Rouge
-        score_bg = "#ffebee"
-        score_icon = "❌"
-        pulse_color = "#f44336"
-    elif score <= 5:
-        score_color = "#ff9800"  # Orange
-        score_bg = "#fff3e0"
-        score_icon = "⚠️"
-        pulse_color = "#ff9800"
-    elif score <= 8:
-        score_color = "#4caf50"  # Vert
-        score_bg = "#e8f5e8"
-        score_icon = "✅"
-        pulse_color = "#4caf50"
-    else:
-        score_color = "#2196f3"  # Bleu
-        score_bg = "#e3f2fd"
-        score_icon = "🌟"
-        pulse_color = "#2196f3"
+    score_class, score_icon = _score_tier(score)
     
     # Déterminer la couleur de la suggestion
     suggestion = ai_analysis.get('review_suggestion', 'Good')
-    suggestion_colors = {
-        "Again": ("#f44336", "#ffebee", "🔄"),
-        "Hard": ("#ff9800", "#fff3e0", "🔥"), 
-        "Good": ("#4caf50", "#e8f5e8", "👍"),
-        "Easy": ("#2196f3", "#e3f2fd", "😎")
-    }
-    suggestion_color, suggestion_bg, suggestion_icon = suggestion_colors.get(suggestion, ("#4caf50", "#e8f5e8", "👍"))
+    suggestion_class, suggestion_icon = SUGGESTION_STYLES.get(suggestion, SUGGESTION_STYLES["Good"])
+
+    # Raccourci pour appliquer la suggestion (modes 'preselect' / 'auto')
+    apply_attrs = ""
+    apply_hint = ""
+    if can_apply:
+        apply_attrs = ' onclick="pycmd(\'ai_apply_suggestion\')" title="Apply" role="button"'
+        hint = texts.get('apply_hint', 'Press {key} to apply').format(key=html.escape(shortcut))
+        apply_hint = f'<div class="aki-hint">⌨️ {hint}</div>'
     
     # **NOUVEAU: Afficher la question pour plus de contexte si elle existe**
     question_display = ""
     if question_text and len(question_text.strip()) > 0:
         # Limiter la longueur de la question affichée
         display_question = question_text[:200] + "..." if len(question_text) > 200 else question_text
-        question_display = f"""
-        <div style="background: rgba(255,255,255,0.9); border: 2px solid #e0e0e0; border-radius: 12px; padding: 15px; margin-bottom: 15px;">
-            <h4 style="color: #2c3e50; margin: 0 0 8px 0; font-size: 16px; font-weight: 700; display: flex; align-items: center;">
-                ❓ {texts.get('question_context', 'Question Context')}:
-            </h4>
-            <p style="color: #34495e; margin: 0; line-height: 1.4; font-size: 14px; font-style: italic;">
-                {display_question}
-            </p>
-        </div>
-        """
-    
+        question_display = f'<div class="aki-question"><h4>❓ {texts.get("question_context", "Question Context")}:</h4><p>{display_question}</p></div>'
+
+    # Détail des parties notées séparément (trous d'un cloze, lignes)
+    parts_display = ""
+    if ai_analysis.get("parts"):
+        items = "".join(
+            f'<li><span class="aki-part-score">{html.escape(str(part["score"]))}/10</span><b>{html.escape(part["expected"])}</b>'
+            f' — {html.escape(part["provided"] or "∅")}: {html.escape(str(part["tips"]))}</li>'
+            for part in ai_analysis["parts"]
+        )
+        parts_display = f'<div class="aki-parts"><h4>🧩 {texts.get("answer_parts", "Answer Parts")}</h4><ol>{items}</ol></div>'
+
     # Affichage alternatif fidèle pour le code (en plus du diff Anki)
-    anki_section = f"""
-    <div style="background: #f8f9fa; padding: 15px; border-radius: 8px; margin-bottom: 20px; border-left: 4px solid #6c757d;">
-    {output}
-    </div>
-    """ if show_anki else ""
+    code_block = ""
+    if config.get("show_code_compare", True):
+        code_block = _code_compare_block(initial_expected, initial_provided, lang_hint="", labels=get_compare_labels(config),
+                                         context=int(config.get("code_diff_context", 3)),
+                                         max_rows=int(config.get("code_diff_max_rows", 400)),
+                                         highlight=config.get("syntax_highlight", True), config=config)
+
+    # Résultat de secours sans LLM (disjoncteur ouvert ou fournisseur en erreur): clairement signalé
+    if ai_analysis.get("provisional"):
+        avatar, title = "⏳", texts.get("provisional_analysis", "Local estimate (AI result pending)")
+    elif ai_analysis.get("local"):
+        avatar, title = "📏", texts.get("local_analysis", "Local comparison (AI unavailable)")
+    else:
+        avatar, title = "🤖", texts.get("ai_analysis", "AI Analysis")
+
+    return (
+        f'{code_block}'
+        f'<div class="aki-card {score_class}">'
+        f'<div class="aki-head"><div class="aki-title"><div class="aki-avatar">{avatar}</div>'
+        f'<h3>{title}</h3></div>'
+        f'<div class="aki-score">{score_icon} {score}/10</div></div>'
+        f'{question_display}'
+        f'{parts_display}'
+        f'<div class="aki-tips"><h4>💡 {texts.get("improvement_tips", "Improvement Tips")}</h4>'
+        f'<p>{html.escape(str(ai_analysis.get("tips", texts.get("no_tips_available", "No tips available"))))}</p></div>'
+        f'<div class="aki-suggest {suggestion_class}"><div class="aki-suggest-row">'
+        f'<span class="aki-suggest-label">🎯 {texts.get("review_suggestion", "Review Suggestion")}:</span>'
+        f'<span class="aki-badge"{apply_attrs}>{suggestion_icon} {texts.get("suggestions", {}).get(suggestion, suggestion)}</span>'
+        f'</div>{apply_hint}</div>'
+        f'</div>'
+    )
+
+
+def _remember_suggestion(cache_key, ai_analysis, config):
+    """Mémorise la suggestion de la carte courante et planifie l'auto-réponse si autorisée"""
+    mode = config.get("apply_suggestion_mode", "off")
+    card = getattr(getattr(mw, "reviewer", None), "card", None)
+    if mode == "off" or card is None:
+        pending_suggestion.clear()
+        return
+    # Les résultats de secours (erreur, réponse non parsée, comparaison locale) ne sont jamais appliqués
+    if ai_analysis.get("error") or ai_analysis.get("unparsed") or ai_analysis.get("local"):
+        pending_suggestion.clear()
+        return
 
-    code_block = _code_compare_block(initial_expected, initial_provided, lang_hint="", labels=labels) if show_code else ""
-        
-    # Affichage simplifié des résultats
-    enhanced_output = f"""
-    <div style="font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif; max-width: 800px; margin: 0 auto;">
-        {anki_section}
-        {code_block}
-        
-        <!-- Analyse IA avec animation d'apparition -->
-        <div style="background: {score_bg}; border: 2px solid {score_color}; border-radius: 16px; padding: 25px; margin: 20px 0; box-shadow: 0 8px 32px rgba(0,0,0,0.1);">
-            
-            <div style="display: flex; align-items: center; margin-bottom: 20px;">
-                <div style="display: flex; align-items: center; flex: 1;">
-                    <div style="background: {score_color}; width: 48px; height: 48px; border-radius: 50%; display: flex; align-items: center; justify-content: center; margin-right: 15px; box-shadow: 0 4px 12px rgba(0,0,0,0.15);">
-                        <span style="font-size: 20px;">🤖</span>
-                    </div>
-                    <h3 style="color: {score_color}; margin: 0; font-size: 22px; font-weight: 700;">
-                        {texts.get('ai_analysis', 'AI Analysis')}
-                    </h3>
-                </div>
-                <div style="background: linear-gradient(135deg, {score_color}, {score_color}dd); color: white; padding: 12px 20px; border-radius: 25px; font-weight: bold; font-size: 18px; box-shadow: 0 4px 15px rgba(0,0,0,0.2);">
-                    {score_icon} {score}/10
-                </div>
-            </div>
-            
-            {question_display}
-            
-            <div style="margin-bottom: 20px; padding: 15px; background: rgba(255,255,255,0.7); border-radius: 12px; border-left: 4px solid {score_color};">
-                <h4 style="color: #2c3e50; margin: 0 0 10px 0; font-size: clamp(15px, 4vw, 17px); font-weight: 700; text-transform: uppercase; letter-spacing: 1px; display: flex; align-items: center;">
-                    💡 {texts.get('improvement_tips', 'Improvement Tips')}
-                </h4>
-                <p style="color: #34495e; margin: 0; line-height: 1.6; font-size: clamp(14px, 4vw, 16px);">
-                    {ai_analysis.get('tips', texts.get('no_tips_available', 'No tips available'))}
-                </p>
-            </div>
-            
-            <div style="background: linear-gradient(135deg, {suggestion_bg}, {suggestion_bg}dd); border: 2px solid {suggestion_color}; border-radius: 12px; padding: 16px;">
-                <div style="display: flex; align-items: center; justify-content: space-between;">
-                    <span style="color: #2c3e50; font-weight: 700; font-size: 16px; display: flex; align-items: center;">
-                        🎯 {texts.get('review_suggestion', 'Review Suggestion')}:
-                    </span>
-                    <span style="background: linear-gradient(135deg, {suggestion_color}, {suggestion_color}dd); color: white; padding: 10px 18px; border-radius: 20px; font-weight: bold; font-size: 15px; box-shadow: 0 3px 10px rgba(0,0,0,0.2);">
-                        {suggestion_icon} {texts.get('suggestions', {}).get(suggestion, suggestion)}
-                    </span>
-                </div>
-            </div>
-        </div>
-    </div>
-    """
-    
-    # Nettoyer les caches plus prudemment
-    cleanup_old_cache_entries()
-    
-    return enhanced_output
+    pending_suggestion.clear()
+    pending_suggestion.update({
+        "card_id": card.id,
+        "cache_key": cache_key,
+        "suggestion": ai_analysis.get("review_suggestion", "Good"),
+        "score": ai_analysis.get("score", 5),
+    })
+
+    if mode == "auto" and cache_key not in auto_answered and _in_auto_band(pending_suggestion["score"], config):
+        auto_answered.add(cache_key)
+        card_id = card.id
+        delay = int(config.get("auto_answer_delay_ms", 1500))
+        print(f"Auto-answer scheduled in {delay} ms for card {card_id}")
+        from aqt.qt import QTimer
+        QTimer.singleShot(delay, lambda: apply_ai_suggestion(expected_card_id=card_id))
+
+def _in_auto_band(score, config):
+    """Vrai si le score tombe dans une des bandes autorisées pour l'auto-réponse"""
+    bands = config.get("auto_answer_score_bands", DEFAULT_CONFIG["auto_answer_score_bands"])
+    try:
+        return any(float(lo) <= score <= float(hi) for lo, hi in bands)
+    except (TypeError, ValueError):
+        return False
+
+def _suggestion_to_ease(suggestion, card):
+    """Convertit la suggestion IA en bouton de réponse selon le nombre de boutons disponibles"""
+    ease = SUGGESTION_TO_EASE.get(suggestion, 3)
+    try:
+        buttons = mw.col.sched.answerButtons(card)
+    except Exception:
+        buttons = 4
+    if buttons == 3:
+        # Ancien planificateur en apprentissage: Again / Good / Easy
+        return {1: 1, 2: 2, 3: 2, 4: 3}[ease]
+    return max(1, min(ease, buttons))
+
+@main_thread_timed("apply_ai_suggestion")
+def apply_ai_suggestion(expected_card_id=None):
+    """Répond à la carte courante avec la suggestion IA, via le chemin de réponse du reviewer"""
+    reviewer = getattr(mw, "reviewer", None)
+    card = getattr(reviewer, "card", None)
+    if card is None or getattr(reviewer, "state", None) != "answer":
+        return False
+    if not pending_suggestion or pending_suggestion.get("card_id") != card.id:
+        return False
+    if expected_card_id is not None and expected_card_id != card.id:
+        # L'utilisateur est déjà passé à une autre carte
+        return False
+
+    ease = _suggestion_to_ease(pending_suggestion["suggestion"], card)
+    print(f"Applying AI suggestion {pending_suggestion['suggestion']} (ease {ease}) to card {card.id}")
+    pending_suggestion.clear()
+    reviewer._answerCard(ease)
+    return True
+
+@main_thread_timed("state_shortcuts_will_change")
+def _add_review_shortcuts(state, shortcuts):
+    """Ajoute le raccourci d'application de la suggestion IA dans le reviewer"""
+    if state != "review":
+        return
+    config = get_config()
+    if config.get("apply_suggestion_mode", "off") == "off":
+        return
+    shortcuts.append((config.get("apply_suggestion_shortcut", "A"), apply_ai_suggestion))
 
 def cleanup_old_cache_entries():
     """Nettoie les anciennes entrées de cache"""
@@ -642,6 +1348,9 @@ def cleanup_old_cache_entries():
                 ai_analysis_cache.pop(key, None)
                 is_analyzing.pop(key, None)
                 analysis_results.pop(key, None)
+                auto_answered.discard(key)
+            for fragment_key in [k for k in rendered_fragments if k[0] in keys_to_remove]:
+                rendered_fragments.pop(fragment_key, None)
             print(f"Cleaned up {len(keys_to_remove)} old cache entries")
     except Exception as e:
         print(f"Error during cache cleanup: {e}")
@@ -653,6 +1362,7 @@ def debug_cache_state():
     print(f"is_analyzing: {len(is_analyzing)} entries")
     print(f"analysis_results: {len(analysis_results)} entries")
     print(f"Currently analyzing: {[k for k, v in is_analyzing.items() if v]}")
+    print(format_stats())
     print("========================")
 
 def reset_ai_caches():
@@ -661,178 +1371,17 @@ def reset_ai_caches():
     ai_analysis_cache.clear()
     is_analyzing.clear()
     analysis_results.clear()
+    pending_suggestion.clear()
+    auto_answered.clear()
+    rendered_fragments.clear()
+    analysis_started.clear()
     print("AI caches reset")
 
-# import the necessary hooks
-from aqt import gui_hooks, mw
-from aqt.utils import showInfo, showWarning
-import json
-import urllib.request
-import urllib.error
-
-# Configuration par défaut
-DEFAULT_CONFIG = {
-    "provider": "openai",
-    "language": "english",
-    "openai_api_key": "",
-    "openai_model": "gpt-3.5-turbo",
-    "gemini_api_key": "",
-    "gemini_model": "gemini-1.5-flash",
-    "claude_api_key": "",
-    "claude_model": "claude-3-haiku-20240307",
-    "deepseek_api_key": "",
-    "deepseek_model": "deepseek-chat",
-    "groq_api_key": "",
-    "groq_model": "llama3-8b-8192",
-    "openrouter_api_key": "",
-    "openrouter_model": "deepseek/deepseek-r1:free",
-    "enabled": True,
-    "max_tokens": 200,
-    "temperature": 0.7,
-    "show_anki_compare": True,
-    "show_code_compare": True,
-    "ui_language": "auto",  # 'auto' | 'en' | 'fr' | 'es' | 'de' | 'pt' | 'it'
-}
-
-# **MODIFIÉ: Langues supportées avec nouveau texte pour le contexte de question**
-LANGUAGES = {
-    "english": {
-        "name": "English",
-        "ai_analysis": "AI Analysis",
-        "improvement_tips": "Improvement Tips",
-        "review_suggestion": "Review Suggestion",
-        "question_context": "Question Context",
-        "analyzing": "AI Analysis in progress...",
-        "please_wait": "Please wait while the AI evaluates your answer",
-        "processing_response": "Processing your response...",
-        "ai_not_available": "AI analysis not available",
-        "no_tips_available": "No tips available",
-        "suggestions": {
-            "Again": "Again",
-            "Hard": "Hard", 
-            "Good": "Good",
-            "Easy": "Easy"
-        }
-    },
-    "french": {
-        "name": "Français",
-        "ai_analysis": "Analyse IA",
-        "improvement_tips": "Conseils d'amélioration",
-        "review_suggestion": "Suggestion de révision",
-        "question_context": "Contexte de la question",
-        "analyzing": "Analyse IA en cours...",
-        "please_wait": "Veuillez patienter pendant que l'IA évalue votre réponse",
-        "processing_response": "Traitement de votre réponse...",
-        "ai_not_available": "Analyse IA non disponible",
-        "no_tips_available": "Aucun conseil disponible",
-        "suggestions": {
-            "Again": "Encore",
-            "Hard": "Difficile", 
-            "Good": "Correct",
-            "Easy": "Facile"
-        }
-    },
-    "spanish": {
-        "name": "Español",
-        "ai_analysis": "Análisis IA",
-        "improvement_tips": "Consejos de mejora",
-        "review_suggestion": "Sugerencia de revisión",
-        "question_context": "Contexto de la pregunta",
-        "analyzing": "Análisis IA en progreso...",
-        "please_wait": "Por favor espera mientras la IA evalúa tu respuesta",
-        "processing_response": "Procesando tu respuesta...",
-        "ai_not_available": "Análisis IA no disponible",
-        "no_tips_available": "Sin consejos disponibles",
-        "suggestions": {
-            "Again": "De nuevo",
-            "Hard": "Difícil", 
-            "Good": "Bien",
-            "Easy": "Fácil"
-        }
-    },
-    "german": {
-        "name": "Deutsch",
-        "ai_analysis": "KI-Analyse",
-        "improvement_tips": "Verbesserungstipps",
-        "review_suggestion": "Wiederholungsvorschlag",
-        "question_context": "Fragenkontext",
-        "analyzing": "KI-Analyse läuft...",
-        "please_wait": "Bitte warten Sie, während die KI Ihre Antwort bewertet",
-        "processing_response": "Ihre Antwort wird verarbeitet...",
-        "ai_not_available": "KI-Analyse nicht verfügbar",
-        "no_tips_available": "Keine Tipps verfügbar",
-        "suggestions": {
-            "Again": "Nochmal",
-            "Hard": "Schwer", 
-            "Good": "Gut",
-            "Easy": "Einfach"
-        }
-    }
-}
-
 def get_ui_texts(language="english"):
     """Récupère les textes de l'interface selon la langue"""
     return LANGUAGES.get(language, LANGUAGES["english"])
 
-# Configuration des fournisseurs
-PROVIDERS = {
-    "openai": {
-        "name": "OpenAI",
-        "url": "https://api.openai.com/v1/chat/completions",
-        "models": ["gpt-3.5-turbo", "gpt-4", "gpt-4-turbo", "gpt-4o", "gpt-4o-mini"],
-        "headers_func": lambda api_key: {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {api_key}"
-        }
-    },
-    "gemini": {
-        "name": "Google Gemini",
-        "url": "https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent",
-        "models": ["gemini-1.5-flash", "gemini-1.5-pro", "gemini-1.0-pro"],
-        "headers_func": lambda api_key: {
-            "Content-Type": "application/json",
-            "x-goog-api-key": api_key
-        }
-    },
-    "claude": {
-        "name": "Anthropic Claude",
-        "url": "https://api.anthropic.com/v1/messages",
-        "models": ["claude-3-haiku-20240307", "claude-3-sonnet-20240229", "claude-3-opus-20240229"],
-        "headers_func": lambda api_key: {
-            "Content-Type": "application/json",
-            "x-api-key": api_key,
-            "anthropic-version": "2023-06-01"
-        }
-    },
-    "deepseek": {
-        "name": "DeepSeek",
-        "url": "https://api.deepseek.com/chat/completions",
-        "models": ["deepseek-chat", "deepseek-coder"],
-        "headers_func": lambda api_key: {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {api_key}"
-        }
-    },
-    "groq": {
-        "name": "Groq",
-        "url": "https://api.groq.com/openai/v1/chat/completions",
-        "models": ["llama3-8b-8192", "llama3-70b-8192", "mixtral-8x7b-32768", "gemma-7b-it"],
-        "headers_func": lambda api_key: {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {api_key}"
-        }
-    },
-    "openrouter": {
-        "name": "OpenRouter",
-        "url": "https://openrouter.ai/api/v1/chat/completions",
-        "models": ["deepseek/deepseek-r1:free","google/gemini-2.5-flash","openai/gpt-4o-mini-2024-07-18", "meta-llama/llama-3.2-1b-instruct", "arliai/qwq-32b-arliai-rpr-v1","openai/gpt-oss-20b:free", "qwen/qwen3-coder:free" ,"google/gemma-3n-e2b-it:free" ,"tencent/hunyuan-a13b-instruct:free"],
-        "headers_func": lambda api_key: {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {api_key}"
-        }
-    }
-}
-
+@main_thread_timed("get_config")
 def get_config():
     """Récupère la configuration depuis les métadonnées d'Anki"""
     try:
@@ -849,324 +1398,419 @@ def save_config(config):
     """Sauvegarde la configuration dans les métadonnées d'Anki"""
     try:
         mw.addonManager.writeConfig(__name__, config)
+        configure_stall_detector(config)
     except Exception as e:
         print(f"Error saving config: {e}")
 
-def format_messages_for_provider(messages, provider):
-    """Formate les messages selon le fournisseur"""
-    if provider == "gemini":
-        # Gemini utilise un format différent
-        formatted_messages = []
-        for msg in messages:
-            if msg["role"] == "system":
-                # Gemini n'a pas de role system, on l'ajoute au premier message user
-                continue
-            elif msg["role"] == "user":
-                system_msg = next((m["content"] for m in messages if m["role"] == "system"), "")
-                content = f"{system_msg}\n\n{msg['content']}" if system_msg else msg["content"]
-                formatted_messages.append({
-                    "parts": [{"text": content}]
-                })
-        return {"contents": formatted_messages}
-    
-    elif provider == "claude":
-        # Claude utilise un format spécifique
-        system_msg = next((m["content"] for m in messages if m["role"] == "system"), "")
-        user_messages = [m for m in messages if m["role"] != "system"]
-        
-        formatted_data = {
-            "model": "",  # Sera ajouté plus tard
-            "max_tokens": 350,  # Sera ajouté plus tard
-            "messages": user_messages
-        }
-        
-        if system_msg:
-            formatted_data["system"] = system_msg
-            
-        return formatted_data
-    
-    else:
-        # Format OpenAI (compatible avec OpenAI, DeepSeek, Groq)
-        return {
-            "messages": messages,
-            "max_tokens": 350,  # Sera ajouté plus tard
-            "temperature": 0.7  # Sera ajouté plus tard
-        }
+# Grilles de notation par note, persistées dans user_files (conservé lors des mises à jour)
+USER_FILES_DIR = os.path.join(os.path.dirname(__file__), "user_files")
+RUBRICS_FILE = os.path.join(USER_FILES_DIR, "rubrics.json")
 
-def call_ai_api(messages, provider="openai", model="gpt-3.5-turbo", max_tokens=200, temperature=0.7, api_key=""):
-    """
-    Appelle l'API du fournisseur choisi
-    """
-    if provider not in PROVIDERS:
-        raise Exception(f"Fournisseur non supporté: {provider}")
-    
-    provider_config = PROVIDERS[provider]
-    
-    # Construire l'URL
-    if provider == "gemini":
-        url = provider_config["url"].format(model=model) + f"?key={api_key}"
-        headers = {"Content-Type": "application/json"}
-    else:
-        url = provider_config["url"]
-        headers = provider_config["headers_func"](api_key)
-    
-    # Formater les données selon le fournisseur
-    data = format_messages_for_provider(messages, provider)
-    
-    # Ajouter les paramètres spécifiques au modèle
-    if provider == "gemini":
-        data["generationConfig"] = {
-            "maxOutputTokens": max_tokens,
-            "temperature": temperature
-        }
-    elif provider == "claude":
-        data["model"] = model
-        data["max_tokens"] = max_tokens
-        data["temperature"] = temperature
-    else:
-        # OpenAI, DeepSeek, Groq
-        data["model"] = model
-        data["max_tokens"] = max_tokens
-        data["temperature"] = temperature
-    
-    try:
-        # Préparer la requête
-        json_data = json.dumps(data).encode('utf-8')
-        req = urllib.request.Request(url, data=json_data, headers=headers, method='POST')
-        
-        # Faire la requête
-        with urllib.request.urlopen(req, timeout=30) as response:
-            response_data = json.loads(response.read().decode('utf-8'))
-            print(f'--AI response-- {response_data}')
-        
-        # Extraire la réponse selon le fournisseur
-        if provider == "gemini":
-            if 'candidates' in response_data and len(response_data['candidates']) > 0:
-                return response_data['candidates'][0]['content']['parts'][0]['text']
-        elif provider == "claude":
-            if 'content' in response_data and len(response_data['content']) > 0:
-                return response_data['content'][0]['text']
-        else:
-            # OpenAI, DeepSeek, Groq
-            if 'choices' in response_data and len(response_data['choices']) > 0:
-                return response_data['choices'][0]['message']['content']
-        
-        raise Exception("Réponse API invalide")
-            
-    except urllib.error.HTTPError as e:
-        error_body = e.read().decode('utf-8')
+note_rubrics = {}  # str(note_id) -> {"mod": note.mod, "rubric": {...}}
+rubrics_lock = threading.Lock()
+rubric_state = {"loaded": False, "running": False}
+
+def load_rubrics():
+    """Charge les grilles de notation depuis le disque (une seule fois)"""
+    with rubrics_lock:
+        if rubric_state["loaded"]:
+            return
+        rubric_state["loaded"] = True
         try:
-            error_data = json.loads(error_body)
-            if provider == "gemini":
-                error_message = error_data.get('error', {}).get('message', str(e))
-            elif provider == "claude":
-                error_message = error_data.get('error', {}).get('message', str(e))
-            else:
-                error_message = error_data.get('error', {}).get('message', str(e))
-        except:
-            error_message = f"Erreur HTTP {e.code}: {error_body[:100]}"
-        raise Exception(f"Erreur API {provider_config['name']}: {error_message}")
-    
-    except urllib.error.URLError as e:
-        raise Exception(f"Erreur de connexion: {str(e)}")
-    
-    except json.JSONDecodeError as e:
-        raise Exception(f"Erreur de parsing JSON: {str(e)}")
-    
+            with open(RUBRICS_FILE, encoding="utf-8") as f:
+                note_rubrics.update(json.load(f))
+            print(f"Loaded {len(note_rubrics)} note rubrics")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Error loading rubrics: {e}")
+
+def save_rubrics():
+    """Sauvegarde les grilles de notation sur le disque"""
+    with rubrics_lock:
+        data = dict(note_rubrics)
+    try:
+        os.makedirs(USER_FILES_DIR, exist_ok=True)
+        tmp_path = RUBRICS_FILE + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, RUBRICS_FILE)
+    except Exception as e:
+        print(f"Error saving rubrics: {e}")
+
+def get_note_rubric(note_id, mod):
+    """Retourne la grille de la note si elle correspond à la version actuelle de la note"""
+    load_rubrics()
+    entry = note_rubrics.get(str(note_id))
+    if entry and entry.get("mod") == mod:
+        return entry.get("rubric")
+    return None
+
+def get_card_rubric(card, config):
+    """Grille de notation de la carte, si activée et déjà générée"""
+    if card is None or not config.get("use_rubrics", False):
+        return None
+    try:
+        note = card.note()
+        return get_note_rubric(note.id, note.mod)
+    except Exception as e:
+        print(f"Error reading card rubric: {e}")
+        return None
+
+def _type_answer_text(card):
+    """Contenu brut du champ {{type:...}} de la carte (réponse attendue)"""
+    try:
+        qfmt = card.template().get("qfmt", "")
+        m = re.search(r"{{type:(?:[^:}]+:)?([^}]+)}}", qfmt)
+        if not m:
+            return ""
+        note = card.note()
+        field = m.group(1).strip()
+        return note[field] if field in note.keys() else ""
     except Exception as e:
-        raise Exception(f"Erreur inattendue: {str(e)}")
+        print(f"Error reading type answer field: {e}")
+        return ""
 
-def get_language_specific_prompt(language, question_text, true_answer, user_answer):
+def generate_deck_rubrics():
     """
-    **MODIFIÉ: Génère un prompt selon la langue configurée avec contexte de question**
+    Génère en arrière-plan les grilles manquantes pour les cartes à réviser du paquet courant.
+    Le rendu des cartes se fait ici (thread principal), seuls les appels IA partent en tâche de fond.
     """
-    
-    prompts = {
-        "english": f"""
-        Analyze the student's answer in the context of the given question and provide a structured evaluation.
-
-        Question: "{question_text}"
-        Expected answer: "{true_answer}"
-        Student's answer: "{user_answer}"
-
-        Please provide your evaluation in the following JSON format:
-        {{
-            "score": [number from 0 to 10],
-            "tips": "[constructive feedback in English, maximum 100 words, considering the question context]",
-            "review_suggestion": "[choose from: Again, Hard, Good, Easy]"
-        }}
-
-        Evaluation criteria:
-        - Score 0-3: Incorrect or very incomplete answer → "Again"
-        - Score 4-5: Partially correct but with significant errors → "Hard"  
-        - Score 6-8: Correct answer with minor imperfections → "Good"
-        - Score 9-10: Excellent and complete answer → "Easy"
-        
-        Consider the question context when evaluating the relevance and completeness of the student's response.
-        """,
-        
-        "french": f"""
-        Analysez la réponse de l'étudiant dans le contexte de la question donnée et fournissez une évaluation structurée.
-
-        Question: "{question_text}"
-        Réponse attendue: "{true_answer}"
-        Réponse de l'étudiant: "{user_answer}"
-
-        Veuillez fournir votre évaluation au format JSON suivant:
-        {{
-            "score": [nombre de 0 à 10],
-            "tips": "[conseils constructifs en français, maximum 100 mots, en tenant compte du contexte de la question]",
-            "review_suggestion": "[choisir parmi: Again, Hard, Good, Easy]"
-        }}
-
-        Critères d'évaluation:
-        - Score 0-3: Réponse incorrecte ou très incomplète → "Again"
-        - Score 4-5: Réponse partiellement correcte mais avec des erreurs importantes → "Hard"  
-        - Score 6-8: Réponse correcte avec quelques imperfections mineures → "Good"
-        - Score 9-10: Réponse excellente et complète → "Easy"
-        
-        Considérez le contexte de la question lors de l'évaluation de la pertinence et de la complétude de la réponse de l'étudiant.
-        """,
-        
-        "spanish": f"""
-        Analiza la respuesta del estudiante en el contexto de la pregunta dada y proporciona una evaluación estructurada.
-
-        Pregunta: "{question_text}"
-        Respuesta esperada: "{true_answer}"
-        Respuesta del estudiante: "{user_answer}"
-
-        Por favor proporciona tu evaluación en el siguiente formato JSON:
-        {{
-            "score": [número del 0 al 10],
-            "tips": "[comentarios constructivos en español, máximo 100 palabras, considerando el contexto de la pregunta]",
-            "review_suggestion": "[elegir entre: Again, Hard, Good, Easy]"
-        }}
-
-        Criterios de evaluación:
-        - Puntuación 0-3: Respuesta incorrecta o muy incompleta → "Again"
-        - Puntuación 4-5: Respuesta parcialmente correcta pero con errores significativos → "Hard"
-        - Puntuación 6-8: Respuesta correcta con imperfecciones menores → "Good"
-        - Puntuación 9-10: Respuesta excelente y completa → "Easy"
-        
-        Considera el contexto de la pregunta al evaluar la relevancia y completitud de la respuesta del estudiante.
-        """,
-        
-        "german": f"""
-        Analysieren Sie die Antwort des Studenten im Kontext der gegebenen Frage und geben Sie eine strukturierte Bewertung ab.
-
-        Frage: "{question_text}"
-        Erwartete Antwort: "{true_answer}"
-        Antwort des Studenten: "{user_answer}"
-
-        Bitte geben Sie Ihre Bewertung im folgenden JSON-Format an:
-        {{
-            "score": [Zahl von 0 bis 10],
-            "tips": "[konstruktives Feedback auf Deutsch, maximal 100 Wörter, unter Berücksichtigung des Fragenkontexts]",
-            "review_suggestion": "[wählen Sie aus: Again, Hard, Good, Easy]"
-        }}
-
-        Bewertungskriterien:
-        - Punktzahl 0-3: Falsche oder sehr unvollständige Antwort → "Again"
-        - Punktzahl 4-5: Teilweise richtige Antwort, aber mit erheblichen Fehlern → "Hard"
-        - Punktzahl 6-8: Richtige Antwort mit kleineren Unvollkommenheiten → "Good"
-        - Punktzahl 9-10: Ausgezeichnete und vollständige Antwort → "Easy"
-        
-        Berücksichtigen Sie den Fragenkontext bei der Bewertung der Relevanz und Vollständigkeit der studentischen Antwort.
-        """
-    }
-    
-    return prompts.get(language, prompts["english"])
+    config = get_config()
+    if not config.get("enabled", True) or not config.get("use_rubrics", False):
+        return
+    if rubric_state["running"] or not getattr(mw, "col", None):
+        return
+    load_rubrics()
+
+    limit = int(config.get("rubric_batch_size", 20))
+    # Nombre de cartes chargées borné: ce parcours se fait à chaque ouverture d'un paquet
+    scan_limit = int(config.get("rubric_scan_limit", 200))
+    items = []
+    seen_notes = set()
+    try:
+        for cid in list(mw.col.find_cards("deck:current (is:due OR is:new)"))[:scan_limit]:
+            if len(items) >= limit:
+                break
+            card = mw.col.get_card(cid)
+            note = card.note()
+            if note.id in seen_notes or get_note_rubric(note.id, note.mod) is not None:
+                continue
+            seen_notes.add(note.id)
+            expected = clean_html_content(_type_answer_text(card))
+            if not expected:
+                continue
+            items.append((note.id, note.mod, clean_html_content(card.question()), expected))
+    except Exception as e:
+        print(f"Error collecting cards for rubrics: {e}")
+        return
+    if not items:
+        return
+
+    rubric_state["running"] = True
+    print(f"Generating {len(items)} note rubrics in background...")
+
+    def task():
+        done = 0
+        for note_id, mod, question_text, expected in items:
+            try:
+                rubric = generate_rubric(question_text, expected, config)
+            except Exception as e:
+                print(f"Rubric generation failed for note {note_id}: {e}")
+                continue
+            if rubric:
+                with rubrics_lock:
+                    note_rubrics[str(note_id)] = {"mod": mod, "rubric": rubric}
+                done += 1
+        return done
+
+    def on_done(fut):
+        rubric_state["running"] = False
+        try:
+            print(f"Generated {fut.result()} note rubrics")
+        except Exception as e:
+            print(f"Rubric job failed: {e}")
+        save_rubrics()
+
+    mw.taskman.run_in_background(task, on_done)
 
-def analyze_answer_with_ai(question_text: str, true_answer: str, user_answer: str) -> dict:
+# Historique des analyses (SQLite dans user_files, schéma et insertion dans core.py)
+HISTORY_FILE = os.path.join(USER_FILES_DIR, "history.sqlite3")
+
+history_state = {"conn": None}
+history_lock = threading.Lock()
+
+def _history_conn():
+    """Connexion SQLite partagée (ouverte au premier usage), à utiliser sous history_lock"""
+    if history_state["conn"] is None:
+        import sqlite3
+        os.makedirs(USER_FILES_DIR, exist_ok=True)
+        conn = sqlite3.connect(HISTORY_FILE, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(HISTORY_SCHEMA)
+        conn.executescript(ANALYSIS_CACHE_SCHEMA)
+        history_state["conn"] = conn
+    return history_state["conn"]
+
+def grade_answer(question_text, true_answer, user_answer, rubric, config):
     """
-    **MODIFIÉ: Analyse la réponse de l'utilisateur avec l'IA en incluant le contexte de la question**
-    Retourne un dictionnaire avec le score, les conseils et la suggestion de révision
+    Note une réponse (thread de fond): cache persistant, puis démon partagé si configuré
+    (repli sur l'analyse locale au processus s'il est injoignable), puis fournisseur.
     """
-    config = get_config()
-    
-    if not config.get("enabled", True):
-        return {"score": 5, "tips": "IA désactivée", "review_suggestion": "Good"}
-    
-    provider = config.get("provider", "openai")
     language = config.get("language", "english")
-    api_key_field = f"{provider}_api_key"
-    model_field = f"{provider}_model"
-    
-    api_key = config.get(api_key_field, "").strip()
-    if not api_key:
-        return {"score": 5, "tips": f"Clé API {PROVIDERS[provider]['name']} non configurée", "review_suggestion": "Good"}
-    
-    # **MODIFIÉ: Utiliser le prompt avec contexte de question selon la langue configurée**
-    prompt = get_language_specific_prompt(language, question_text, true_answer, user_answer)
-    
-    # Message système selon la langue
-    system_messages = {
-        "english": "You are an educational assistant that evaluates student responses constructively and kindly. Use the question context to provide more accurate and relevant feedback.",
-        "french": "Vous êtes un assistant pédagogique qui évalue les réponses des étudiants de manière constructive et bienveillante. Utilisez le contexte de la question pour fournir des commentaires plus précis et pertinents.",
-        "spanish": "Eres un asistente educativo que evalúa las respuestas de los estudiantes de manera constructiva y amable. Usa el contexto de la pregunta para proporcionar comentarios más precisos y relevantes.",
-        "german": "Sie sind ein pädagogischer Assistent, der die Antworten der Studenten konstruktiv und freundlich bewertet. Nutzen Sie den Fragenkontext, um genauere und relevantere Rückmeldungen zu geben."
-    }
-    
-    system_message = system_messages.get(language, system_messages["english"])
+    digest = analysis_digest(question_text, true_answer, user_answer, rubric, language, analysis_model_tag(config))
+    use_cache = config.get("persistent_cache", True)
+    if use_cache:
+        try:
+            with history_lock:
+                cached = cache_lookup(_history_conn(), digest)
+            if cached:
+                print(f"Using persistent cache for {digest[:12]}")
+                return cached
+        except Exception as e:
+            print(f"Error reading persistent cache: {e}")
 
-    messages = [
-        {"role": "system", "content": system_message},
-        {"role": "user", "content": prompt}
-    ]
+    result = None
+    daemon_url = config.get("daemon_url", "").strip()
+    # Budget de tokens vérifié avant le démon: une fois atteint, analyze_answer_with_ai répond sans appel
+    level = budget_level(config)
+    if daemon_url and level != "exhausted":
+        try:
+            result = analyze_via_daemon(daemon_url, question_text, true_answer, user_answer, rubric, language,
+                                        token=config.get("daemon_token", ""),
+                                        timeout=float(config.get("analysis_deadline_ms", 30000)) / 1000,
+                                        budget=level)
+        except Exception as e:
+            print(f"Grading daemon unavailable ({e}), analyzing in-process")
+        # Tokens dépensés par le démon pour cette analyse: comptés dans le budget local
+        if result and result.get("tokens"):
+            record_usage(result.get("provider", "daemon"), result.get("model"),
+                         result.get("input_tokens", 0), result.get("output_tokens", 0))
+    if result is None:
+        result = analyze_answer_with_ai(question_text, true_answer, user_answer, rubric=rubric, config=config)
+
+    if use_cache and is_cacheable(result):
+        try:
+            with history_lock:
+                cache_store(_history_conn(), digest, result)
+        except Exception as e:
+            print(f"Error writing persistent cache: {e}")
+    return result
 
+def grade_answer_parts(question_text, parts, rubric, config):
+    """
+    Note les parties en parallèle, chacune avec sa propre entrée de cache (un nouvel essai ne renote
+    que les parties modifiées), puis agrège. La grille de la note est envoyée avec chaque partie,
+    dont le numéro est indiqué dans la question.
+    """
+    import concurrent.futures
+    workers = max(1, min(len(parts), int(config.get("part_grading_workers", 4))))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="aki-part") as executor:
+        futures = [
+            executor.submit(grade_answer, part_question(question_text, index, len(parts)), expected, provided, rubric, config)
+            for index, (expected, provided) in enumerate(parts)
+        ]
+        results = [future.result() for future in futures]
+    return aggregate_part_results(parts, results)
+
+def record_analysis(card_id, note_id, deck_id, result, latency_ms):
+    """Ajoute une analyse à l'historique et met à jour les agrégats de la carte; retourne l'id de la ligne"""
+    with history_lock:
+        return history_insert(_history_conn(), card_id, note_id, deck_id, result, latency_ms)
+
+def record_anki_answer(card_id, ease, analysis_id):
+    """Enregistre le bouton choisi sur l'analyse de cette révision et marque les désaccords avec sa suggestion"""
+    with history_lock:
+        conn = _history_conn()
+        with conn:
+            row = conn.execute("SELECT suggestion FROM analyses WHERE id = ? AND card_id = ?",
+                               (analysis_id, card_id)).fetchone()
+            if not row:
+                return
+            conn.execute("UPDATE analyses SET anki_ease = ? WHERE id = ?", (ease, analysis_id))
+            disagree = 1 if SUGGESTION_TO_EASE.get(row[0]) not in (None, ease) else 0
+            conn.execute("UPDATE card_stats SET last_ease = ?, disagree = ? WHERE card_id = ?", (ease, disagree, card_id))
+
+def _deck_filter(deck_ids):
+    placeholders = ",".join("?" for _ in deck_ids)
+    return f"deck_id IN ({placeholders})", list(deck_ids)
+
+def weakest_cards(deck_ids, limit=50):
+    """Cartes des paquets donnés ayant la plus faible moyenne glissante de score IA"""
+    where, params = _deck_filter(deck_ids)
+    with history_lock:
+        rows = _history_conn().execute(
+            f"SELECT card_id FROM card_stats WHERE {where} ORDER BY rolling_mean ASC, trend ASC LIMIT ?",
+            params + [limit],
+        ).fetchall()
+    return [r[0] for r in rows]
+
+def disagreeing_cards(deck_ids, limit=100):
+    """Cartes dont la dernière réponse Anki diffère de la suggestion IA"""
+    where, params = _deck_filter(deck_ids)
+    with history_lock:
+        rows = _history_conn().execute(
+            f"SELECT card_id FROM card_stats WHERE {where} AND disagree = 1 ORDER BY last_ts DESC LIMIT ?",
+            params + [limit],
+        ).fetchall()
+    return [r[0] for r in rows]
+
+# Tokens des sessions précédentes du jour, repris une fois pour le budget journalier
+# (les analyses de cette session, postérieures à SESSION_STARTED, sont déjà comptées par core)
+SESSION_STARTED = time.time()
+token_usage_state = {"seeded": False}
+
+def _seed_token_usage():
+    if token_usage_state["seeded"]:
+        return
+    token_usage_state["seeded"] = True
+    midnight = time.mktime(time.strptime(time.strftime("%Y-%m-%d"), "%Y-%m-%d"))
     try:
-        ai_response = call_ai_api(
-            messages=messages,
-            provider=provider,
-            model=config.get(model_field, PROVIDERS[provider]["models"][0]),
-            max_tokens=config.get("max_tokens", 200),
-            temperature=config.get("temperature", 0.7),
-            api_key=api_key
-        )
-        
-        # Tenter de parser la réponse JSON
-        try:
-            # Nettoyer la réponse (enlever les balises markdown si présentes)
-            clean_response = ai_response.strip()
-            if clean_response.startswith("```json"):
-                clean_response = clean_response[7:]
-            if clean_response.endswith("```"):
-                clean_response = clean_response[:-3]
-            clean_response = clean_response.strip()
-            
-            result = json.loads(clean_response)
-            # Valider les champs requis
-            if all(key in result for key in ["score", "tips", "review_suggestion"]):
-                # Valider le score
-                result["score"] = max(0, min(10, int(result["score"])))
-                # Valider la suggestion de révision
-                if result["review_suggestion"] not in ["Again", "Hard", "Good", "Easy"]:
-                    result["review_suggestion"] = "Good"
-                return result
-        except (json.JSONDecodeError, ValueError, KeyError):
-            pass
-        
-        # Si le parsing JSON échoue, essayer d'extraire les informations
-        lines = ai_response.split('\n')
-        score = 5
-        tips = "Analyse disponible dans la réponse complète"
-        review_suggestion = "Good"
-        
-        for line in lines:
-            if 'score' in line.lower():
-                try:
-                    import re
-                    score_match = re.search(r'(\d+)', line)
-                    if score_match:
-                        score = max(0, min(10, int(score_match.group(1))))
-                except:
-                    pass
-        
-        return {"score": score, "tips": ai_response[:300] + "...", "review_suggestion": review_suggestion}
-        
+        with history_lock:
+            row = _history_conn().execute(
+                "SELECT COALESCE(SUM(tokens), 0) FROM analyses WHERE ts >= ? AND ts < ?", (midnight, SESSION_STARTED),
+            ).fetchone()
+        core.seed_daily_tokens(row[0])
+    except Exception as e:
+        print(f"Error reading today's token usage: {e}")
+
+def token_usage_by_deck(days=7):
+    """Tokens par jour, paquet et fournisseur (analyses de l'historique des `days` derniers jours)"""
+    with history_lock:
+        return _history_conn().execute(
+            "SELECT date(ts, 'unixepoch', 'localtime') AS day, deck_id, provider, COUNT(*), SUM(tokens)"
+            " FROM analyses WHERE tokens IS NOT NULL AND ts >= ?"
+            " GROUP BY day, deck_id, provider ORDER BY day DESC, SUM(tokens) DESC",
+            (time.time() - days * 86400,),
+        ).fetchall()
+
+def format_token_usage(days=7):
+    try:
+        rows = token_usage_by_deck(days)
     except Exception as e:
-        print(f"AI Analysis Error: {str(e)}")  # Pour debugging
-        return {"score": 5, "tips": f"Erreur d'analyse {PROVIDERS[provider]['name']}: {str(e)}", "review_suggestion": "Good"}
+        return [f"Token usage unavailable: {e}"]
+    if not rows:
+        return []
+    lines = [f"Tokens per day / deck / provider (last {days} days):"]
+    for day, deck_id, provider, count, tokens in rows:
+        try:
+            deck = mw.col.decks.name(deck_id)
+        except Exception:
+            deck = str(deck_id)
+        lines.append(f"  {day}  {deck}  {provider}: {tokens} tokens, {count} analyses")
+    return lines
+
+def build_filtered_deck(name, card_ids):
+    """Crée un paquet filtré contenant les cartes données"""
+    if not card_ids:
+        showInfo("No AI-scored cards match in this deck yet.")
+        return
+    search = "cid:" + ",".join(str(cid) for cid in card_ids)
+    try:
+        deck = mw.col.sched.get_or_create_filtered_deck(deck_id=0)
+        deck.name = name
+        deck.config.search_terms[0].search = search
+        deck.config.search_terms[0].limit = len(card_ids)
+        mw.col.sched.add_or_update_filtered_deck(deck)
+    except AttributeError:
+        # Anciennes versions d'Anki
+        did = mw.col.decks.new_filtered(name)
+        dyn = mw.col.decks.get(did)
+        dyn["terms"] = [[search, len(card_ids), 0]]
+        mw.col.decks.save(dyn)
+        mw.col.sched.rebuild_filtered_deck(did)
+    mw.reset()
+    showInfo(f"Filtered deck '{name}' created with {len(card_ids)} cards.")
+
+def _current_deck_ids():
+    did = mw.col.decks.current()["id"]
+    return list(mw.col.decks.deck_and_child_ids(did))
+
+def build_weak_cards_deck():
+    build_filtered_deck("AI weakest cards", weakest_cards(_current_deck_ids(), 50))
+
+def build_disagreement_deck():
+    build_filtered_deck("AI vs Anki disagreements", disagreeing_cards(_current_deck_ids()))
+
+CACHE_FILE_FILTER = "AI analysis cache (*.akicache.gz)"
+
+def export_cache_dialog():
+    """Tools → exporte le cache d'analyses dans un fichier à partager"""
+    from aqt.qt import QFileDialog
+    path, _ = QFileDialog.getSaveFileName(mw, "Export AI Analysis Cache", "analysis.akicache.gz", CACHE_FILE_FILTER)
+    if not path:
+        return
+
+    def task():
+        with history_lock:
+            conn = _history_conn()
+        return export_analysis_cache(conn, path, lock=history_lock)
+
+    def on_done(fut):
+        try:
+            showInfo(f"Exported {fut.result()} analyses to {path}")
+        except Exception as e:
+            showWarning(f"Export failed: {e}")
+
+    mw.taskman.run_in_background(task, on_done)
+
+def import_cache_dialog():
+    """Tools → fusionne un cache d'analyses exporté (voir import_analysis_cache pour les règles de fusion)"""
+    from aqt.qt import QFileDialog
+    path, _ = QFileDialog.getOpenFileName(mw, "Import AI Analysis Cache", "", CACHE_FILE_FILTER)
+    if not path:
+        return
+
+    def task():
+        # Verrou pris par paquet d'entrées: les statistiques et l'historique restent utilisables pendant l'import
+        with history_lock:
+            conn = _history_conn()
+        return import_analysis_cache(conn, path, lock=history_lock)
+
+    def on_done(fut):
+        try:
+            counts = fut.result()
+        except Exception as e:
+            showWarning(f"Import failed: {e}")
+            return
+        showInfo(f"{counts['added']} analyses added, {counts['replaced']} replaced by a better or newer result,"
+                 f" {counts['kept']} kept, {counts['skipped']} invalid entries skipped.")
+
+    mw.taskman.run_in_background(task, on_done)
+
+@main_thread_timed("reviewer_did_answer_card")
+def _on_card_answered(reviewer, card, ease):
+    """Hook reviewer_did_answer_card: mémorise le bouton choisi pour les comparaisons IA/Anki"""
+    if not get_config().get("history_enabled", True):
+        return
+    # Analyse de la carte encore en cours: le bouton sera enregistré après elle (_flush_pending_answer)
+    with answered_lock:
+        if card.id in pending_answers:
+            pending_answers[card.id] = ease
+            return
+        analysis_id = review_analysis_rows.pop(card.id, None)
+    # Pas d'analyse enregistrée pour cette révision: rien à comparer
+    if not analysis_id:
+        return
+    card_id = card.id
+
+    def on_done(fut):
+        try:
+            fut.result()
+        except Exception as e:
+            print(f"Error recording Anki answer in history: {e}")
+
+    # Écriture SQLite hors du thread principal (history_lock sérialise avec l'enregistrement des analyses)
+    mw.taskman.run_in_background(lambda: record_anki_answer(card_id, ease, analysis_id), on_done)
+
+@main_thread_timed("state_did_change")
+def _on_state_change(new_state, old_state):
+    """Génère les grilles à l'ouverture d'un paquet, préchauffe la session à l'ouverture du reviewer"""
+    if new_state == "overview":
+        generate_deck_rubrics()
+    elif new_state == "review" and old_state != "review":
+        warm_up_session()
 
 def setup_config_menu():
     """Configure le menu de configuration"""
@@ -1203,6 +1847,7 @@ def setup_config_menu():
         provider_layout.addWidget(QLabel("AI Provider:"))
         provider_combo = QComboBox()
         provider_items = [(key, value["name"]) for key, value in PROVIDERS.items()]
+        provider_items.append(("auto", "Auto (fastest configured provider)"))
         for key, name in provider_items:
             provider_combo.addItem(name, key)
         
@@ -1248,6 +1893,28 @@ def setup_config_menu():
         temp_spin.setValue(config.get("temperature", 0.7))
         temp_layout.addWidget(temp_spin)
         general_group.addLayout(temp_layout)
+
+        # Application de la suggestion IA
+        apply_layout = QHBoxLayout()
+        apply_layout.addWidget(QLabel("Apply AI suggestion:"))
+        apply_combo = QComboBox()
+        apply_modes = [("off", "Off"), ("preselect", "Pre-select (shortcut)"), ("auto", "Auto-answer (score bands)")]
+        for mode_key, mode_name in apply_modes:
+            apply_combo.addItem(mode_name, mode_key)
+        current_mode = config.get("apply_suggestion_mode", "off")
+        apply_combo.setCurrentIndex(next((i for i, (key, _) in enumerate(apply_modes) if key == current_mode), 0))
+        apply_layout.addWidget(apply_combo)
+        general_group.addLayout(apply_layout)
+
+        # Cascade de modèles
+        cascade_checkbox = QCheckBox("Model cascade (fast model first, escalate on ambiguous scores)")
+        cascade_checkbox.setChecked(config.get("cascade_enabled", False))
+        general_group.addWidget(cascade_checkbox)
+
+        # Retour différé: le verso n'attend pas l'IA, le résultat arrive en notification
+        deferred_checkbox = QCheckBox("Deferred feedback (answer side without waiting; AI result shown on the next card)")
+        deferred_checkbox.setChecked(config.get("feedback_mode", "inline") == "deferred")
+        general_group.addWidget(deferred_checkbox)
         
         layout.addLayout(general_group)
         
@@ -1318,9 +1985,10 @@ def setup_config_menu():
         def update_tab_states():
             selected_provider = provider_combo.currentData()
             for i, (provider_key, _) in enumerate(PROVIDERS.items()):
-                tab_enabled = (provider_key == selected_provider)
+                # En mode auto, tous les fournisseurs peuvent être configurés
+                tab_enabled = selected_provider in (provider_key, "auto")
                 tabs.setTabEnabled(i, tab_enabled)
-                if tab_enabled:
+                if provider_key == selected_provider:
                     tabs.setCurrentIndex(i)
         
         # Connecter le changement de fournisseur à la mise à jour des onglets
@@ -1329,42 +1997,87 @@ def setup_config_menu():
         # Initialiser l'état des onglets
         update_tab_states()
         
-        # Test de connexion
+        # Test de connexion (en arrière-plan, annulable)
+        test_layout = QHBoxLayout()
         test_button = QPushButton("Test API Connection")
-        layout.addWidget(test_button)
+        test_layout.addWidget(test_button)
+        test_all_chk = QCheckBox("All providers with a key")
+        test_layout.addWidget(test_all_chk)
+        cancel_test_button = QPushButton("Cancel")
+        cancel_test_button.setVisible(False)
+        test_layout.addWidget(cancel_test_button)
+        layout.addLayout(test_layout)
+        
+        # Test en cours: numéro (un résultat d'un test annulé ou remplacé est ignoré) et connexions à interrompre
+        test_state = {"generation": 0, "connections": []}
+        
+        def test_targets():
+            """(provider, model, clé) à tester: le fournisseur affiché, ou tous ceux qui ont une clé"""
+            if test_all_chk.isChecked():
+                providers = list(PROVIDERS.keys())
+            else:
+                current_provider_data = provider_combo.currentData()
+                if current_provider_data == "auto":
+                    # Tester le fournisseur de l'onglet affiché
+                    current_provider_data = list(PROVIDERS.keys())[tabs.currentIndex()]
+                providers = [current_provider_data]
+            targets = []
+            for provider_key in providers:
+                # Une seule clé suffit pour le test: champ du dialogue, puis liste {provider}_api_keys enregistrée
+                keys = get_api_keys({
+                    f"{provider_key}_api_key": api_inputs[provider_key].text(),
+                    f"{provider_key}_api_keys": config.get(f"{provider_key}_api_keys", []),
+                }, provider_key)
+                if keys:
+                    targets.append((provider_key, model_combos[provider_key].currentText(), keys[0]))
+            return targets
+        
+        def finish_test():
+            test_button.setText("Test API Connection")
+            test_button.setEnabled(True)
+            cancel_test_button.setVisible(False)
         
         def test_api():
-            current_provider_data = provider_combo.currentData()
-            api_key = api_inputs[current_provider_data].text().strip()
-            
-            if not api_key:
+            targets = test_targets()
+            if not targets:
                 showWarning("Please enter an API key to test the connection.")
                 return
             
             # Changer le texte du bouton pour indiquer le test en cours
-            original_text = test_button.text()
-            test_button.setText("Testing...")
+            test_button.setText(f"Testing {len(targets)}...")
             test_button.setEnabled(False)
+            cancel_test_button.setVisible(True)
+            test_state["generation"] += 1
+            generation = test_state["generation"]
+            connections = test_state["connections"] = []
             
-            try:
-                messages = [{"role": "user", "content": "Respond simply 'OK' to test the connection."}]
-                response = call_ai_api(
-                    messages=messages,
-                    provider=current_provider_data,
-                    model=model_combos[current_provider_data].currentText(),
-                    max_tokens=10,
-                    temperature=0.1,
-                    api_key=api_key
-                )
-                showInfo(f"✅ Connection successful with {PROVIDERS[current_provider_data]['name']}!\n\nResponse: {response[:50]}...")
-            except Exception as e:
-                showWarning(f"❌ Connection error with {PROVIDERS[current_provider_data]['name']}:\n\n{str(e)}")
-            finally:
-                # Restaurer le bouton
-                test_button.setText(original_text)
-                test_button.setEnabled(True)
+            def on_done(fut):
+                # Annulé (ou dialogue fermé) depuis: les widgets peuvent ne plus exister
+                if test_state["generation"] != generation:
+                    return
+                finish_test()
+                try:
+                    results = fut.result()
+                except Exception as e:
+                    showWarning(f"❌ Connection test failed:\n\n{str(e)}")
+                    return
+                report = "\n".join(format_probe_result(r) for r in results)
+                if all(r["ok"] for r in results):
+                    showInfo(f"Connection test (fastest first):\n\n{report}")
+                else:
+                    showWarning(f"Connection test (fastest first):\n\n{report}")
+            
+            mw.taskman.run_in_background(
+                lambda: probe_providers(targets, timeout=30, connections=connections), on_done)
+        
+        def cancel_test():
+            test_state["generation"] += 1
+            cancel_probes(test_state["connections"])
+            finish_test()
         
         test_button.clicked.connect(test_api)
+        cancel_test_button.clicked.connect(cancel_test)
+        dialog.finished.connect(lambda _result: cancel_test())
         
         # Boutons
         button_layout = QHBoxLayout()
@@ -1375,13 +2088,18 @@ def setup_config_menu():
         layout.addLayout(button_layout)
         
         def save_and_close():
-            new_config = {
+            # Partir de la config existante pour conserver les options avancées
+            new_config = dict(config)
+            new_config.update({
                 "provider": provider_combo.currentData(),
                 "language": language_combo.currentData(),
                 "enabled": enabled_checkbox.isChecked(),
                 "max_tokens": tokens_spin.value(),
-                "temperature": temp_spin.value()
-            }
+                "temperature": temp_spin.value(),
+                "apply_suggestion_mode": apply_combo.currentData(),
+                "cascade_enabled": cascade_checkbox.isChecked(),
+                "feedback_mode": "deferred" if deferred_checkbox.isChecked() else "inline",
+            })
             new_config["show_anki_compare"] = show_anki_chk.isChecked()
             new_config["show_code_compare"] = show_code_chk.isChecked()
             
@@ -1409,40 +2127,61 @@ def setup_config_menu():
     action = mw.form.menuTools.addAction("AI Multi-Provider Configuration")
     action.triggered.connect(open_config)
 
+    stats_action = mw.form.menuTools.addAction("AI Answer Scorer Stats")
+    stats_action.triggered.connect(lambda: showInfo(format_stats()))
+
+    weak_action = mw.form.menuTools.addAction("AI Filtered Deck: Weakest Cards")
+    weak_action.triggered.connect(build_weak_cards_deck)
+
+    disagree_action = mw.form.menuTools.addAction("AI Filtered Deck: AI/Anki Disagreements")
+    disagree_action.triggered.connect(build_disagreement_deck)
+
+    export_cache_action = mw.form.menuTools.addAction("AI Analysis Cache: Export...")
+    export_cache_action.triggered.connect(export_cache_dialog)
+
+    import_cache_action = mw.form.menuTools.addAction("AI Analysis Cache: Import...")
+    import_cache_action.triggered.connect(import_cache_dialog)
+
 # Commande pour rafraîchir l'analyse IA
+@main_thread_timed("refresh_ai_analysis")
 def refresh_ai_analysis():
     """Rafraîchit l'affichage de l'analyse IA"""
     if hasattr(mw, 'reviewer') and mw.reviewer and hasattr(mw.reviewer, 'card') and mw.reviewer.card:
+        # Seulement au verso: un résultat arrivé après le passage à la carte suivante ne doit pas la retourner
+        if getattr(mw.reviewer, 'state', None) != "answer":
+            return
         if hasattr(mw.reviewer, '_showAnswer'):
             mw.reviewer._showAnswer()
 
 # Enregistrer la commande pour le JavaScript
 def register_refresh_command():
     """Enregistre la commande de rafraîchissement pour le JavaScript"""
-    try:
-        from aqt import gui_hooks
-        gui_hooks.webview_did_receive_js_message.append(handle_js_message)
-    except ImportError:
-        pass
+    gui_hooks.webview_did_receive_js_message.append(handle_js_message)
 
+@main_thread_timed("webview_did_receive_js_message")
 def handle_js_message(handled, message, context):
     """Gère les messages JavaScript"""
     if message == "refresh_ai_analysis":
         refresh_ai_analysis()
         return True, None
+    if message == "ai_apply_suggestion":
+        apply_ai_suggestion()
+        return True, None
+    if message.startswith("aki_typeans:"):
+        record_typeans_timing(message)
+        return True, None
     return handled
 
 # Initialisation
 def init():
-    """Initialise l'add-on"""
+    """
+    Initialise l'add-on: seulement le menu et des hooks légers.
+    Réseau, grilles et historique sont initialisés au premier passage par le reviewer.
+    """
+    configure_stall_detector(get_config())
     setup_config_menu()
     register_refresh_command()
-    
-    # Nettoyer les caches au démarrage
-    ai_analysis_cache.clear()
-    is_analyzing.clear()
-    analysis_results.clear()
-    
+
 def _debug_dump_front(text, card, kind):
     if kind and "Question" in kind:
         print("=== FRONT HTML START ===")
@@ -1451,12 +2190,21 @@ def _debug_dump_front(text, card, kind):
     return text
 
 # Add the functions to the hooks
+gui_hooks.webview_will_set_content.append(inject_multiline_type_input)
 gui_hooks.card_will_show.append(_to_textarea_on_question)
 gui_hooks.card_will_show.append(_code_friendly_diff_on_answer)
 gui_hooks.reviewer_will_compare_answer.append(store_ai_analysis)
 gui_hooks.reviewer_will_render_compared_answer.append(render_enhanced_comparison)
-# enable briefly
-gui_hooks.card_will_show.append(_debug_dump_front)
+gui_hooks.state_shortcuts_will_change.append(_add_review_shortcuts)
+gui_hooks.state_did_change.append(_on_state_change)
+gui_hooks.reviewer_did_answer_card.append(_on_card_answered)
+gui_hooks.profile_will_close.append(shutdown_cpu_pool)
+if get_config().get("debug_dump_front", False):
+    gui_hooks.card_will_show.append(_debug_dump_front)
 
 # Initialiser lors du chargement
-init()
\ No newline at end of file
+init()
+
+load_stats["import_ms"] = (time.perf_counter() - _load_started) * 1000
+if load_stats["import_ms"] > get_config().get("load_time_budget_ms", DEFAULT_CONFIG["load_time_budget_ms"]):
+    print(f"AI Answer Scorer: add-on load took {load_stats['import_ms']:.1f} ms (over budget)")
\ No newline at end of file
@@ -0,0 +1,155 @@
+"""
+Notation en masse hors révision (re-notation, réponses importées) avec le moteur de core.py.
+
+Deux modes:
+- packed (défaut): K éléments par requête (voir core.grade_bulk); K s'adapte au budget de tokens
+  et à la latence observée, et seuls les éléments invalides sont refaits un par un.
+- batch: lot asynchrone OpenAI / Anthropic (moins cher, hors des limites interactives). Le job est
+  enregistré dans --job; relancer la même commande reprend le suivi au lieu de renvoyer le lot.
+
+Les résultats déjà présents dans le cache d'analyses sont réutilisés.
+
+    python bulk.py answers.jsonl --config bulk.json --output results.jsonl
+    python bulk.py answers.jsonl --config bulk.json --backend batch --cache user_files/history.sqlite3 --history
+
+Entrée: JSONL ou CSV (en-tête) avec les champs id, question_text, true_answer, user_answer
+et, en option, rubric (objet JSON) et card_id, note_id, deck_id (pour l'historique des scores).
+Sortie: une ligne JSON par élément {"id", "score", "tips", "review_suggestion", ...}.
+"""
+import argparse
+import csv
+import json
+import os
+import sqlite3
+import sys
+import time
+
+import core
+
+def read_items(path):
+    """Éléments d'un fichier JSONL ou CSV; l'id par défaut est le numéro de ligne"""
+    with open(path, encoding="utf-8", newline="") as f:
+        if path.lower().endswith(".csv"):
+            rows = list(csv.DictReader(f))
+        else:
+            rows = [json.loads(line) for line in f if line.strip()]
+    items = []
+    for number, row in enumerate(rows, 1):
+        rubric = row.get("rubric")
+        if isinstance(rubric, str):
+            rubric = json.loads(rubric) if rubric.strip() else None
+        items.append({
+            "id": str(row.get("id") or number),
+            "question_text": row.get("question_text", ""),
+            "true_answer": row.get("true_answer", ""),
+            "user_answer": row.get("user_answer", ""),
+            "rubric": rubric,
+            "card_id": int(row["card_id"]) if row.get("card_id") else None,
+            "note_id": int(row["note_id"]) if row.get("note_id") else None,
+            "deck_id": int(row["deck_id"]) if row.get("deck_id") else None,
+        })
+    return items
+
+def run_batch(items, config, job_path, digest):
+    """Envoie le lot (ou reprend le job enregistré), attend la fin et retourne {id: résultat}"""
+    if os.path.exists(job_path):
+        with open(job_path, encoding="utf-8") as f:
+            job = json.load(f)
+        print(f"Resuming batch {job['batch_id']} ({job['status']})", file=sys.stderr)
+    else:
+        job = core.submit_batch(core.build_batch_requests(items, config), config)
+
+    def save(job):
+        with open(job_path, "w", encoding="utf-8") as f:
+            json.dump(job, f)
+
+    save(job)
+    core.wait_for_batch(job, config, on_poll=save)
+    by_digest = core.fetch_batch_results(job, config)
+    print(f"Batch {job['batch_id']} {job['status']}: {len(by_digest)}/{job['count']} results", file=sys.stderr)
+    os.remove(job_path)
+    return {item["id"]: by_digest[digest(item)] for item in items if digest(item) in by_digest}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk grading with the AI Answer Scorer engine")
+    parser.add_argument("input", help="JSONL or CSV file of answers to grade")
+    parser.add_argument("--config", help="JSON file with the add-on settings (provider, API keys, ...)")
+    parser.add_argument("--output", help="JSONL file for the results (default: stdout)")
+    parser.add_argument("--cache", help="SQLite analysis cache to reuse and fill (e.g. user_files/history.sqlite3)")
+    parser.add_argument("--history", action="store_true",
+                        help="also add the scores of items with a card_id to the score history tables of --cache")
+    parser.add_argument("--backend", choices=("packed", "batch"), default="packed",
+                        help="packed: several answers per request; batch: asynchronous OpenAI/Anthropic batch")
+    parser.add_argument("--job", help="file keeping the batch job for resuming (default: <input>.job.json)")
+    parser.add_argument("--pack-size", type=int, help="initial number of answers per request")
+    args = parser.parse_args(argv)
+
+    config = {}
+    if args.config:
+        with open(args.config, encoding="utf-8") as f:
+            config = json.load(f)
+    config = core.resolve_config(config)
+    if args.pack_size:
+        config["bulk_pack_size"] = args.pack_size
+    language = config.get("language", "english")
+    model_tag = core.analysis_model_tag(config)
+
+    items = read_items(args.input)
+    out = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    conn = None
+    if args.cache:
+        conn = sqlite3.connect(args.cache)
+        conn.executescript(core.ANALYSIS_CACHE_SCHEMA)
+        if args.history:
+            conn.executescript(core.HISTORY_SCHEMA)
+
+    def digest(item):
+        return core.analysis_digest(item["question_text"], item["true_answer"], item["user_answer"],
+                                    item["rubric"], language, model_tag)
+
+    def write(item, result):
+        out.write(json.dumps(dict(result, id=item["id"]), ensure_ascii=False) + "\n")
+        out.flush()
+
+    def on_result(item, result):
+        if conn is not None:
+            core.cache_store(conn, digest(item), result)
+            if args.history and item["card_id"] and not (result.get("error") or result.get("local")):
+                core.history_insert(conn, item["card_id"], item["note_id"], item["deck_id"], result, None)
+        write(item, result)
+
+    started = time.monotonic()
+    pending = []
+    for item in items:
+        cached = core.cache_lookup(conn, digest(item)) if conn is not None else None
+        if cached:
+            write(item, cached)
+        else:
+            pending.append(item)
+    missing = 0
+    try:
+        if args.backend == "batch" and pending:
+            results = run_batch(pending, config, args.job or args.input + ".job.json", digest)
+            for item in pending:
+                if item["id"] in results:
+                    on_result(item, results[item["id"]])
+                else:
+                    missing += 1
+        else:
+            core.grade_bulk(pending, config, on_result=on_result)
+    finally:
+        if conn is not None:
+            conn.close()
+        if out is not sys.stdout:
+            out.close()
+
+    elapsed = time.monotonic() - started
+    rate = len(items) * 60 / elapsed if elapsed else 0
+    print(f"Graded {len(items) - missing} answers ({len(items) - len(pending)} from cache) in {elapsed:.1f} s"
+          f" ({rate:.0f}/min)", file=sys.stderr)
+    if missing:
+        print(f"{missing} answers have no batch result; run again to grade them", file=sys.stderr)
+    print(core.format_stats(config), file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
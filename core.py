@@ -0,0 +1,2482 @@
+"""
+Moteur de notation indépendant d'Anki: prompts, appels aux fournisseurs, parsing, extraction HTML et diff.
+
+Ce module n'importe pas aqt; il peut être utilisé hors d'Anki (benchmarks, notation en lot, serveur)
+en ajoutant le dossier de l'add-on au sys.path puis `import core`. La configuration est passée
+explicitement (dict, voir DEFAULT_CONFIG et resolve_config).
+"""
+import hashlib
+import html
+import json
+import os
+import re
+import sys
+import threading
+import time
+import urllib.parse
+from collections import Counter, deque
+from difflib import SequenceMatcher
+
+# http.client / urllib.error (et leurs dépendances email, ssl...) sont importés au premier appel réseau
+
+
+def extract_code_text(html_or_text: str) -> str:
+    """
+    Extract readable code from HTML or plaintext while preserving newlines/indentation.
+    - Prefers the content inside <pre> blocks if present (common in highlighter output).
+    - Strips tags/spans/line-numbering, unescapes entities.
+    - Falls back to a generic HTML strip that keeps line breaks.
+    """
+    if not html_or_text:
+        return ""
+    s = html_or_text.replace('\r\n', '\n').replace('\r', '\n')
+
+    # Prefer <pre> blocks (e.g., hilite.me wraps code in <pre> inside a table) [hilite.me](http://hilite.me/)
+    pre_blocks = re.findall(r'<pre[^>]*>(.*?)</pre>', s, flags=re.IGNORECASE | re.DOTALL)
+    if pre_blocks:
+        parts = []
+        for block in pre_blocks:
+            block = re.sub(r'<br\s*/?>', '\n', block, flags=re.IGNORECASE)
+            block = re.sub(r'<[^>]+>', '', block)  # strip spans/etc. inside pre
+            block = html.unescape(block)
+            block = '\n'.join(ln.rstrip() for ln in block.split('\n'))
+            parts.append(block.strip('\n'))
+        text = '\n\n'.join(parts)
+
+        # Optional: drop leading line numbers if most lines start with digits
+        lines = text.split('\n')
+        if lines and sum(1 for ln in lines if re.match(r'^\s*\d+\b', ln)) >= max(3, len(lines)//2):
+            lines = [re.sub(r'^\s*\d+\b\s*', '', ln) for ln in lines]
+            text = '\n'.join(lines)
+    else:
+        # Generic HTML → text with preserved line breaks
+        s = re.sub(r'<script.*?</script>', '', s, flags=re.IGNORECASE | re.DOTALL)
+        s = re.sub(r'<style.*?</style>', '', s, flags=re.IGNORECASE | re.DOTALL)
+        # Block-level to newline
+        s = re.sub(r'</?(p|div|br|li|tr|td|th|blockquote|h[1-6]|ul|ol|pre|table)[^>]*>', '\n', s, flags=re.IGNORECASE)
+        s = re.sub(r'<[^>]+>', '', s)  # remove remaining tags
+        text = html.unescape(s)
+
+    # Normalize blank lines
+    text = re.sub(r'\n{3,}', '\n\n', text).strip()
+    return text
+
+
+# Configuration par défaut
+DEFAULT_CONFIG = {
+    "provider": "openai",
+    "language": "english",
+    "openai_api_key": "",
+    "openai_model": "gpt-3.5-turbo",
+    "gemini_api_key": "",
+    "gemini_model": "gemini-1.5-flash",
+    "claude_api_key": "",
+    "claude_model": "claude-3-haiku-20240307",
+    "deepseek_api_key": "",
+    "deepseek_model": "deepseek-chat",
+    "groq_api_key": "",
+    "groq_model": "llama3-8b-8192",
+    "openrouter_api_key": "",
+    "openrouter_model": "deepseek/deepseek-r1:free",
+    "enabled": True,
+    "max_tokens": 200,
+    "temperature": 0.7,
+    "show_anki_compare": True,
+    "show_code_compare": True,
+    "ui_language": "auto",  # 'auto' | 'en' | 'fr' | 'es' | 'de' | 'pt' | 'it'
+    "apply_suggestion_mode": "off",  # 'off' | 'preselect' | 'auto'
+    "apply_suggestion_shortcut": "A",
+    "auto_answer_score_bands": [[0, 2], [9, 10]],  # auto uniquement si le score est dans une bande
+    "auto_answer_delay_ms": 1500,
+    "use_rubrics": False,  # grilles de notation générées à l'avance par note
+    "rubric_batch_size": 20,
+    "rubric_scan_limit": 200,  # cartes examinées au plus à chaque ouverture d'un paquet
+    "rubric_max_tokens": 400,  # limite de la réponse pour une grille (max_tokens sert à la notation)
+    "rubric_trim_chars": 300,
+    "warmup_due_cards": 10,  # nombre de cartes à préparer au démarrage du reviewer
+    "code_diff_context": 3,  # lignes inchangées affichées autour de chaque différence
+    "code_diff_max_rows": 400,  # au-delà, le reste du diff est rendu à la demande
+    "prompt_diff_hunks": False,  # envoyer seulement les zones différentes au modèle
+    "prompt_diff_min_lines": 8,
+    "syntax_highlight": True,  # coloration avec détection automatique du langage
+    "cascade_enabled": False,  # modèle rapide d'abord, escalade si score ambigu
+    "cascade_fast_model": "",  # vide = modèle rapide par défaut du fournisseur
+    "cascade_ambiguous_band": [4, 7],
+    # provider 'auto': routage selon latence/erreurs de chaque clé configurée
+    "auto_quality_weight": 0.3,  # 0 = latence seulement, 1 = qualité seulement
+    "auto_latency_sla_ms": 10000,
+    "auto_max_error_rate": 0.5,
+    "auto_demote_seconds": 120,
+    # plusieurs clés par fournisseur: '{provider}_api_key' séparées par des virgules ou '{provider}_api_keys'
+    "key_rotation": "round_robin",  # 'round_robin' | 'least_limited'
+    "key_bench_seconds": 60,
+    # disjoncteur par fournisseur: après N échecs consécutifs, comparaison locale pendant le délai
+    "breaker_failure_threshold": 3,
+    "breaker_cooldown_seconds": 60,
+    # délais par analyse: connexion, premier octet, échéance totale; le reviewer affiche
+    # une estimation locale après display_deadline_ms et la remplace à l'arrivée du résultat IA
+    "connect_timeout_ms": 5000,
+    "first_byte_timeout_ms": 20000,
+    "analysis_deadline_ms": 30000,
+    "display_deadline_ms": 5000,
+    "history_enabled": True,  # historique local des scores (user_files/history.sqlite3)
+    "debug_dump_front": False,  # affiche le HTML du recto dans la console (débogage)
+    "load_time_budget_ms": 30,  # au-delà, le temps de chargement de l'add-on est signalé dans la console
+    "stall_detector": True,  # chronomètre les hooks du thread principal
+    "stall_threshold_ms": 100,  # au-delà, l'appel est signalé avec la pile capturée
+    "persistent_cache": True,  # réutilise les analyses déjà faites (table analysis_cache)
+    "daemon_url": "",  # ex. http://192.168.1.10:8765 pour utiliser un démon de notation partagé (daemon.py)
+    "daemon_token": "",
+    # calculs locaux lourds (diff de gros blocs de code) hors du thread principal
+    "cpu_offload_min_chars": 4000,  # taille (attendu + saisi) à partir de laquelle le diff est calculé en arrière-plan
+    "cpu_task_timeout_ms": 10000,
+    "process_pool": False,  # processus séparés au lieu de threads (voir Config.md)
+    "process_pool_workers": 2,
+    "process_pool_python": "",  # interpréteur Python pour les workers si sys.executable n'en est pas un
+    # notation groupée hors révision (bulk.py): K réponses par requête, K adapté à la latence observée
+    "bulk_pack_size": 8,  # K initial
+    "bulk_max_pack_size": 32,
+    "bulk_target_latency_ms": 15000,  # durée visée d'une requête groupée
+    "bulk_tokens_per_item": 120,  # tokens de réponse réservés par élément
+    "bulk_max_prompt_tokens": 6000,
+    "bulk_max_output_tokens": 4000,
+    # lots asynchrones OpenAI / Anthropic (bulk.py --backend batch)
+    "batch_base_url": "",  # vide = API du fournisseur; sinon proxy compatible
+    "batch_poll_initial_seconds": 30,
+    "batch_poll_max_seconds": 600,
+    # notation par parties (trous d'un cloze, lignes d'une réponse structurée), en parallèle
+    "part_grading": True,
+    "part_grading_lines": False,  # découpe aussi par ligne (même nombre de lignes saisies qu'attendues)
+    "part_grading_max_parts": 8,  # au-delà, la réponse est notée d'un bloc
+    "part_grading_workers": 4,
+    # budget de tokens (0 = illimité): à budget_degrade_ratio, modèle rapide seul; une fois atteint,
+    # note locale ("local") ou seulement les analyses déjà en cache ("cache_only")
+    "daily_token_budget": 0,
+    "session_token_budget": 0,
+    "budget_degrade_ratio": 0.8,
+    "budget_exhausted_mode": "local",
+    # "deferred": le verso affiche la comparaison d'Anki sans attendre, le résultat IA arrive en notification
+    "feedback_mode": "inline",
+    "deferred_toast_ms": 8000,
+}
+
+def resolve_config(config=None):
+    """Configuration complète: valeurs par défaut complétées par celles fournies"""
+    resolved = dict(DEFAULT_CONFIG)
+    resolved.update(config or {})
+    return resolved
+
+# Suggestion IA -> bouton de réponse du reviewer
+SUGGESTION_TO_EASE = {"Again": 1, "Hard": 2, "Good": 3, "Easy": 4}
+
+# **MODIFIÉ: Langues supportées avec nouveau texte pour le contexte de question**
+# LANGUAGES, PROVIDERS et les tables de prompts sont de simples littéraux (≈20 µs à l'import, mesuré):
+# ils restent construits à l'import; seuls les imports coûteux (http.client, sqlite3...) sont différés.
+LANGUAGES = {
+    "english": {
+        "name": "English",
+        "ai_analysis": "AI Analysis",
+        "improvement_tips": "Improvement Tips",
+        "review_suggestion": "Review Suggestion",
+        "question_context": "Question Context",
+        "analyzing": "AI Analysis in progress...",
+        "please_wait": "Please wait while the AI evaluates your answer",
+        "processing_response": "Processing your response...",
+        "ai_not_available": "AI analysis not available",
+        "no_tips_available": "No tips available",
+        "apply_hint": "Press {key} to apply",
+        "local_analysis": "Local comparison (AI unavailable)",
+        "local_tips": "{percent}% similar to the expected answer. The AI provider is unavailable; this score comes from a local text comparison.",
+        "provisional_analysis": "Local estimate (AI result pending)",
+        "answer_parts": "Answer Parts",
+        "provisional_tips": "{percent}% similar to the expected answer. Local estimate; the AI analysis will replace it as soon as it arrives.",
+        "budget_local_tips": "{percent}% similar to the expected answer. The token budget is reached; this score comes from a local text comparison.",
+        "budget_cache_only": "Token budget reached: only answers already in the analysis cache are graded until the budget resets.",
+        "suggestions": {
+            "Again": "Again",
+            "Hard": "Hard", 
+            "Good": "Good",
+            "Easy": "Easy"
+        }
+    },
+    "french": {
+        "name": "Français",
+        "ai_analysis": "Analyse IA",
+        "improvement_tips": "Conseils d'amélioration",
+        "review_suggestion": "Suggestion de révision",
+        "question_context": "Contexte de la question",
+        "analyzing": "Analyse IA en cours...",
+        "please_wait": "Veuillez patienter pendant que l'IA évalue votre réponse",
+        "processing_response": "Traitement de votre réponse...",
+        "ai_not_available": "Analyse IA non disponible",
+        "no_tips_available": "Aucun conseil disponible",
+        "apply_hint": "Appuyez sur {key} pour appliquer",
+        "local_analysis": "Comparaison locale (IA indisponible)",
+        "local_tips": "{percent}% de similarité avec la réponse attendue. Le fournisseur IA est indisponible; ce score vient d'une comparaison locale du texte.",
+        "provisional_analysis": "Estimation locale (analyse IA en attente)",
+        "answer_parts": "Parties de la réponse",
+        "provisional_tips": "{percent}% de similarité avec la réponse attendue. Estimation locale; l'analyse IA la remplacera dès son arrivée.",
+        "budget_local_tips": "{percent}% de similarité avec la réponse attendue. Le budget de tokens est atteint; ce score vient d'une comparaison locale du texte.",
+        "budget_cache_only": "Budget de tokens atteint: seules les réponses déjà dans le cache d'analyses sont notées jusqu'à sa remise à zéro.",
+        "suggestions": {
+            "Again": "Encore",
+            "Hard": "Difficile", 
+            "Good": "Correct",
+            "Easy": "Facile"
+        }
+    },
+    "spanish": {
+        "name": "Español",
+        "ai_analysis": "Análisis IA",
+        "improvement_tips": "Consejos de mejora",
+        "review_suggestion": "Sugerencia de revisión",
+        "question_context": "Contexto de la pregunta",
+        "analyzing": "Análisis IA en progreso...",
+        "please_wait": "Por favor espera mientras la IA evalúa tu respuesta",
+        "processing_response": "Procesando tu respuesta...",
+        "ai_not_available": "Análisis IA no disponible",
+        "no_tips_available": "Sin consejos disponibles",
+        "apply_hint": "Pulsa {key} para aplicar",
+        "local_analysis": "Comparación local (IA no disponible)",
+        "local_tips": "{percent}% de similitud con la respuesta esperada. El proveedor de IA no está disponible; esta puntuación proviene de una comparación local del texto.",
+        "provisional_analysis": "Estimación local (análisis IA pendiente)",
+        "answer_parts": "Partes de la respuesta",
+        "provisional_tips": "{percent}% de similitud con la respuesta esperada. Estimación local; el análisis IA la reemplazará en cuanto llegue.",
+        "budget_local_tips": "{percent}% de similitud con la respuesta esperada. Se alcanzó el presupuesto de tokens; esta puntuación proviene de una comparación local del texto.",
+        "budget_cache_only": "Presupuesto de tokens alcanzado: solo se califican las respuestas que ya están en la caché de análisis hasta que se reinicie.",
+        "suggestions": {
+            "Again": "De nuevo",
+            "Hard": "Difícil", 
+            "Good": "Bien",
+            "Easy": "Fácil"
+        }
+    },
+    "german": {
+        "name": "Deutsch",
+        "ai_analysis": "KI-Analyse",
+        "improvement_tips": "Verbesserungstipps",
+        "review_suggestion": "Wiederholungsvorschlag",
+        "question_context": "Fragenkontext",
+        "analyzing": "KI-Analyse läuft...",
+        "please_wait": "Bitte warten Sie, während die KI Ihre Antwort bewertet",
+        "processing_response": "Ihre Antwort wird verarbeitet...",
+        "ai_not_available": "KI-Analyse nicht verfügbar",
+        "no_tips_available": "Keine Tipps verfügbar",
+        "apply_hint": "{key} drücken zum Übernehmen",
+        "local_analysis": "Lokaler Vergleich (KI nicht verfügbar)",
+        "local_tips": "{percent}% Ähnlichkeit mit der erwarteten Antwort. Der KI-Anbieter ist nicht verfügbar; diese Bewertung stammt aus einem lokalen Textvergleich.",
+        "provisional_analysis": "Lokale Schätzung (KI-Analyse ausstehend)",
+        "answer_parts": "Antwortteile",
+        "provisional_tips": "{percent}% Ähnlichkeit mit der erwarteten Antwort. Lokale Schätzung; die KI-Analyse ersetzt sie, sobald sie eintrifft.",
+        "budget_local_tips": "{percent}% Ähnlichkeit mit der erwarteten Antwort. Das Token-Budget ist erreicht; diese Bewertung stammt aus einem lokalen Textvergleich.",
+        "budget_cache_only": "Token-Budget erreicht: bis zum Zurücksetzen werden nur Antworten aus dem Analyse-Cache bewertet.",
+        "suggestions": {
+            "Again": "Nochmal",
+            "Hard": "Schwer", 
+            "Good": "Gut",
+            "Easy": "Einfach"
+        }
+    }
+}
+
+
+# Configuration des fournisseurs
+PROVIDERS = {
+    "openai": {
+        "name": "OpenAI",
+        "url": "https://api.openai.com/v1/chat/completions",
+        "models": ["gpt-3.5-turbo", "gpt-4", "gpt-4-turbo", "gpt-4o", "gpt-4o-mini"],
+        "headers_func": lambda api_key: {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {api_key}"
+        }
+    },
+    "gemini": {
+        "name": "Google Gemini",
+        "url": "https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent",
+        "models": ["gemini-1.5-flash", "gemini-1.5-pro", "gemini-1.0-pro"],
+        "headers_func": lambda api_key: {
+            "Content-Type": "application/json",
+            "x-goog-api-key": api_key
+        }
+    },
+    "claude": {
+        "name": "Anthropic Claude",
+        "url": "https://api.anthropic.com/v1/messages",
+        "models": ["claude-3-haiku-20240307", "claude-3-sonnet-20240229", "claude-3-opus-20240229"],
+        "headers_func": lambda api_key: {
+            "Content-Type": "application/json",
+            "x-api-key": api_key,
+            "anthropic-version": "2023-06-01"
+        }
+    },
+    "deepseek": {
+        "name": "DeepSeek",
+        "url": "https://api.deepseek.com/chat/completions",
+        "models": ["deepseek-chat", "deepseek-coder"],
+        "headers_func": lambda api_key: {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {api_key}"
+        }
+    },
+    "groq": {
+        "name": "Groq",
+        "url": "https://api.groq.com/openai/v1/chat/completions",
+        "models": ["llama3-8b-8192", "llama3-70b-8192", "mixtral-8x7b-32768", "gemma-7b-it"],
+        "headers_func": lambda api_key: {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {api_key}"
+        }
+    },
+    "openrouter": {
+        "name": "OpenRouter",
+        "url": "https://openrouter.ai/api/v1/chat/completions",
+        "models": ["deepseek/deepseek-r1:free","google/gemini-2.5-flash","openai/gpt-4o-mini-2024-07-18", "meta-llama/llama-3.2-1b-instruct", "arliai/qwq-32b-arliai-rpr-v1","openai/gpt-oss-20b:free", "qwen/qwen3-coder:free" ,"google/gemma-3n-e2b-it:free" ,"tencent/hunyuan-a13b-instruct:free"],
+        "headers_func": lambda api_key: {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {api_key}"
+        }
+    }
+}
+
+
+def format_messages_for_provider(messages, provider):
+    """Formate les messages selon le fournisseur"""
+    if provider == "gemini":
+        # Gemini utilise un format différent
+        formatted_messages = []
+        for msg in messages:
+            if msg["role"] == "system":
+                # Gemini n'a pas de role system, on l'ajoute au premier message user
+                continue
+            elif msg["role"] == "user":
+                system_msg = next((m["content"] for m in messages if m["role"] == "system"), "")
+                content = f"{system_msg}\n\n{msg['content']}" if system_msg else msg["content"]
+                formatted_messages.append({
+                    "parts": [{"text": content}]
+                })
+        return {"contents": formatted_messages}
+    
+    elif provider == "claude":
+        # Claude utilise un format spécifique
+        system_msg = next((m["content"] for m in messages if m["role"] == "system"), "")
+        user_messages = [m for m in messages if m["role"] != "system"]
+        
+        formatted_data = {
+            "model": "",  # Sera ajouté plus tard
+            "max_tokens": 350,  # Sera ajouté plus tard
+            "messages": user_messages
+        }
+        
+        if system_msg:
+            formatted_data["system"] = system_msg
+            
+        return formatted_data
+    
+    else:
+        # Format OpenAI (compatible avec OpenAI, DeepSeek, Groq)
+        return {
+            "messages": messages,
+            "max_tokens": 350,  # Sera ajouté plus tard
+            "temperature": 0.7  # Sera ajouté plus tard
+        }
+
+# Connexions HTTP persistantes (keep-alive), réutilisées entre les analyses
+http_pool = {}  # (scheme, host, port) -> [connexions libres]
+http_pool_lock = threading.Lock()
+HTTP_POOL_MAX_IDLE = 4
+
+def _pool_key(url):
+    parts = urllib.parse.urlsplit(url)
+    port = parts.port or (443 if parts.scheme == "https" else 80)
+    return (parts.scheme, parts.hostname, port)
+
+def _acquire_connection(key, timeout):
+    """Retourne (connexion, réutilisée?) pour l'hôte donné"""
+    with http_pool_lock:
+        idle = http_pool.get(key)
+        if idle:
+            conn = idle.pop()
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            return conn, True
+    import http.client
+    scheme, host, port = key
+    conn_class = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+    return conn_class(host, port, timeout=timeout), False
+
+def _release_connection(key, conn):
+    with http_pool_lock:
+        idle = http_pool.setdefault(key, [])
+        if len(idle) < HTTP_POOL_MAX_IDLE:
+            idle.append(conn)
+            return
+    conn.close()
+
+def _budget(limit, deadline):
+    """Délai (s) d'une étape: sa limite propre, bornée par le temps restant avant l'échéance globale"""
+    if deadline is None:
+        return limit
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise TimeoutError("analysis deadline exceeded")
+    return min(limit, remaining)
+
+def request_timeouts(config, deadline=None):
+    """Délais de connexion / premier octet (config, en ms) et échéance absolue (time.monotonic) d'une requête"""
+    return {
+        "connect_timeout": float(config.get("connect_timeout_ms", 5000)) / 1000,
+        "first_byte_timeout": float(config.get("first_byte_timeout_ms", 20000)) / 1000,
+        "deadline": deadline,
+    }
+
+def http_post(url, body, headers, timeout=30, connect_timeout=None, first_byte_timeout=None, deadline=None):
+    """POST sur une connexion keep-alive du pool (voir http_request)"""
+    return http_request("POST", url, body, headers, timeout=timeout, connect_timeout=connect_timeout,
+                        first_byte_timeout=first_byte_timeout, deadline=deadline)
+
+def http_request(method, url, body=None, headers=None, timeout=30, connect_timeout=None, first_byte_timeout=None,
+                 deadline=None):
+    """
+    Requête HTTP sur une connexion keep-alive du pool.
+    Lève urllib.error.HTTPError / URLError comme urlopen pour garder la gestion d'erreurs existante.
+    Délais par étape: connexion (connect_timeout), premier octet de la réponse (first_byte_timeout),
+    puis lecture du corps; aucune étape ne dépasse l'échéance absolue `deadline` (time.monotonic).
+    """
+    import http.client
+    import io
+    import urllib.error
+    key = _pool_key(url)
+    parts = urllib.parse.urlsplit(url)
+    path = parts.path + (f"?{parts.query}" if parts.query else "")
+
+    for attempt in range(2):
+        conn = None
+        try:
+            conn, reused = _acquire_connection(key, _budget(connect_timeout or timeout, deadline))
+            if conn.sock is None:
+                conn.connect()
+            sock = conn.sock
+            sock.settimeout(_budget(first_byte_timeout or timeout, deadline))
+            conn.request(method, path, body=body, headers=headers or {})
+            response = conn.getresponse()
+            # Corps lu par morceaux pour que l'échéance s'applique à toute la lecture
+            chunks = []
+            while True:
+                sock.settimeout(_budget(timeout, deadline))
+                chunk = response.read(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            data = b"".join(chunks)
+        except (http.client.HTTPException, OSError) as e:
+            if conn is not None:
+                conn.close()
+            if conn is not None and reused and attempt == 0 and not isinstance(e, TimeoutError):
+                # Connexion keep-alive fermée côté serveur: on réessaie avec une neuve
+                continue
+            raise urllib.error.URLError(e)
+
+        if response.will_close:
+            conn.close()
+        else:
+            _release_connection(key, conn)
+
+        if response.status >= 400:
+            raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(data))
+        return data
+
+def prewarm_connection(url, timeout=10):
+    """Ouvre à l'avance (DNS + TLS) une connexion vers l'hôte et la garde dans le pool"""
+    key = _pool_key(url)
+    with http_pool_lock:
+        if http_pool.get(key):
+            return
+    conn, _ = _acquire_connection(key, timeout)
+    try:
+        conn.connect()
+    except OSError as e:
+        conn.close()
+        print(f"Connection prewarm failed for {key[1]}: {e}")
+        return
+    _release_connection(key, conn)
+    print(f"Connection prewarmed for {key[1]}")
+
+class RateLimitError(Exception):
+    """Erreur 429 / quota du fournisseur (retry_after en secondes si annoncé)"""
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class TransientAPIError(Exception):
+    """Panne passagère du fournisseur (connexion, timeout, erreur 5xx): la note locale peut la remplacer"""
+
+# Rotation des clés API: état par fournisseur et par clé
+key_pool_state = {}  # provider -> {"next": index, "keys": {key: {...}}}
+key_pool_lock = threading.Lock()
+
+def get_api_keys(config, provider):
+    """
+    Clés configurées pour le fournisseur: '{provider}_api_keys' (liste) et/ou
+    '{provider}_api_key' contenant une ou plusieurs clés séparées par des virgules.
+    """
+    raw = [config.get(f"{provider}_api_key", "") or ""]
+    raw.extend(config.get(f"{provider}_api_keys", []) or [])
+    keys = []
+    for value in raw:
+        for key in re.split(r"[,\s]+", str(value)):
+            if key and key not in keys:
+                keys.append(key)
+    return keys
+
+def _key_entry(provider, key):
+    pool = key_pool_state.setdefault(provider, {"next": 0, "keys": {}})
+    return pool["keys"].setdefault(key, {"uses": 0, "limited": 0, "benched_until": 0.0, "last_limited": 0.0})
+
+def acquire_api_key(provider, keys, strategy="round_robin", exclude=()):
+    """Choisit la prochaine clé non mise sur la touche (None si toutes le sont)"""
+    now = time.time()
+    with key_pool_lock:
+        candidates = [k for k in keys if k not in exclude and _key_entry(provider, k)["benched_until"] <= now]
+        if not candidates:
+            return None
+        if strategy == "least_limited":
+            key = min(candidates, key=lambda k: (_key_entry(provider, k)["last_limited"], _key_entry(provider, k)["uses"]))
+        else:
+            pool = key_pool_state[provider]
+            key = candidates[pool["next"] % len(candidates)]
+            pool["next"] += 1
+        _key_entry(provider, key)["uses"] += 1
+        return key
+
+def bench_api_key(provider, key, seconds):
+    """Met une clé de côté après un 429 / dépassement de quota"""
+    with key_pool_lock:
+        entry = _key_entry(provider, key)
+        entry["limited"] += 1
+        entry["last_limited"] = time.time()
+        entry["benched_until"] = time.time() + seconds
+    print(f"API key …{key[-4:]} of {provider} rate limited, benched for {seconds:.0f} s")
+
+def call_with_key_pool(messages, provider, model, config, max_tokens, temperature, deadline=None):
+    """Appelle call_ai_api en répartissant les requêtes sur les clés du fournisseur"""
+    keys = get_api_keys(config, provider)
+    if not keys:
+        raise Exception(f"Clé API {PROVIDERS[provider]['name']} non configurée")
+    strategy = config.get("key_rotation", "round_robin")
+    tried = set()
+    last_error = None
+    while len(tried) < len(keys):
+        key = acquire_api_key(provider, keys, strategy, exclude=tried)
+        if key is None:
+            break
+        tried.add(key)
+        try:
+            return call_ai_api(messages=messages, provider=provider, model=model,
+                               max_tokens=max_tokens, temperature=temperature, api_key=key,
+                               timeouts=request_timeouts(config, deadline))
+        except RateLimitError as e:
+            bench_api_key(provider, key, e.retry_after or float(config.get("key_bench_seconds", 60)))
+            last_error = e
+    if last_error:
+        raise last_error
+    raise RateLimitError(f"Toutes les clés {PROVIDERS[provider]['name']} sont limitées")
+
+def format_key_stats():
+    with key_pool_lock:
+        lines = []
+        now = time.time()
+        for provider, pool in sorted(key_pool_state.items()):
+            for key, entry in pool["keys"].items():
+                state = " (benched)" if entry["benched_until"] > now else ""
+                lines.append(f"  {provider} …{key[-4:]}: {entry['uses']} uses, {entry['limited']} rate limits{state}")
+    return lines
+
+def build_request_body(messages, provider, model, max_tokens=200, temperature=0.7):
+    """Corps JSON (dict) de la requête au format du fournisseur, partagé par les appels directs et les lots"""
+    # Formater les données selon le fournisseur
+    data = format_messages_for_provider(messages, provider)
+    
+    # Ajouter les paramètres spécifiques au modèle
+    if provider == "gemini":
+        data["generationConfig"] = {
+            "maxOutputTokens": max_tokens,
+            "temperature": temperature
+        }
+    elif provider == "claude":
+        data["model"] = model
+        data["max_tokens"] = max_tokens
+        data["temperature"] = temperature
+    else:
+        # OpenAI, DeepSeek, Groq
+        data["model"] = model
+        data["max_tokens"] = max_tokens
+        data["temperature"] = temperature
+    
+    return data
+
+def build_api_request(messages, provider, model, max_tokens=200, temperature=0.7, api_key=""):
+    """URL, en-têtes et corps JSON (bytes) de la requête pour le fournisseur choisi"""
+    if provider not in PROVIDERS:
+        raise Exception(f"Fournisseur non supporté: {provider}")
+    
+    provider_config = PROVIDERS[provider]
+    
+    # Construire l'URL
+    if provider == "gemini":
+        url = provider_config["url"].format(model=model) + f"?key={api_key}"
+        headers = {"Content-Type": "application/json"}
+    else:
+        url = provider_config["url"]
+        headers = provider_config["headers_func"](api_key)
+    
+    data = build_request_body(messages, provider, model, max_tokens, temperature)
+    return url, headers, json.dumps(data).encode('utf-8')
+
+def extract_response_text(provider, response_data):
+    """Texte de la réponse selon le format du fournisseur"""
+    if provider == "gemini":
+        if 'candidates' in response_data and len(response_data['candidates']) > 0:
+            return response_data['candidates'][0]['content']['parts'][0]['text']
+    elif provider == "claude":
+        if 'content' in response_data and len(response_data['content']) > 0:
+            return response_data['content'][0]['text']
+    else:
+        # OpenAI, DeepSeek, Groq
+        if 'choices' in response_data and len(response_data['choices']) > 0:
+            return response_data['choices'][0]['message']['content']
+    
+    raise Exception("Réponse API invalide")
+
+def _api_error_message(error_body, status, default):
+    """Message d'erreur renvoyé par le fournisseur (même format {"error": {"message"}} pour tous)"""
+    try:
+        return json.loads(error_body).get('error', {}).get('message', default)
+    except:
+        return f"Erreur HTTP {status}: {error_body[:100]}"
+
+# Consommation de tokens: totaux de la session et du jour (par fournisseur), plus un compteur
+# par thread qui attribue à chaque analyse les tokens de ses appels (cascade comprise)
+usage_state = {
+    "day": "",
+    "day_tokens": 0,  # tokens du jour (historique des sessions précédentes compris, voir seed_daily_tokens)
+    "session_tokens": 0,
+    "providers": {},  # provider -> {"requests", "input", "output"} pour la session
+}
+usage_lock = threading.Lock()
+usage_local = threading.local()
+
+def extract_usage(provider, response_data):
+    """Tokens (entrée, sortie) annoncés par le fournisseur, (0, 0) s'ils manquent"""
+    if provider == "gemini":
+        usage = response_data.get("usageMetadata") or {}
+        return usage.get("promptTokenCount", 0) or 0, usage.get("candidatesTokenCount", 0) or 0
+    usage = response_data.get("usage") or {}
+    if provider == "claude":
+        return usage.get("input_tokens", 0) or 0, usage.get("output_tokens", 0) or 0
+    return usage.get("prompt_tokens", 0) or 0, usage.get("completion_tokens", 0) or 0
+
+def _roll_usage_day():
+    """Remise à zéro du total du jour au changement de date (à appeler sous usage_lock)"""
+    today = time.strftime("%Y-%m-%d")
+    if usage_state["day"] != today:
+        usage_state["day"] = today
+        usage_state["day_tokens"] = 0
+
+def record_usage(provider, model, input_tokens, output_tokens):
+    """Ajoute les tokens d'un appel aux totaux et au compteur de l'analyse en cours dans ce thread"""
+    tokens = input_tokens + output_tokens
+    with usage_lock:
+        _roll_usage_day()
+        usage_state["day_tokens"] += tokens
+        usage_state["session_tokens"] += tokens
+        entry = usage_state["providers"].setdefault(provider, {"requests": 0, "input": 0, "output": 0})
+        entry["requests"] += 1
+        entry["input"] += input_tokens
+        entry["output"] += output_tokens
+    counter = getattr(usage_local, "tokens", None)
+    if counter is not None:
+        counter[0] += input_tokens
+        counter[1] += output_tokens
+
+def seed_daily_tokens(tokens, day=None):
+    """Reprend les tokens déjà consommés aujourd'hui par les sessions précédentes (historique de l'add-on)"""
+    with usage_lock:
+        _roll_usage_day()
+        if (day or usage_state["day"]) == usage_state["day"]:
+            usage_state["day_tokens"] += tokens
+
+def _usage_so_far():
+    """Tokens des appels de l'analyse en cours (champs ajoutés au résultat)"""
+    counter = getattr(usage_local, "tokens", None)
+    if not counter or not (counter[0] or counter[1]):
+        return {}
+    return {"input_tokens": counter[0], "output_tokens": counter[1], "tokens": counter[0] + counter[1]}
+
+def budget_level(config):
+    """
+    État du budget de tokens (journalier et de session, 0 = illimité):
+    "ok", "cheap" au-delà de budget_degrade_ratio (modèle rapide seulement), "exhausted" une fois atteint.
+    budget_floor="cheap": au moins "cheap" (budget d'un client du démon, voir analyze_via_daemon)
+    """
+    with usage_lock:
+        _roll_usage_day()
+        used = [(usage_state["day_tokens"], int(config.get("daily_token_budget", 0) or 0)),
+                (usage_state["session_tokens"], int(config.get("session_token_budget", 0) or 0))]
+    ratio = max((tokens / budget for tokens, budget in used if budget > 0), default=0)
+    if ratio >= 1:
+        return "exhausted"
+    if ratio >= float(config.get("budget_degrade_ratio", 0.8)) or config.get("budget_floor") == "cheap":
+        return "cheap"
+    return "ok"
+
+def format_usage_stats(config=None):
+    config = resolve_config(config)
+    with usage_lock:
+        _roll_usage_day()
+        day_tokens, session_tokens = usage_state["day_tokens"], usage_state["session_tokens"]
+        providers = {k: dict(v) for k, v in usage_state["providers"].items()}
+    if not (day_tokens or session_tokens):
+        return []
+    daily, session = int(config.get("daily_token_budget", 0) or 0), int(config.get("session_token_budget", 0) or 0)
+    lines = [f"Tokens: session {session_tokens}" + (f"/{session}" if session else "")
+             + f", today {day_tokens}" + (f"/{daily}" if daily else "") + f" ({budget_level(config)})"]
+    for provider, entry in sorted(providers.items()):
+        lines.append(f"  {provider}: {entry['requests']} requests, {entry['input']} in / {entry['output']} out")
+    return lines
+
+def call_ai_api(messages, provider="openai", model="gpt-3.5-turbo", max_tokens=200, temperature=0.7, api_key="", timeouts=None):
+    """
+    Appelle l'API du fournisseur choisi
+    timeouts: délais par étape passés à http_post (voir request_timeouts)
+    """
+    import urllib.error
+    url, headers, json_data = build_api_request(messages, provider, model, max_tokens, temperature, api_key)
+    provider_config = PROVIDERS[provider]
+    
+    try:
+        # Faire la requête (connexion keep-alive réutilisée)
+        response_data = json.loads(http_post(url, json_data, headers, timeout=30, **(timeouts or {})).decode('utf-8'))
+        print(f'--AI response-- {response_data}')
+        record_usage(provider, model, *extract_usage(provider, response_data))
+        
+        # Extraire la réponse selon le fournisseur
+        return extract_response_text(provider, response_data)
+            
+    except urllib.error.HTTPError as e:
+        error_body = e.read().decode('utf-8')
+        error_message = _api_error_message(error_body, e.code, str(e))
+        if e.code == 429 or "quota" in error_message.lower():
+            try:
+                retry_after = float(e.headers.get("Retry-After")) if e.headers else None
+            except (TypeError, ValueError):
+                retry_after = None
+            raise RateLimitError(f"Erreur API {provider_config['name']}: {error_message}", retry_after)
+        if e.code >= 500:
+            raise TransientAPIError(f"Erreur API {provider_config['name']}: {error_message}")
+        raise Exception(f"Erreur API {provider_config['name']}: {error_message}")
+    
+    except urllib.error.URLError as e:
+        raise TransientAPIError(f"Erreur de connexion: {str(e)}")
+    
+    except json.JSONDecodeError as e:
+        raise Exception(f"Erreur de parsing JSON: {str(e)}")
+    
+    except Exception as e:
+        raise Exception(f"Erreur inattendue: {str(e)}")
+
+# Test de connexion: une requête sur une connexion neuve (non poolée) pour mesurer
+# connexion (TCP + TLS), premier octet et durée totale
+def probe_provider(provider, model, api_key, timeout=30, connections=None):
+    """
+    Teste un fournisseur/modèle et retourne ses temps (ms).
+    Si une liste `connections` est fournie, la connexion y est enregistrée pour que
+    cancel_probes puisse l'interrompre depuis un autre thread (elle en est alors retirée).
+    """
+    import http.client
+    result = {"provider": provider, "model": model, "ok": False,
+              "connect_ms": None, "ttfb_ms": None, "total_ms": None}
+    try:
+        messages = [{"role": "user", "content": "Respond simply 'OK' to test the connection."}]
+        url, headers, body = build_api_request(messages, provider, model, max_tokens=10, temperature=0.1, api_key=api_key)
+        scheme, host, port = _pool_key(url)
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path + (f"?{parts.query}" if parts.query else "")
+        conn_class = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+        conn = conn_class(host, port, timeout=timeout)
+        if connections is not None:
+            connections.append(conn)
+        try:
+            start = time.perf_counter()
+            conn.connect()
+            result["connect_ms"] = (time.perf_counter() - start) * 1000
+            # Annulé pendant connect(): la socket n'existait pas encore au moment de cancel_probes
+            if connections is not None and conn not in connections:
+                raise ConnectionAbortedError("test cancelled")
+            conn.request("POST", path, body=body, headers=headers)
+            response = conn.getresponse()
+            result["ttfb_ms"] = (time.perf_counter() - start) * 1000
+            data = response.read()
+            result["total_ms"] = (time.perf_counter() - start) * 1000
+        finally:
+            conn.close()
+        error_body = data.decode('utf-8', errors='replace')
+        if response.status >= 400:
+            result["error"] = _api_error_message(error_body, response.status, f"HTTP {response.status}")
+            return result
+        result["response"] = extract_response_text(provider, json.loads(error_body))
+        result["ok"] = True
+    except Exception as e:
+        result["error"] = str(e) or e.__class__.__name__
+    return result
+
+def probe_providers(targets, timeout=30, connections=None):
+    """Teste en parallèle une liste de (provider, model, api_key); résultats triés par durée totale"""
+    results = [None] * len(targets)
+
+    def worker(index, target):
+        results[index] = probe_provider(*target, timeout=timeout, connections=connections)
+
+    threads = [threading.Thread(target=worker, args=(i, t), daemon=True) for i, t in enumerate(targets)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sorted(results, key=lambda r: (not r["ok"], r["total_ms"] or float("inf")))
+
+def cancel_probes(connections):
+    """
+    Interrompt les tests en cours: ferme leurs connexions et les retire de la liste, ce qui
+    arrête aussi un test encore dans connect() dès la connexion établie (voir probe_provider).
+    """
+    import socket
+    for conn in list(connections):
+        connections.remove(conn)
+        sock = conn.sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        conn.close()
+
+def format_probe_result(result):
+    """Ligne de rapport d'un test de connexion"""
+    name = PROVIDERS[result["provider"]]["name"]
+    timings = ", ".join(f"{label} {result[key]:.0f} ms" for key, label in
+                        (("connect_ms", "connect"), ("ttfb_ms", "first byte"), ("total_ms", "total"))
+                        if result[key] is not None)
+    if result["ok"]:
+        return f"✅ {name} {result['model']}: {timings}"
+    return f"❌ {name} {result['model']}: {result.get('error', '')[:120]}" + (f" ({timings})" if timings else "")
+
+def get_language_specific_prompt(language, question_text, true_answer, user_answer, rubric=None, trim_chars=300, diff=None):
+    """
+    **MODIFIÉ: Génère un prompt selon la langue configurée avec contexte de question**
+    Si une grille de notation (rubric) existe pour la note, elle est envoyée avec
+    une version raccourcie de la question et de la réponse attendue.
+    Si un diff est fourni, seules les zones différentes sont envoyées en entier.
+    """
+    extra_sections = []
+    if rubric:
+        question_text = _trim_for_prompt(question_text, trim_chars)
+        true_answer = _trim_for_prompt(true_answer, trim_chars)
+        title = RUBRIC_TITLES.get(language, RUBRIC_TITLES["english"])
+        extra_sections.append(f"{title}:\n{format_rubric(rubric)}")
+    if diff:
+        true_answer = _trim_for_prompt(true_answer, trim_chars)
+        user_answer = _trim_for_prompt(user_answer, trim_chars)
+        title = DIFF_TITLES.get(language, DIFF_TITLES["english"])
+        extra_sections.append(f"{title}:\n{diff}")
+    extra_block = "\n".join(extra_sections)
+    
+    prompts = {
+        "english": f"""
+        Analyze the student's answer in the context of the given question and provide a structured evaluation.
+
+        Question: "{question_text}"
+        Expected answer: "{true_answer}"
+        Student's answer: "{user_answer}"
+        {extra_block}
+
+        Please provide your evaluation in the following JSON format:
+        {{
+            "score": [number from 0 to 10],
+            "tips": "[constructive feedback in English, maximum 100 words, considering the question context]",
+            "review_suggestion": "[choose from: Again, Hard, Good, Easy]"
+        }}
+
+        Evaluation criteria:
+        - Score 0-3: Incorrect or very incomplete answer → "Again"
+        - Score 4-5: Partially correct but with significant errors → "Hard"  
+        - Score 6-8: Correct answer with minor imperfections → "Good"
+        - Score 9-10: Excellent and complete answer → "Easy"
+        
+        Consider the question context when evaluating the relevance and completeness of the student's response.
+        """,
+        
+        "french": f"""
+        Analysez la réponse de l'étudiant dans le contexte de la question donnée et fournissez une évaluation structurée.
+
+        Question: "{question_text}"
+        Réponse attendue: "{true_answer}"
+        Réponse de l'étudiant: "{user_answer}"
+        {extra_block}
+
+        Veuillez fournir votre évaluation au format JSON suivant:
+        {{
+            "score": [nombre de 0 à 10],
+            "tips": "[conseils constructifs en français, maximum 100 mots, en tenant compte du contexte de la question]",
+            "review_suggestion": "[choisir parmi: Again, Hard, Good, Easy]"
+        }}
+
+        Critères d'évaluation:
+        - Score 0-3: Réponse incorrecte ou très incomplète → "Again"
+        - Score 4-5: Réponse partiellement correcte mais avec des erreurs importantes → "Hard"  
+        - Score 6-8: Réponse correcte avec quelques imperfections mineures → "Good"
+        - Score 9-10: Réponse excellente et complète → "Easy"
+        
+        Considérez le contexte de la question lors de l'évaluation de la pertinence et de la complétude de la réponse de l'étudiant.
+        """,
+        
+        "spanish": f"""
+        Analiza la respuesta del estudiante en el contexto de la pregunta dada y proporciona una evaluación estructurada.
+
+        Pregunta: "{question_text}"
+        Respuesta esperada: "{true_answer}"
+        Respuesta del estudiante: "{user_answer}"
+        {extra_block}
+
+        Por favor proporciona tu evaluación en el siguiente formato JSON:
+        {{
+            "score": [número del 0 al 10],
+            "tips": "[comentarios constructivos en español, máximo 100 palabras, considerando el contexto de la pregunta]",
+            "review_suggestion": "[elegir entre: Again, Hard, Good, Easy]"
+        }}
+
+        Criterios de evaluación:
+        - Puntuación 0-3: Respuesta incorrecta o muy incompleta → "Again"
+        - Puntuación 4-5: Respuesta parcialmente correcta pero con errores significativos → "Hard"
+        - Puntuación 6-8: Respuesta correcta con imperfecciones menores → "Good"
+        - Puntuación 9-10: Respuesta excelente y completa → "Easy"
+        
+        Considera el contexto de la pregunta al evaluar la relevancia y completitud de la respuesta del estudiante.
+        """,
+        
+        "german": f"""
+        Analysieren Sie die Antwort des Studenten im Kontext der gegebenen Frage und geben Sie eine strukturierte Bewertung ab.
+
+        Frage: "{question_text}"
+        Erwartete Antwort: "{true_answer}"
+        Antwort des Studenten: "{user_answer}"
+        {extra_block}
+
+        Bitte geben Sie Ihre Bewertung im folgenden JSON-Format an:
+        {{
+            "score": [Zahl von 0 bis 10],
+            "tips": "[konstruktives Feedback auf Deutsch, maximal 100 Wörter, unter Berücksichtigung des Fragenkontexts]",
+            "review_suggestion": "[wählen Sie aus: Again, Hard, Good, Easy]"
+        }}
+
+        Bewertungskriterien:
+        - Punktzahl 0-3: Falsche oder sehr unvollständige Antwort → "Again"
+        - Punktzahl 4-5: Teilweise richtige Antwort, aber mit erheblichen Fehlern → "Hard"
+        - Punktzahl 6-8: Richtige Antwort mit kleineren Unvollkommenheiten → "Good"
+        - Punktzahl 9-10: Ausgezeichnete und vollständige Antwort → "Easy"
+        
+        Berücksichtigen Sie den Fragenkontext bei der Bewertung der Relevanz und Vollständigkeit der studentischen Antwort.
+        """
+    }
+    
+    return prompts.get(language, prompts["english"])
+
+# Titre de la grille de notation dans le prompt
+RUBRIC_TITLES = {
+    "english": "Grading rubric",
+    "french": "Grille de notation",
+    "spanish": "Rúbrica de evaluación",
+    "german": "Bewertungsraster",
+}
+
+# Titre du diff (zones différentes) dans le prompt
+DIFF_TITLES = {
+    "english": "Differences ('-' expected only, '+' student only)",
+    "french": "Différences ('-' attendu seulement, '+' étudiant seulement)",
+    "spanish": "Diferencias ('-' solo esperado, '+' solo estudiante)",
+    "german": "Unterschiede ('-' nur erwartet, '+' nur Student)",
+}
+
+def _prompt_diff(true_answer, user_answer, config):
+    """Hunks du diff pour le prompt, si activé et si la réponse est assez longue"""
+    if not config.get("prompt_diff_hunks", False):
+        return None
+    exp_text = extract_code_text(true_answer)
+    prov_text = extract_code_text(user_answer)
+    if exp_text.count("\n") + 1 < int(config.get("prompt_diff_min_lines", 8)):
+        return None
+    return format_diff_for_prompt(diff_code_lines(exp_text, prov_text))
+
+def _trim_for_prompt(text, limit):
+    """Raccourcit un texte pour le prompt en gardant le début"""
+    text = text or ""
+    if limit and len(text) > limit:
+        return text[:limit].rstrip() + "…"
+    return text
+
+def format_rubric(rubric):
+    """Formate une grille de notation en quelques lignes compactes"""
+    sections = [
+        ("Key points", rubric.get("key_points")),
+        ("Acceptable variants", rubric.get("acceptable_variants")),
+        ("Common mistakes", rubric.get("common_mistakes")),
+    ]
+    lines = []
+    for title, items in sections:
+        if items:
+            lines.append(f"- {title}: " + "; ".join(str(i) for i in items))
+    return "\n".join(lines)
+
+def _parse_json_response(ai_response):
+    """Parse une réponse JSON de l'IA (en enlevant les balises markdown si présentes)"""
+    clean_response = ai_response.strip()
+    if clean_response.startswith("```json"):
+        clean_response = clean_response[7:]
+    elif clean_response.startswith("```"):
+        clean_response = clean_response[3:]
+    if clean_response.endswith("```"):
+        clean_response = clean_response[:-3]
+    return json.loads(clean_response.strip())
+
+def _get_provider_settings(config, probe=True):
+    """
+    Retourne (provider, model, api_key) pour la configuration courante ('auto' = meilleure route).
+    probe=False pour les appelants qui n'enregistrent pas le résultat de la route (pas de sonde réservée).
+    """
+    provider = config.get("provider", "openai")
+    if provider == "auto":
+        route = select_route(config, probe=probe)
+        if route:
+            return route
+        provider = "openai"
+    if provider not in PROVIDERS:
+        provider = "openai"
+    model = config.get(f"{provider}_model", PROVIDERS[provider]["models"][0])
+    keys = get_api_keys(config, provider)  # première clé; les appels répartissent sur toutes (call_with_key_pool)
+    return provider, model, keys[0] if keys else ""
+
+def _configured_routes(config):
+    """Toutes les routes (provider, model, api_key) ayant au moins une clé configurée (voir get_api_keys)"""
+    routes = []
+    for provider, info in PROVIDERS.items():
+        keys = get_api_keys(config, provider)
+        if keys:
+            routes.append((provider, config.get(f"{provider}_model", info["models"][0]), keys[0]))
+    return routes
+
+# Qualité relative estimée des modèles (0-1) pour le mode 'auto'; 0.5 pour les modèles inconnus
+MODEL_QUALITY = {
+    "gpt-4o": 0.9, "gpt-4-turbo": 0.85, "gpt-4": 0.8, "gpt-4o-mini": 0.65, "gpt-3.5-turbo": 0.5,
+    "gemini-1.5-pro": 0.85, "gemini-1.5-flash": 0.65, "gemini-1.0-pro": 0.5,
+    "claude-3-opus-20240229": 0.9, "claude-3-sonnet-20240229": 0.75, "claude-3-haiku-20240307": 0.6,
+    "deepseek-chat": 0.7, "deepseek-coder": 0.6,
+    "llama3-70b-8192": 0.7, "llama3-8b-8192": 0.45, "mixtral-8x7b-32768": 0.5, "gemma-7b-it": 0.35,
+}
+
+# Statistiques glissantes par route 'provider/model' (latence EWMA, erreurs, rétrogradation)
+route_stats = {}
+route_lock = threading.Lock()
+ROUTE_EWMA_ALPHA = 0.3
+ROUTE_WINDOW = 20
+
+def _route_entry(provider, model):
+    return route_stats.setdefault(f"{provider}/{model}", {
+        "ewma_ms": None,
+        "calls": 0,
+        "errors": 0,
+        "recent": deque(maxlen=ROUTE_WINDOW),  # True = succès
+        "consecutive_failures": 0,
+        "demoted_until": 0.0,
+        "probing": False,
+    })
+
+def select_route(config, probe=True):
+    """
+    Choisit la route la plus performante parmi les fournisseurs configurés, selon
+    auto_quality_weight (0 = latence seulement, 1 = qualité seulement).
+    Une route rétrogradée est re-testée (sonde) une fois son délai écoulé; l'appelant doit alors
+    appeler record_route_result ou release_route_probe. Avec probe=False, aucune sonde n'est réservée.
+    """
+    # Fournisseurs coupés par le disjoncteur exclus (ils reviennent une fois le délai écoulé)
+    configured = _configured_routes(config)
+    routes = [r for r in configured if not breaker_is_open(r[0], config)]
+    if not routes:
+        # Tous coupés: analyze_answer_with_ai renverra la comparaison locale
+        return configured[0] if configured else None
+    weight = float(config.get("auto_quality_weight", 0.3))
+    now = time.time()
+    with route_lock:
+        entries = [(route, _route_entry(route[0], route[1])) for route in routes]
+        # Routes actives, ou rétrogradées dont le délai est écoulé (sauf sonde déjà en cours)
+        available = [(r, e) for r, e in entries
+                     if e["demoted_until"] <= now and not e["probing"] and (probe or not e["demoted_until"])]
+        if not available:
+            # Tout est rétrogradé: prendre la route qui revient le plus tôt
+            route, entry = min(entries, key=lambda item: item[1]["demoted_until"])
+            return route
+
+        # Route rétrogradée dont le délai est écoulé: une seule requête de sonde
+        for route, entry in available:
+            if entry["demoted_until"] and not entry["probing"]:
+                entry["probing"] = True
+                print(f"Auto routing: probing {route[0]}/{route[1]}")
+                return route
+
+        known = [e["ewma_ms"] for _, e in available if e["ewma_ms"] is not None]
+        slowest = max(known) if known else 1.0
+
+        def cost(item):
+            route, entry = item
+            # Route jamais mesurée: latence optimiste pour l'explorer
+            latency = (entry["ewma_ms"] or 0.0) / slowest if slowest else 0.0
+            quality = MODEL_QUALITY.get(route[1], 0.5)
+            return (1 - weight) * latency + weight * (1 - quality)
+
+        route, _ = min(available, key=cost)
+        return route
+
+def release_route_probe(provider, model):
+    """Libère la sonde réservée par select_route si aucun résultat n'a été enregistré pour la route"""
+    with route_lock:
+        entry = route_stats.get(f"{provider}/{model}")
+        if entry:
+            entry["probing"] = False
+
+def record_route_result(provider, model, elapsed_ms, ok, config):
+    """Met à jour les statistiques de la route et la rétrograde si elle ne tient pas le SLA"""
+    with route_lock:
+        entry = _route_entry(provider, model)
+        entry["calls"] += 1
+        entry["recent"].append(ok)
+        if ok:
+            entry["consecutive_failures"] = 0
+            previous = entry["ewma_ms"]
+            entry["ewma_ms"] = elapsed_ms if previous is None else (
+                ROUTE_EWMA_ALPHA * elapsed_ms + (1 - ROUTE_EWMA_ALPHA) * previous)
+        else:
+            entry["errors"] += 1
+            entry["consecutive_failures"] += 1
+
+        was_probing = entry["probing"]
+        entry["probing"] = False
+        sla_ms = float(config.get("auto_latency_sla_ms", 10000))
+        recent = entry["recent"]
+        error_rate = recent.count(False) / len(recent) if recent else 0.0
+        failing = (
+            (not ok and was_probing)
+            or entry["consecutive_failures"] >= 3
+            or (len(recent) >= 4 and error_rate > float(config.get("auto_max_error_rate", 0.5)))
+            or (ok and elapsed_ms > sla_ms and entry["ewma_ms"] > sla_ms)
+        )
+        if failing:
+            entry["demoted_until"] = time.time() + float(config.get("auto_demote_seconds", 120))
+            if was_probing:
+                entry["consecutive_failures"] = 0
+            print(f"Auto routing: demoting {provider}/{model} (ewma {entry['ewma_ms']}, errors {error_rate:.0%})")
+        elif was_probing and ok:
+            entry["demoted_until"] = 0.0
+            entry["recent"].clear()
+            entry["recent"].append(True)
+            print(f"Auto routing: promoting {provider}/{model} again")
+
+def format_route_stats():
+    with route_lock:
+        items = sorted(route_stats.items())
+        now = time.time()
+        lines = []
+        for name, entry in items:
+            ewma = f"{entry['ewma_ms']:.0f} ms" if entry["ewma_ms"] is not None else "n/a"
+            state = " (demoted)" if entry["demoted_until"] > now else ""
+            lines.append(f"  {name}: {entry['calls']} calls, {entry['errors']} errors, ewma {ewma}{state}")
+    return lines
+
+# Disjoncteur par fournisseur: fermé -> ouvert après N échecs consécutifs -> semi-ouvert
+# (une seule requête de sonde) une fois le délai écoulé -> fermé si la sonde réussit
+breaker_state = {}  # provider -> {"state", "failures", "opened_at", "probing", "trips"}
+breaker_lock = threading.Lock()
+
+def _breaker_entry(provider):
+    return breaker_state.setdefault(provider, {
+        "state": "closed", "failures": 0, "opened_at": 0.0, "probing": False, "trips": 0,
+    })
+
+def breaker_is_open(provider, config):
+    """Vrai si le fournisseur est coupé et que son délai n'est pas écoulé"""
+    with breaker_lock:
+        entry = breaker_state.get(provider)
+        if not entry or entry["state"] == "closed":
+            return False
+        cooldown = float(config.get("breaker_cooldown_seconds", 60))
+        return entry["probing"] or time.time() - entry["opened_at"] < cooldown
+
+def breaker_allows(provider, config):
+    """
+    Autorise un appel au fournisseur. Après le délai, un seul appel passe (sonde semi-ouverte);
+    les autres continuent d'utiliser la comparaison locale jusqu'à son résultat.
+    """
+    with breaker_lock:
+        entry = _breaker_entry(provider)
+        if entry["state"] == "closed":
+            return True
+        cooldown = float(config.get("breaker_cooldown_seconds", 60))
+        if entry["probing"] or time.time() - entry["opened_at"] < cooldown:
+            return False
+        entry["state"] = "half_open"
+        entry["probing"] = True
+        print(f"Circuit breaker: probing {provider}")
+        return True
+
+def record_breaker_result(provider, ok, config):
+    """Met à jour le disjoncteur après un appel (réussi ou non) au fournisseur"""
+    with breaker_lock:
+        entry = _breaker_entry(provider)
+        was_probing = entry["probing"]
+        entry["probing"] = False
+        if ok:
+            if entry["state"] != "closed":
+                print(f"Circuit breaker: {provider} closed again")
+            entry["state"] = "closed"
+            entry["failures"] = 0
+            return
+        entry["failures"] += 1
+        threshold = int(config.get("breaker_failure_threshold", 3))
+        if was_probing or (entry["state"] == "closed" and entry["failures"] >= threshold):
+            if entry["state"] == "closed":
+                entry["trips"] += 1
+            entry["state"] = "open"
+            entry["opened_at"] = time.time()
+            print(f"Circuit breaker: {provider} open after {entry['failures']} failures")
+
+def format_breaker_stats():
+    with breaker_lock:
+        return [f"  {PROVIDERS.get(provider, {}).get('name', provider)}: {entry['state']}, opened {entry['trips']} times"
+                for provider, entry in sorted(breaker_state.items()) if entry["trips"]]
+
+def local_score(true_answer, user_answer, language="english", provisional=False, budget=False):
+    """
+    Note locale (sans LLM) par similarité du texte, utilisée quand le fournisseur est indisponible
+    ou le budget de tokens atteint (budget), ou comme estimation provisoire (provisional)
+    en attendant un résultat IA en retard; l'estimation provisoire, calculée pendant le rendu,
+    se limite au recouvrement des mots (linéaire)
+    """
+    def normalize(text):
+        return " ".join(extract_code_text(text or "").lower().split())[:5000]
+    if provisional:
+        # Rendu du verso (thread principal): recouvrement des mots en O(n), pas l'alignement quadratique
+        expected_words = Counter(normalize(true_answer).split())
+        provided_words = Counter(normalize(user_answer).split())
+        total = sum(expected_words.values()) + sum(provided_words.values())
+        ratio = 2 * sum((expected_words & provided_words).values()) / total if total else 1.0
+    else:
+        ratio = SequenceMatcher(None, normalize(true_answer), normalize(user_answer), autojunk=False).ratio()
+    score = int(round(ratio * 10))
+    suggestion = "Again" if score <= 3 else "Hard" if score <= 5 else "Good" if score <= 8 else "Easy"
+    texts = LANGUAGES.get(language, LANGUAGES["english"])
+    tips_key = "provisional_tips" if provisional else "budget_local_tips" if budget else "local_tips"
+    tips = texts[tips_key].format(percent=int(round(ratio * 100)))
+    result = {"score": score, "tips": tips, "review_suggestion": suggestion, "local": True, "provider": "local"}
+    if provisional:
+        result["provisional"] = True
+    return result
+
+# Notation par parties (plusieurs trous d'un cloze, réponses structurées sur plusieurs lignes):
+# chaque partie est notée et mise en cache séparément, puis les scores sont agrégés
+CLOZE_DELETION_RE = re.compile(r"\{\{c(\d+)::(.*?)(?:::[^{}]*?)?\}\}", re.DOTALL)
+
+def cloze_answers(field_text, ordinal):
+    """Réponses des trous c<ordinal> d'un champ cloze, dans l'ordre (sans indice ni HTML)"""
+    return [clean_html_content(answer).strip() for number, answer in CLOZE_DELETION_RE.findall(field_text or "")
+            if int(number) == ordinal]
+
+def split_answer_parts(true_answer, user_answer, cloze_parts=None, lines=False, max_parts=8):
+    """
+    Parties alignées [(attendu, saisi), ...] de la réponse, ou None pour la noter d'un bloc.
+    Cloze: cloze_parts sont les réponses des trous de la carte (voir cloze_answers); la saisie est
+    découpée sur ", " comme Anki joint les trous. Un trou contenant lui-même ", " change le nombre
+    de parties: la réponse est alors notée d'un bloc.
+    Lignes (option lines): une partie par ligne, seulement si la saisie a exactement autant de lignes
+    non vides que l'attendu (non indenté, pas du code): une ligne fusionnée ou oubliée décalerait
+    toutes les suivantes, la réponse est alors notée d'un bloc.
+    """
+    if cloze_parts:
+        expected = list(cloze_parts)
+        provided = [part.strip() for part in (user_answer or "").split(", ")]
+    elif lines:
+        if "<pre" in (true_answer or "").lower():
+            return None
+        expected_lines = [line for line in extract_code_text(true_answer).split("\n") if line.strip()]
+        if any(line[:1].isspace() for line in expected_lines):
+            return None
+        expected = [line.strip() for line in expected_lines]
+        provided = [line.strip() for line in extract_code_text(user_answer).split("\n") if line.strip()]
+    else:
+        return None
+    if len(expected) < 2 or len(provided) != len(expected) or len(expected) > max_parts:
+        return None
+    return list(zip(expected, provided))
+
+def part_question(question_text, index, count):
+    """Question envoyée pour une partie: le contexte complet et le numéro de la partie notée"""
+    return f"{question_text}\n(Part {index + 1} of {count})"
+
+def aggregate_part_results(parts, results):
+    """
+    Résultat unique à partir des notes des parties: score moyen, suggestion = moyenne des
+    boutons arrondie vers le bas, conseil de la partie la plus faible; le détail est dans "parts".
+    Un résultat local ou en erreur dans une partie rend l'ensemble local (jamais appliqué ni historisé).
+    """
+    scores = [result.get("score", 5) for result in results]
+    eases = [SUGGESTION_TO_EASE.get(result.get("review_suggestion"), 3) for result in results]
+    ease = int(sum(eases) / len(eases))
+    weakest = min(range(len(results)), key=lambda i: scores[i])
+    aggregated = {
+        "score": int(round(sum(scores) / len(scores))),
+        "tips": results[weakest].get("tips", ""),
+        "review_suggestion": next(name for name, value in SUGGESTION_TO_EASE.items() if value == ease),
+        "parts": [
+            {"expected": expected, "provided": provided, "score": result.get("score"), "tips": result.get("tips", "")}
+            for (expected, provided), result in zip(parts, results)
+        ],
+    }
+    tokens = sum(result.get("tokens", 0) for result in results)
+    if tokens:
+        aggregated["tokens"] = tokens
+    graded = [result for result in results if not (result.get("error") or result.get("local"))]
+    if graded:
+        aggregated["provider"] = graded[0].get("provider")
+        aggregated["model"] = graded[0].get("model")
+    if len(graded) < len(results):
+        if all(result.get("error") for result in results):
+            aggregated["error"] = True
+        else:
+            aggregated["local"] = True
+            aggregated["provider"] = "local"
+    return aggregated
+
+def build_grading_messages(question_text, true_answer, user_answer, rubric, config):
+    """Messages système et utilisateur de l'analyse d'une réponse (appel direct ou lot)"""
+    language = config.get("language", "english")
+    # **MODIFIÉ: Utiliser le prompt avec contexte de question selon la langue configurée**
+    prompt = get_language_specific_prompt(language, question_text, true_answer, user_answer,
+                                          rubric=rubric, trim_chars=config.get("rubric_trim_chars", 300),
+                                          diff=_prompt_diff(true_answer, user_answer, config))
+    
+    # Message système selon la langue
+    system_messages = {
+        "english": "You are an educational assistant that evaluates student responses constructively and kindly. Use the question context to provide more accurate and relevant feedback.",
+        "french": "Vous êtes un assistant pédagogique qui évalue les réponses des étudiants de manière constructive et bienveillante. Utilisez le contexte de la question pour fournir des commentaires plus précis et pertinents.",
+        "spanish": "Eres un asistente educativo que evalúa las respuestas de los estudiantes de manera constructiva y amable. Usa el contexto de la pregunta para proporcionar comentarios más precisos y relevantes.",
+        "german": "Sie sind ein pädagogischer Assistent, der die Antworten der Studenten konstruktiv und freundlich bewertet. Nutzen Sie den Fragenkontext, um genauere und relevantere Rückmeldungen zu geben."
+    }
+    
+    system_message = system_messages.get(language, system_messages["english"])
+
+    messages = [
+        {"role": "system", "content": system_message},
+        {"role": "user", "content": prompt}
+    ]
+    return messages
+
+def analyze_answer_with_ai(question_text: str, true_answer: str, user_answer: str, rubric=None, config=None) -> dict:
+    """
+    **MODIFIÉ: Analyse la réponse de l'utilisateur avec l'IA en incluant le contexte de la question**
+    Retourne un dictionnaire avec le score, les conseils et la suggestion de révision
+    """
+    config = resolve_config(config)
+    
+    if not config.get("enabled", True):
+        return {"score": 5, "tips": "IA désactivée", "review_suggestion": "Good"}
+    
+    language = config.get("language", "english")
+
+    # Budget de tokens: modèle rapide seul à l'approche, puis note locale ou cache seul une fois atteint.
+    # Vérifié avant le choix de la route et le disjoncteur, qui peuvent réserver une requête de sonde.
+    level = budget_level(config)
+    if level == "exhausted":
+        _bump_stat("budget_skips")
+        if config.get("budget_exhausted_mode", "local") == "cache_only":
+            texts = LANGUAGES.get(language, LANGUAGES["english"])
+            return {"score": 5, "tips": texts["budget_cache_only"], "review_suggestion": "Good", "error": True, "budget": True}
+        return local_score(true_answer, user_answer, language, budget=True)
+
+    provider, model, api_key = _get_provider_settings(config)
+    route_model = model
+
+    if not api_key:
+        return {"score": 5, "tips": f"Clé API {PROVIDERS[provider]['name']} non configurée", "review_suggestion": "Good", "error": True}
+
+    # Fournisseur en panne (disjoncteur ouvert): résultat local immédiat au lieu d'attendre un timeout
+    if not breaker_allows(provider, config):
+        release_route_probe(provider, route_model)
+        _bump_stat("local_fallbacks")
+        return local_score(true_answer, user_answer, language)
+
+    if level == "cheap":
+        _bump_stat("budget_downgrades")
+        model = config.get("cascade_fast_model") or CASCADE_FAST_MODELS.get(provider, model)
+        config = dict(config, cascade_enabled=False)
+
+    messages = build_grading_messages(question_text, true_answer, user_answer, rubric, config)
+    usage_local.tokens = [0, 0]  # tokens de cette analyse, ajoutés au résultat par _grade_with_model
+
+    # Échéance de bout en bout (cascade et changements de clé compris)
+    deadline = time.monotonic() + float(config.get("analysis_deadline_ms", 30000)) / 1000
+
+    try:
+        # Cascade: modèle rapide d'abord, modèle configuré seulement si le score est ambigu
+        fast_model = _cascade_fast_model(config, provider, model)
+        if fast_model:
+            try:
+                result = _grade_with_model(messages, provider, fast_model, api_key, config, tier="fast", deadline=deadline)
+                if not _needs_escalation(result, config):
+                    return result
+                print(f"Cascade: escalating from {fast_model} (score {result.get('score')}, unparsed={bool(result.get('unparsed'))})")
+            except Exception as e:
+                print(f"Cascade: fast model {fast_model} failed, escalating: {e}")
+            _bump_stat("escalations")
+
+        return _grade_with_model(messages, provider, model, api_key, config, tier="strong", deadline=deadline)
+        
+    except Exception as e:
+        print(f"AI Analysis Error: {str(e)}")  # Pour debugging
+        # Note locale seulement pour une panne passagère; une erreur de clé, de modèle ou de quota est affichée
+        if isinstance(e, (TransientAPIError, TimeoutError)) or breaker_is_open(provider, config):
+            _bump_stat("local_fallbacks")
+            return local_score(true_answer, user_answer, language)
+        return {"score": 5, "tips": f"Erreur d'analyse {PROVIDERS[provider]['name']}: {str(e)}", "review_suggestion": "Good", "error": True}
+    finally:
+        # Modèle rapide ou réduit seul: la route choisie n'a pas de résultat propre
+        release_route_probe(provider, route_model)
+
+def parse_ai_analysis(ai_response):
+    """Transforme la réponse brute de l'IA en dict score / tips / review_suggestion"""
+    # Tenter de parser la réponse JSON
+    try:
+        result = _parse_json_response(ai_response)
+        # Valider les champs requis
+        if all(key in result for key in ["score", "tips", "review_suggestion"]):
+            # Valider le score
+            result["score"] = max(0, min(10, int(result["score"])))
+            # Valider la suggestion de révision
+            if result["review_suggestion"] not in ["Again", "Hard", "Good", "Easy"]:
+                result["review_suggestion"] = "Good"
+            return result
+    except (json.JSONDecodeError, ValueError, KeyError, TypeError):
+        pass
+    
+    # Si le parsing JSON échoue, essayer d'extraire les informations
+    lines = ai_response.split('\n')
+    score = 5
+    tips = "Analyse disponible dans la réponse complète"
+    review_suggestion = "Good"
+    
+    for line in lines:
+        if 'score' in line.lower():
+            try:
+                score_match = re.search(r'(\d+)', line)
+                if score_match:
+                    score = max(0, min(10, int(score_match.group(1))))
+            except:
+                pass
+    
+    return {"score": score, "tips": ai_response[:300] + "...", "review_suggestion": review_suggestion, "unparsed": True}
+
+# Modèle rapide par défaut de chaque fournisseur pour la cascade
+CASCADE_FAST_MODELS = {
+    "openai": "gpt-4o-mini",
+    "gemini": "gemini-1.5-flash",
+    "claude": "claude-3-haiku-20240307",
+    "deepseek": "deepseek-chat",
+    "groq": "llama3-8b-8192",
+    "openrouter": "openai/gpt-4o-mini-2024-07-18",
+}
+
+# Statistiques d'analyse (latence par niveau de cascade, escalades)
+analysis_stats = {
+    "tiers": {},  # tier -> {"count", "total_ms", "max_ms", "errors"} (count: appels réussis)
+    "escalations": 0,
+    "analyses": 0,
+    "local_fallbacks": 0,
+    "packed_requests": 0,  # notation groupée (grade_bulk)
+    "packed_items": 0,
+    "packed_retries": 0,
+    "budget_downgrades": 0,  # analyses passées au modèle rapide (budget de tokens proche)
+    "budget_skips": 0,  # analyses non envoyées (budget atteint)
+}
+stats_lock = threading.Lock()
+
+def _bump_stat(name, amount=1):
+    with stats_lock:
+        analysis_stats[name] = analysis_stats.get(name, 0) + amount
+
+def _tier_entry(tier):
+    return analysis_stats["tiers"].setdefault(tier, {"count": 0, "total_ms": 0.0, "max_ms": 0.0, "errors": 0})
+
+def _record_tier_latency(tier, elapsed_ms):
+    with stats_lock:
+        entry = _tier_entry(tier)
+        entry["count"] += 1
+        entry["total_ms"] += elapsed_ms
+        entry["max_ms"] = max(entry["max_ms"], elapsed_ms)
+
+def _record_tier_error(tier):
+    """Appel en échec: compté dans les tentatives du niveau (taux d'escalade), pas dans la latence"""
+    with stats_lock:
+        _tier_entry(tier)["errors"] += 1
+
+def _cascade_fast_model(config, provider, model):
+    """Modèle rapide à essayer d'abord, ou None si la cascade est inactive ou inutile"""
+    if not config.get("cascade_enabled", False):
+        return None
+    fast_model = config.get("cascade_fast_model") or CASCADE_FAST_MODELS.get(provider)
+    if not fast_model or fast_model == model:
+        return None
+    return fast_model
+
+def _needs_escalation(result, config):
+    """Escalade si la réponse n'a pas pu être parsée ou si le score est dans la bande ambiguë"""
+    if result.get("unparsed") or result.get("error"):
+        return True
+    low, high = config.get("cascade_ambiguous_band", DEFAULT_CONFIG["cascade_ambiguous_band"])
+    return low <= result.get("score", 5) <= high
+
+def _grade_with_model(messages, provider, model, api_key, config, tier, deadline=None):
+    """Appelle un modèle, parse sa réponse et enregistre la latence du niveau"""
+    start = time.perf_counter()
+    try:
+        ai_response = call_with_key_pool(
+            messages=messages,
+            provider=provider,
+            model=model,
+            config=config,
+            max_tokens=config.get("max_tokens", 200),
+            temperature=config.get("temperature", 0.7),
+            deadline=deadline
+        )
+    except Exception:
+        record_route_result(provider, model, (time.perf_counter() - start) * 1000, False, config)
+        record_breaker_result(provider, False, config)
+        _record_tier_error(tier)
+        raise
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    record_route_result(provider, model, elapsed_ms, True, config)
+    record_breaker_result(provider, True, config)
+    _record_tier_latency(tier, elapsed_ms)
+    _bump_stat("analyses")
+    result = parse_ai_analysis(ai_response)
+    result["provider"] = provider
+    result["model"] = model
+    result["tier"] = tier
+    result.update(_usage_so_far())
+    return result
+
+def format_stats(config=None):
+    """Résumé texte des statistiques de la session (config: budgets de tokens affichés)"""
+    with stats_lock:
+        tiers = {k: dict(v) for k, v in analysis_stats["tiers"].items()}
+        escalations = analysis_stats["escalations"]
+        analyses = analysis_stats["analyses"]
+    lines = [f"Model calls: {analyses}"]
+    for tier, entry in sorted(tiers.items()):
+        avg = entry["total_ms"] / entry["count"] if entry["count"] else 0
+        failed = f", {entry['errors']} failed" if entry.get("errors") else ""
+        lines.append(f"  {tier}: {entry['count']} calls{failed}, avg {avg:.0f} ms, max {entry['max_ms']:.0f} ms")
+    # Taux d'escalade sur les tentatives du modèle rapide (un échec escalade aussi)
+    fast = tiers.get("fast", {})
+    fast_attempts = fast.get("count", 0) + fast.get("errors", 0)
+    if fast_attempts:
+        lines.append(f"Cascade escalations: {escalations}/{fast_attempts} ({100.0 * escalations / fast_attempts:.0f}%)")
+    key_lines = format_key_stats()
+    if key_lines:
+        lines.append("API keys:")
+        lines.extend(key_lines)
+    route_lines = format_route_stats()
+    if route_lines:
+        lines.append("Routes:")
+        lines.extend(route_lines)
+    with stats_lock:
+        local_fallbacks = analysis_stats["local_fallbacks"]
+    if local_fallbacks:
+        lines.append(f"Local fallbacks (provider unavailable): {local_fallbacks}")
+    with stats_lock:
+        packed = {k: analysis_stats[k] for k in ("packed_requests", "packed_items", "packed_retries")}
+    if packed["packed_requests"]:
+        lines.append(f"Packed grading: {packed['packed_items']} items in {packed['packed_requests']} requests,"
+                     f" {packed['packed_retries']} retried alone")
+    lines.extend(format_usage_stats(config))
+    with stats_lock:
+        budget = {k: analysis_stats[k] for k in ("budget_downgrades", "budget_skips")}
+    if budget["budget_downgrades"] or budget["budget_skips"]:
+        lines.append(f"Token budget: {budget['budget_downgrades']} analyses on the cheaper model,"
+                     f" {budget['budget_skips']} not sent")
+    breaker_lines = format_breaker_stats()
+    if breaker_lines:
+        lines.append("Circuit breakers:")
+        lines.extend(breaker_lines)
+    return "\n".join(lines)
+
+
+# Cache persistant des analyses (table SQLite partagée par l'add-on, le démon et l'export),
+# indexé par une empreinte stable de la question, des réponses, de la grille et de la langue
+ANALYSIS_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS analysis_cache (
+    digest TEXT PRIMARY KEY,
+    result TEXT NOT NULL,
+    model TEXT,
+    ts REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+def analysis_digest(question_text, true_answer, user_answer, rubric=None, language="english", model=None):
+    """
+    Empreinte sha256 stable (contrairement à hash()) d'une analyse, partageable entre machines.
+    model: modèle configuré (voir analysis_model_tag), pour ne pas resservir les notes d'un autre modèle.
+    """
+    payload = json.dumps([question_text or "", true_answer or "", user_answer or "", rubric, language, model],
+                         ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def analysis_model_tag(config):
+    """Fournisseur/modèle configuré pour l'empreinte ('auto' si le routage choisit le modèle)"""
+    if config.get("provider", "openai") == "auto":
+        return "auto"
+    provider, model, _ = _get_provider_settings(config, probe=False)
+    return f"{provider}/{model}"
+
+def is_cacheable(result):
+    """Seuls les vrais résultats IA sont réutilisés (pas les erreurs, réponses non parsées ou notes locales)"""
+    return bool(result) and not (result.get("error") or result.get("unparsed") or result.get("local"))
+
+def cache_lookup(conn, digest):
+    """Résultat en cache pour l'empreinte, ou None"""
+    row = conn.execute("SELECT result FROM analysis_cache WHERE digest = ?", (digest,)).fetchone()
+    if not row:
+        return None
+    with conn:
+        conn.execute("UPDATE analysis_cache SET hits = hits + 1 WHERE digest = ?", (digest,))
+    return json.loads(row[0])
+
+USAGE_FIELDS = ("input_tokens", "output_tokens", "tokens")
+
+def cache_store(conn, digest, result):
+    """Enregistre un résultat réutilisable (sans ses tokens: une réutilisation ne consomme rien)"""
+    if not is_cacheable(result):
+        return
+    result = {key: value for key, value in result.items() if key not in USAGE_FIELDS}
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO analysis_cache (digest, result, model, ts, hits)"
+            " VALUES (?, ?, ?, ?, COALESCE((SELECT hits FROM analysis_cache WHERE digest = ?), 0))",
+            (digest, json.dumps(result, ensure_ascii=False), result.get("model"), time.time(), digest),
+        )
+
+# Export / import du cache d'analyses (partage d'un cache pré-rempli avec un paquet commun):
+# JSON lines compressé (gzip), une ligne d'en-tête versionnée puis une entrée par analyse
+CACHE_EXPORT_FORMAT = "aki-analysis-cache"
+CACHE_EXPORT_VERSION = 1
+
+def export_analysis_cache(conn, path, lock=None):
+    """
+    Écrit tout le cache dans `path` (sans les compteurs d'usage locaux); retourne le nombre d'entrées.
+    lock: verrou de la connexion, tenu seulement pendant la lecture (pas pendant l'écriture du fichier).
+    """
+    import contextlib
+    import gzip
+    with lock or contextlib.nullcontext():
+        rows = conn.execute("SELECT digest, result, model, ts FROM analysis_cache ORDER BY digest").fetchall()
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        f.write(json.dumps({"format": CACHE_EXPORT_FORMAT, "version": CACHE_EXPORT_VERSION,
+                            "exported": time.time(), "count": len(rows)}) + "\n")
+        for digest, result, model, ts in rows:
+            f.write(json.dumps({"d": digest, "r": json.loads(result), "m": model, "t": ts},
+                               ensure_ascii=False, separators=(",", ":")) + "\n")
+    return len(rows)
+
+def _valid_cache_entry(entry):
+    result = entry.get("r")
+    digest = entry.get("d")
+    return (isinstance(digest, str) and re.fullmatch(r"[0-9a-f]{64}", digest) is not None
+            and isinstance(result, dict) and is_cacheable(result)
+            and isinstance(result.get("score"), int) and 0 <= result["score"] <= 10
+            and isinstance(result.get("tips"), str)
+            and result.get("review_suggestion") in SUGGESTION_TO_EASE
+            and isinstance(entry.get("t"), (int, float)))
+
+def _prefer_incoming(existing_model, existing_ts, model, ts):
+    """Règle de fusion: le modèle de meilleure qualité l'emporte, puis l'analyse la plus récente"""
+    existing_quality = MODEL_QUALITY.get(existing_model, 0.5)
+    quality = MODEL_QUALITY.get(model, 0.5)
+    if quality != existing_quality:
+        return quality > existing_quality
+    return ts > existing_ts
+
+CACHE_IMPORT_CHUNK = 500  # entrées fusionnées par transaction
+
+def import_analysis_cache(conn, path, lock=None):
+    """
+    Fusionne un export dans le cache. Entrées invalides ignorées; en cas de conflit (même empreinte),
+    voir _prefer_incoming. Les compteurs d'usage locaux sont conservés.
+    lock: verrou de la connexion, pris par paquet de CACHE_IMPORT_CHUNK entrées (une transaction
+    chacun) et relâché entre deux, pour ne pas bloquer les autres utilisateurs pendant tout l'import.
+    Retourne {"added", "replaced", "kept", "skipped"}.
+    """
+    import contextlib
+    import gzip
+    counts = {"added": 0, "replaced": 0, "kept": 0, "skipped": 0}
+    lock = lock or contextlib.nullcontext()
+
+    def merge(chunk):
+        with lock, conn:
+            for digest, result, model, ts in chunk:
+                row = conn.execute("SELECT model, ts FROM analysis_cache WHERE digest = ?", (digest,)).fetchone()
+                if row and not _prefer_incoming(row[0], row[1], model, ts):
+                    counts["kept"] += 1
+                    continue
+                conn.execute(
+                    "INSERT OR REPLACE INTO analysis_cache (digest, result, model, ts, hits)"
+                    " VALUES (?, ?, ?, ?, COALESCE((SELECT hits FROM analysis_cache WHERE digest = ?), 0))",
+                    (digest, json.dumps(result, ensure_ascii=False), model, ts, digest),
+                )
+                counts["replaced" if row else "added"] += 1
+
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        header = json.loads(f.readline() or "{}")
+        if header.get("format") != CACHE_EXPORT_FORMAT:
+            raise Exception("Fichier de cache d'analyses invalide")
+        if header.get("version", 0) > CACHE_EXPORT_VERSION:
+            raise Exception(f"Version de cache {header.get('version')} non supportée (mettez l'add-on à jour)")
+        # Lecture et validation hors du verrou
+        chunk = []
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                counts["skipped"] += 1
+                continue
+            if not isinstance(entry, dict) or not _valid_cache_entry(entry):
+                counts["skipped"] += 1
+                continue
+            chunk.append((entry["d"], entry["r"], entry.get("m"), float(entry["t"])))
+            if len(chunk) >= CACHE_IMPORT_CHUNK:
+                merge(chunk)
+                chunk = []
+        if chunk:
+            merge(chunk)
+    return counts
+
+# Historique des analyses (user_files/history.sqlite3 de l'add-on) avec agrégats par carte maintenus à l'insertion
+HISTORY_TREND_WINDOW = 5
+
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS analyses (
+    id INTEGER PRIMARY KEY,
+    card_id INTEGER NOT NULL,
+    note_id INTEGER,
+    deck_id INTEGER,
+    ts REAL NOT NULL,
+    score INTEGER,
+    suggestion TEXT,
+    provider TEXT,
+    model TEXT,
+    latency_ms REAL,
+    tokens INTEGER,
+    anki_ease INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_analyses_card ON analyses(card_id, ts);
+CREATE INDEX IF NOT EXISTS idx_analyses_deck ON analyses(deck_id, ts);
+CREATE TABLE IF NOT EXISTS card_stats (
+    card_id INTEGER PRIMARY KEY,
+    note_id INTEGER,
+    deck_id INTEGER,
+    n INTEGER NOT NULL,
+    rolling_mean REAL,
+    last_scores TEXT,
+    trend REAL,
+    last_suggestion TEXT,
+    last_ease INTEGER,
+    disagree INTEGER NOT NULL DEFAULT 0,
+    last_ts REAL
+);
+CREATE INDEX IF NOT EXISTS idx_card_stats_weak ON card_stats(deck_id, rolling_mean);
+CREATE INDEX IF NOT EXISTS idx_card_stats_disagree ON card_stats(deck_id, disagree);
+"""
+
+def history_insert(conn, card_id, note_id, deck_id, result, latency_ms, ts=None):
+    """Ajoute une analyse à l'historique et met à jour les agrégats de la carte; retourne l'id de la ligne"""
+    score = result.get("score")
+    suggestion = result.get("review_suggestion")
+    now = ts or time.time()
+    with conn:
+        analysis_id = conn.execute(
+            "INSERT INTO analyses (card_id, note_id, deck_id, ts, score, suggestion, provider, model, latency_ms, tokens)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (card_id, note_id, deck_id, now, score, suggestion, result.get("provider"), result.get("model"),
+             latency_ms, result.get("tokens")),
+        ).lastrowid
+        row = conn.execute("SELECT n, last_scores FROM card_stats WHERE card_id = ?", (card_id,)).fetchone()
+        n = (row[0] if row else 0) + 1
+        last_scores = (json.loads(row[1]) if row and row[1] else []) + [score]
+        last_scores = last_scores[-HISTORY_TREND_WINDOW:]
+        rolling_mean = sum(last_scores) / len(last_scores)
+        trend = last_scores[-1] - last_scores[0] if len(last_scores) > 1 else 0
+        conn.execute(
+            "INSERT INTO card_stats (card_id, note_id, deck_id, n, rolling_mean, last_scores, trend, last_suggestion, last_ts)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+            " ON CONFLICT(card_id) DO UPDATE SET note_id = excluded.note_id, deck_id = excluded.deck_id,"
+            " n = excluded.n, rolling_mean = excluded.rolling_mean, last_scores = excluded.last_scores,"
+            " trend = excluded.trend, last_suggestion = excluded.last_suggestion, last_ts = excluded.last_ts",
+            (card_id, note_id, deck_id, n, rolling_mean, json.dumps(last_scores), trend, suggestion, now),
+        )
+    return analysis_id
+
+# Client du démon de notation partagé (daemon.py)
+def analyze_via_daemon(daemon_url, question_text, true_answer, user_answer, rubric=None, language="english",
+                       token="", timeout=30, budget="ok"):
+    """
+    Demande l'analyse au démon; lève une exception si le démon est injoignable ou en erreur.
+    budget: état du budget de tokens du client ("cheap": le démon n'utilise que le modèle rapide).
+    """
+    body = json.dumps({
+        "question_text": question_text, "true_answer": true_answer, "user_answer": user_answer,
+        "rubric": rubric, "language": language, "budget": budget,
+    }).encode("utf-8")
+    headers = {"Content-Type": "application/json"}
+    if token:
+        headers["X-AKI-Token"] = token
+    data = http_post(daemon_url.rstrip("/") + "/analyze", body, headers, timeout=timeout)
+    return json.loads(data.decode("utf-8"))
+
+# Notation groupée (re-notation, réponses importées): K éléments par requête au lieu d'une
+# requête par réponse, pour amortir l'en-tête du prompt et le coût fixe de chaque appel
+PACKED_PROMPT = """
+Grade each student answer below against the expected answer (0-10), using the question for context.
+Write the tips in {language}: one or two short, constructive sentences per item.
+
+Items (JSON):
+{items}
+
+Respond only with a JSON array containing exactly one object per item, with the same "id":
+[
+    {{"id": "...", "score": 0, "tips": "...", "review_suggestion": "Again|Hard|Good|Easy"}}
+]
+"""
+
+def estimate_tokens(text):
+    """Estimation grossière (≈ 4 caractères par token), suffisante pour dimensionner les paquets"""
+    return len(text) // 4 + 1
+
+def _packed_item(item, trim_chars):
+    """Élément compact pour le prompt groupé (question et réponse attendue raccourcies si une grille existe)"""
+    rubric = item.get("rubric")
+    question = item.get("question_text", "")
+    expected = item.get("true_answer", "")
+    if rubric:
+        question = _trim_for_prompt(question, trim_chars)
+        expected = _trim_for_prompt(expected, trim_chars)
+    entry = {"id": str(item["id"]), "question": question, "expected": expected, "answer": item.get("user_answer", "")}
+    if rubric:
+        entry["rubric"] = format_rubric(rubric)
+    return json.dumps(entry, ensure_ascii=False)
+
+def build_packed_messages(items, config):
+    language = LANGUAGES.get(config.get("language", "english"), LANGUAGES["english"])["name"]
+    trim_chars = config.get("rubric_trim_chars", 300)
+    lines = "\n".join(_packed_item(item, trim_chars) for item in items)
+    return [
+        {"role": "system", "content": "You are an educational assistant that evaluates student responses constructively and kindly."},
+        {"role": "user", "content": PACKED_PROMPT.format(language=language, items=lines)},
+    ]
+
+def _iter_json_objects(text):
+    """Objets JSON complets d'un texte, même si le tableau est tronqué (max_tokens atteint)"""
+    decoder = json.JSONDecoder()
+    pos = text.find("{")
+    while pos != -1:
+        try:
+            obj, end = decoder.raw_decode(text, pos)
+        except ValueError:
+            pos = text.find("{", pos + 1)
+            continue
+        yield obj
+        pos = text.find("{", end)
+
+def parse_packed_response(ai_response, ids):
+    """Résultats valides par id; les éléments absents, en double ou invalides sont omis (à refaire seuls)"""
+    results = {}
+    for entry in _iter_json_objects(ai_response):
+        if not isinstance(entry, dict):
+            continue
+        item_id = str(entry.get("id"))
+        if item_id not in ids or item_id in results:
+            continue
+        try:
+            score = int(entry["score"])
+        except (KeyError, TypeError, ValueError):
+            continue
+        tips = entry.get("tips")
+        suggestion = entry.get("review_suggestion")
+        if not 0 <= score <= 10 or not isinstance(tips, str) or not tips.strip() or suggestion not in SUGGESTION_TO_EASE:
+            continue
+        results[item_id] = {"score": score, "tips": tips, "review_suggestion": suggestion}
+    return results
+
+def grade_packed(items, config, route=None):
+    """
+    Note plusieurs éléments en une requête; retourne ({id: résultat}, latence en ms).
+    route: (provider, model, api_key) déjà choisie par l'appelant (sinon choisie ici).
+    """
+    provider, model, _ = route or _get_provider_settings(config)
+    route_model = model
+    if budget_level(config) == "cheap":
+        model = config.get("cascade_fast_model") or CASCADE_FAST_MODELS.get(provider, model)
+    per_item = int(config.get("bulk_tokens_per_item", 120))
+    start = time.perf_counter()
+    try:
+        ai_response = call_with_key_pool(
+            messages=build_packed_messages(items, config),
+            provider=provider,
+            model=model,
+            config=config,
+            max_tokens=per_item * len(items) + 50,
+            temperature=config.get("temperature", 0.7),
+        )
+    except Exception:
+        record_route_result(provider, model, (time.perf_counter() - start) * 1000, False, config)
+        record_breaker_result(provider, False, config)
+        raise
+    finally:
+        release_route_probe(provider, route_model)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    record_route_result(provider, model, elapsed_ms, True, config)
+    record_breaker_result(provider, True, config)
+    _record_tier_latency("packed", elapsed_ms)
+    results = parse_packed_response(ai_response, {str(item["id"]) for item in items})
+    for result in results.values():
+        result.update(provider=provider, model=model, tier="packed")
+    _bump_stat("packed_requests")
+    _bump_stat("packed_items", len(results))
+    return results, elapsed_ms
+
+def plan_pack(items, start, size, config):
+    """Nombre d'éléments du prochain paquet: au plus `size`, dans le budget de tokens d'entrée et de sortie"""
+    per_item = int(config.get("bulk_tokens_per_item", 120))
+    size = min(size, max(1, int(config.get("bulk_max_output_tokens", 4000)) // per_item))
+    budget = int(config.get("bulk_max_prompt_tokens", 6000))
+    trim_chars = config.get("rubric_trim_chars", 300)
+    used = estimate_tokens(PACKED_PROMPT)
+    count = 0
+    for item in items[start:start + size]:
+        used += estimate_tokens(_packed_item(item, trim_chars))
+        if count and used > budget:
+            break
+        count += 1
+    return count
+
+def adapt_pack_size(size, count, valid, elapsed_ms, config):
+    """
+    K suivant d'après le dernier paquet: la latence observée par élément donne le K qui tient
+    dans bulk_target_latency_ms (au plus le double du K courant); trop d'éléments invalides le divise par deux.
+    """
+    limit = max(1, int(config.get("bulk_max_pack_size", 32)))
+    if valid < count * 0.8:
+        return max(1, size // 2)
+    per_item_ms = elapsed_ms / max(1, count)
+    fits = int(float(config.get("bulk_target_latency_ms", 15000)) / max(per_item_ms, 1.0))
+    return max(1, min(limit, size * 2, fits))
+
+def grade_bulk(items, config=None, on_result=None):
+    """
+    Notation non interactive d'une liste d'éléments {"id", "question_text", "true_answer", "user_answer", "rubric"}.
+    Les éléments sont envoyés par paquets de taille adaptative; ceux qui manquent ou sont invalides
+    dans la réponse groupée (et tout le paquet si la requête échoue) sont refaits un par un.
+    on_result(item, result) est appelé pour chaque élément dès qu'il est noté. Retourne {id: résultat}.
+    """
+    config = resolve_config(config)
+    size = max(1, int(config.get("bulk_pack_size", 8)))
+    results = {}
+    start = 0
+    while start < len(items):
+        count = plan_pack(items, start, size, config)
+        pack = items[start:start + count]
+        start += count
+        graded = {}
+        # Route choisie par paquet et transmise à grade_packed, qui en enregistre le résultat
+        route = _get_provider_settings(config) if count > 1 and budget_level(config) != "exhausted" else None
+        if route and route[2] and breaker_allows(route[0], config):
+            try:
+                graded, elapsed_ms = grade_packed(pack, config, route)
+                size = adapt_pack_size(size, count, len(graded), elapsed_ms, config)
+            except Exception as e:
+                print(f"Bulk: packed request of {count} items failed: {e}")
+                size = max(1, size // 2)
+        elif route:
+            release_route_probe(route[0], route[1])
+        for item in pack:
+            item_id = str(item["id"])
+            result = graded.get(item_id)
+            if result is None:
+                if count > 1:
+                    _bump_stat("packed_retries")
+                result = analyze_answer_with_ai(item.get("question_text", ""), item.get("true_answer", ""),
+                                                item.get("user_answer", ""), rubric=item.get("rubric"), config=config)
+            results[item_id] = result
+            if on_result:
+                on_result(item, result)
+    return results
+
+# Lots asynchrones des fournisseurs (OpenAI Batch API, Anthropic Message Batches): moins chers et
+# hors des limites interactives, pour les re-notations de nuit. custom_id = empreinte de l'analyse,
+# ce qui relie directement chaque résultat au cache d'analyses.
+BATCH_BASE_URLS = {
+    "openai": "https://api.openai.com/v1",
+    "claude": "https://api.anthropic.com/v1",
+}
+BATCH_FINAL_STATUSES = {"completed", "failed", "expired", "cancelled", "ended"}
+
+def _batch_endpoint(provider, config):
+    """URL de base des lots (batch_base_url pour un proxy compatible) et en-têtes authentifiés"""
+    if provider not in BATCH_BASE_URLS:
+        raise Exception(f"Lots non supportés par {PROVIDERS[provider]['name']}")
+    keys = get_api_keys(config, provider)
+    if not keys:
+        raise Exception(f"Clé API {PROVIDERS[provider]['name']} non configurée")
+    base = (config.get("batch_base_url") or BATCH_BASE_URLS[provider]).rstrip("/")
+    return base, PROVIDERS[provider]["headers_func"](keys[0])
+
+def build_batch_requests(items, config):
+    """Une requête de lot par analyse distincte, au format du fournisseur configuré"""
+    provider, model, _ = _get_provider_settings(config, probe=False)
+    language = config.get("language", "english")
+    requests = []
+    seen = set()
+    for item in items:
+        args = (item.get("question_text", ""), item.get("true_answer", ""), item.get("user_answer", ""))
+        digest = analysis_digest(*args, item.get("rubric"), language, analysis_model_tag(config))
+        if digest in seen:
+            continue
+        seen.add(digest)
+        messages = build_grading_messages(*args, item.get("rubric"), config)
+        body = build_request_body(messages, provider, model, config.get("max_tokens", 200), config.get("temperature", 0.7))
+        if provider == "openai":
+            requests.append({"custom_id": digest, "method": "POST", "url": "/v1/chat/completions", "body": body})
+        else:
+            requests.append({"custom_id": digest, "params": body})
+    return requests
+
+def _multipart_body(fields, filename, content):
+    """Corps multipart/form-data (champs texte + un fichier) pour l'envoi du fichier de lot OpenAI"""
+    boundary = "aki-" + os.urandom(12).hex()
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode("utf-8"))
+    parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+                 f'Content-Type: application/jsonl\r\n\r\n'.encode("utf-8") + content + b"\r\n")
+    parts.append(f"--{boundary}--\r\n".encode("utf-8"))
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+def submit_batch(requests, config, timeout=120):
+    """Envoie le lot; retourne le job {provider, model, batch_id, status, submitted} à conserver pour le suivi"""
+    provider, model, _ = _get_provider_settings(config, probe=False)
+    base, headers = _batch_endpoint(provider, config)
+    if provider == "openai":
+        content = "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in requests).encode("utf-8")
+        body, content_type = _multipart_body({"purpose": "batch"}, "grading.jsonl", content)
+        upload = json.loads(http_post(f"{base}/files", body, dict(headers, **{"Content-Type": content_type}), timeout=timeout))
+        data = json.loads(http_post(f"{base}/batches", json.dumps({
+            "input_file_id": upload["id"], "endpoint": "/v1/chat/completions", "completion_window": "24h",
+        }).encode("utf-8"), headers, timeout=timeout))
+        status = data.get("status", "validating")
+    else:
+        data = json.loads(http_post(f"{base}/messages/batches", json.dumps({"requests": requests}).encode("utf-8"),
+                                    headers, timeout=timeout))
+        status = data.get("processing_status", "in_progress")
+    print(f"Batch {data['id']} submitted to {PROVIDERS[provider]['name']} ({len(requests)} requests)")
+    return {"provider": provider, "model": model, "batch_id": data["id"], "status": status,
+            "submitted": time.time(), "count": len(requests)}
+
+def poll_batch(job, config, timeout=60):
+    """Met à jour le statut du job (et l'emplacement des résultats quand le lot est terminé)"""
+    base, headers = _batch_endpoint(job["provider"], config)
+    if job["provider"] == "openai":
+        data = json.loads(http_request("GET", f"{base}/batches/{job['batch_id']}", headers=headers, timeout=timeout))
+        job["status"] = data.get("status", job["status"])
+        job["output"] = data.get("output_file_id")
+    else:
+        data = json.loads(http_request("GET", f"{base}/messages/batches/{job['batch_id']}", headers=headers, timeout=timeout))
+        job["status"] = data.get("processing_status", job["status"])
+        job["output"] = data.get("results_url")
+    return job
+
+def wait_for_batch(job, config, on_poll=None, sleep=time.sleep):
+    """
+    Interroge le lot jusqu'à un statut final, avec un intervalle croissant
+    (batch_poll_initial_seconds ×1.5 jusqu'à batch_poll_max_seconds). on_poll(job) après chaque interrogation.
+    """
+    delay = float(config.get("batch_poll_initial_seconds", 30))
+    while True:
+        try:
+            poll_batch(job, config)
+        except Exception as e:
+            # Erreur réseau passagère: le lot continue côté fournisseur, on réessaie plus tard
+            print(f"Batch {job['batch_id']}: poll failed: {e}")
+        if on_poll:
+            on_poll(job)
+        if job["status"] in BATCH_FINAL_STATUSES:
+            return job
+        sleep(delay)
+        delay = min(delay * 1.5, float(config.get("batch_poll_max_seconds", 600)))
+
+def fetch_batch_results(job, config, timeout=120):
+    """Résultats {empreinte: analyse} d'un lot terminé; les requêtes en erreur ou expirées sont absentes"""
+    if not job.get("output"):
+        return {}
+    provider = job["provider"]
+    base, headers = _batch_endpoint(provider, config)
+    if provider == "openai":
+        url = f"{base}/files/{job['output']}/content"
+    else:
+        url = job["output"]
+    results = {}
+    for line in http_request("GET", url, headers=headers, timeout=timeout).decode("utf-8").splitlines():
+        if not line.strip():
+            continue
+        entry = json.loads(line)
+        if provider == "openai":
+            response = entry.get("response") or {}
+            if response.get("status_code") != 200:
+                continue
+            data = response.get("body") or {}
+        else:
+            result = entry.get("result") or {}
+            if result.get("type") != "succeeded":
+                continue
+            data = result.get("message") or {}
+        input_tokens, output_tokens = extract_usage(provider, data)
+        record_usage(provider, job["model"], input_tokens, output_tokens)
+        try:
+            analysis = parse_ai_analysis(extract_response_text(provider, data))
+        except Exception as e:
+            print(f"Batch {job['batch_id']}: invalid result for {entry.get('custom_id')}: {e}")
+            continue
+        analysis.update(provider=provider, model=job["model"], tier="batch", tokens=input_tokens + output_tokens)
+        results[entry["custom_id"]] = analysis
+    return results
+
+RUBRIC_PROMPT = """
+Prepare a compact grading rubric for the flashcard below. It will be used later to grade typed answers.
+
+Question: "{question_text}"
+Expected answer: "{true_answer}"
+
+Respond only with JSON in this format (write the items in {language}, keep each item short):
+{{
+    "key_points": ["..."],
+    "acceptable_variants": ["..."],
+    "common_mistakes": ["..."]
+}}
+"""
+
+
+def generate_rubric(question_text, true_answer, config):
+    """Demande à l'IA une grille de notation compacte pour une note"""
+    provider, model, api_key = _get_provider_settings(config, probe=False)
+    if not api_key:
+        return None
+    language = LANGUAGES.get(config.get("language", "english"), LANGUAGES["english"])["name"]
+    prompt = RUBRIC_PROMPT.format(question_text=question_text, true_answer=true_answer, language=language)
+    ai_response = call_with_key_pool(
+        messages=[{"role": "user", "content": prompt}],
+        provider=provider,
+        model=model,
+        config=config,
+        max_tokens=config.get("rubric_max_tokens", 400),
+        temperature=0.2
+    )
+    result = _parse_json_response(ai_response)
+    if not isinstance(result, dict):
+        return None
+    return {key: [str(i) for i in result.get(key, [])][:6]
+            for key in ("key_points", "acceptable_variants", "common_mistakes")}
+
+
+def clean_html_content(html_content):
+    """
+    Nettoie le contenu HTML pour extraire le texte brut, 
+    en supprimant les balises HTML, le CSS et le JavaScript.
+    """
+    if not html_content:
+        return ""
+    
+    # 1. Supprimer les blocs de script et de style
+    # L'option re.DOTALL permet au '.' de correspondre aussi aux sauts de ligne
+    text = re.sub(r'<script.*?</script>', '', html_content, flags=re.DOTALL)
+    text = re.sub(r'<style.*?</style>', '', text, flags=re.DOTALL)
+    
+    # 2. Supprimer les balises HTML restantes
+    text = re.sub(r'<[^>]+>', '', text)
+    
+    # 3. Remplacer les entités HTML communes
+    text = text.replace('&nbsp;', ' ')
+    text = text.replace('&lt;', '<')
+    text = text.replace('&gt;', '>')
+    text = text.replace('&amp;', '&')
+    text = text.replace('&quot;', '"')
+    
+    # 4. Nettoyer les espaces multiples et les sauts de ligne
+    text = re.sub(r'\s+', ' ', text).strip()
+    
+    return text
+
+
+def myers_diff(a, b, max_d=None):
+    """
+    Diff de Myers (O((N+M)·D)) entre deux séquences (lignes ou caractères).
+    Retourne une liste d'opérations (tag, élément) avec tag 'equal' | 'delete' | 'insert'.
+    Au-delà de max_d différences, la zone centrale est traitée comme supprimée puis insérée.
+    """
+    # Préfixe et suffixe communs: la plupart des réponses ne diffèrent que localement
+    start = 0
+    while start < len(a) and start < len(b) and a[start] == b[start]:
+        start += 1
+    end_a, end_b = len(a), len(b)
+    while end_a > start and end_b > start and a[end_a - 1] == b[end_b - 1]:
+        end_a -= 1
+        end_b -= 1
+    head = [("equal", x) for x in a[:start]]
+    tail = [("equal", x) for x in a[end_a:]]
+    return head + _myers_middle(a[start:end_a], b[start:end_b], max_d) + tail
+
+def _myers_middle(a, b, max_d):
+    n, m = len(a), len(b)
+    if n == 0 or m == 0:
+        return [("delete", x) for x in a] + [("insert", y) for y in b]
+    limit = n + m if max_d is None else min(max_d, n + m)
+
+    offset = limit + 1
+    v = [0] * (2 * limit + 3)  # v[offset + k]: x le plus avancé sur la diagonale k
+    # trace[d]: seulement les diagonales -d..d (pas de 2) atteintes à l'étape d, pas une copie de v
+    trace = []
+    for d in range(limit + 1):
+        for i in range(offset - d, offset + d + 1, 2):  # i = offset + k
+            if i == offset - d or (i != offset + d and v[i - 1] < v[i + 1]):
+                x = v[i + 1]
+            else:
+                x = v[i - 1] + 1
+            y = x - i + offset
+            while x < n and y < m and a[x] == b[y]:
+                x += 1
+                y += 1
+            v[i] = x
+            if x >= n and y >= m:
+                trace.append(v[offset - d:offset + d + 1:2])
+                return _myers_backtrack(a, b, trace)
+        trace.append(v[offset - d:offset + d + 1:2])
+    return [("delete", x) for x in a] + [("insert", y) for y in b]
+
+def _myers_backtrack(a, b, trace):
+    x, y = len(a), len(b)
+    ops = []
+    for d in range(len(trace) - 1, 0, -1):
+        prev = trace[d - 1]  # diagonale k de l'étape d - 1 en prev[(k + d - 1) // 2]
+        k = x - y
+        if k == -d or (k != d and prev[(k + d - 2) // 2] < prev[(k + d) // 2]):
+            prev_k = k + 1
+        else:
+            prev_k = k - 1
+        prev_x = prev[(prev_k + d - 1) // 2]
+        prev_y = prev_x - prev_k
+        while x > prev_x and y > prev_y:
+            ops.append(("equal", a[x - 1]))
+            x -= 1
+            y -= 1
+        if x == prev_x:
+            ops.append(("insert", b[y - 1]))
+        else:
+            ops.append(("delete", a[x - 1]))
+        x, y = prev_x, prev_y
+    # Étape 0: diagonale commune du début
+    while x > 0 and y > 0:
+        ops.append(("equal", a[x - 1]))
+        x -= 1
+        y -= 1
+    ops.reverse()
+    return ops
+
+def diff_code_lines(expected_text, provided_text, max_d=2000):
+    """
+    Diff aligné ligne par ligne puis intra-ligne.
+    Retourne des lignes (tag, n° attendu, texte attendu, n° saisi, texte saisi) avec
+    tag 'equal' | 'replace' | 'delete' | 'insert'.
+    """
+    ops = myers_diff(expected_text.split("\n"), provided_text.split("\n"), max_d=max_d)
+    rows = []
+    ln_exp = ln_prov = 0
+    deleted, inserted = [], []
+
+    def flush():
+        nonlocal ln_exp, ln_prov
+        for i in range(max(len(deleted), len(inserted))):
+            left = deleted[i] if i < len(deleted) else None
+            right = inserted[i] if i < len(inserted) else None
+            if left is not None:
+                ln_exp += 1
+            if right is not None:
+                ln_prov += 1
+            tag = "replace" if left is not None and right is not None else ("delete" if right is None else "insert")
+            rows.append((tag, ln_exp if left is not None else None, left, ln_prov if right is not None else None, right))
+        deleted.clear()
+        inserted.clear()
+
+    for tag, line in ops:
+        if tag == "equal":
+            flush()
+            ln_exp += 1
+            ln_prov += 1
+            rows.append(("equal", ln_exp, line, ln_prov, line))
+        elif tag == "delete":
+            deleted.append(line)
+        else:
+            inserted.append(line)
+    flush()
+    return rows
+
+
+def format_diff_for_prompt(rows, context=2):
+    """Hunks du diff au format unifié ('-' attendu seulement, '+' saisi seulement) pour le prompt"""
+    changed = [i for i, row in enumerate(rows) if row[0] != "equal"]
+    keep = set()
+    for i in changed:
+        keep.update(range(max(0, i - context), min(len(rows), i + context + 1)))
+    lines = []
+    last = -1
+    for i in sorted(keep):
+        if last >= 0 and i != last + 1:
+            lines.append("…")
+        tag, _, left, _, right = rows[i]
+        if tag == "equal":
+            lines.append(f"  {left}")
+        else:
+            if left is not None:
+                lines.append(f"- {left}")
+            if right is not None:
+                lines.append(f"+ {right}")
+        last = i
+    return "\n".join(lines)
+
+def compare_code_texts(expected, provided, max_d=2000):
+    """Extraction du code et diff ligne à ligne: la partie coûteuse de la comparaison, exécutable hors du thread principal"""
+    exp_text = extract_code_text(expected)
+    prov_text = extract_code_text(provided)
+    return exp_text, prov_text, diff_code_lines(exp_text, prov_text, max_d=max_d)
+
+# Calculs locaux lourds exécutables dans le pool (appelés par nom, voir submit_cpu_task)
+CPU_TASKS = {
+    "compare_code_texts": compare_code_texts,
+}
+
+# Pool de calcul: processus (option process_pool, démarré au premier usage) ou threads.
+# Les tâches des processus passent par cpu_worker.run, qui charge ce fichier sous un nom propre
+# (aki_scoring_core) au lieu du paquet de l'add-on, pour ne pas importer aqt ni ré-enregistrer les hooks.
+# disabled: le pool de processus a échoué une fois, les threads sont utilisés jusqu'à la fin de la session.
+cpu_pool_state = {"executor": None, "processes": False, "disabled": False}
+cpu_pool_lock = threading.Lock()
+
+CPU_WORKER_MODULE = "cpu_worker"
+
+def _cpu_worker():
+    """cpu_worker.py chargé par son chemin sous le nom que les workers importent (cpu_worker.run doit s'y retrouver)"""
+    module = sys.modules.get(CPU_WORKER_MODULE)
+    if module is None:
+        import importlib.util
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cpu_worker.py")
+        spec = importlib.util.spec_from_file_location(CPU_WORKER_MODULE, path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        sys.modules[CPU_WORKER_MODULE] = module
+    return module
+
+def _cpu_executor(config):
+    with cpu_pool_lock:
+        if cpu_pool_state["executor"] is not None:
+            return cpu_pool_state["executor"], cpu_pool_state["processes"]
+        import concurrent.futures
+        executor, processes = None, False
+        if config.get("process_pool", False) and not cpu_pool_state["disabled"]:
+            try:
+                import multiprocessing
+                import site
+                _cpu_worker()
+                context = multiprocessing.get_context("spawn")
+                # Dans les versions empaquetées d'Anki, sys.executable n'est pas un interpréteur Python
+                if config.get("process_pool_python"):
+                    context.set_executable(config["process_pool_python"])
+                executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=max(1, int(config.get("process_pool_workers", 2))),
+                    mp_context=context,
+                    initializer=site.addsitedir,
+                    initargs=(os.path.dirname(os.path.abspath(__file__)),),
+                )
+                processes = True
+                print("CPU pool: process pool started")
+            except Exception as e:
+                cpu_pool_state["disabled"] = True
+                print(f"CPU pool: process pool unavailable ({e}), using threads")
+        if executor is None:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix="aki-cpu")
+        cpu_pool_state["executor"], cpu_pool_state["processes"] = executor, processes
+        return executor, processes
+
+def _disable_process_pool(reason):
+    """Abandonne le pool de processus pour la session; les tâches suivantes passent par des threads"""
+    with cpu_pool_lock:
+        executor = cpu_pool_state["executor"] if cpu_pool_state["processes"] else None
+        if executor is not None:
+            cpu_pool_state["executor"], cpu_pool_state["processes"] = None, False
+        first = not cpu_pool_state["disabled"]
+        cpu_pool_state["disabled"] = True
+    if first:
+        print(f"CPU pool: process pool broken ({reason!r}), falling back to threads")
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def _on_cpu_task_done(future):
+    """Un pool de processus cassé (worker tué, démarrage impossible) est remplacé par des threads"""
+    if future.cancelled():
+        return
+    from concurrent.futures.process import BrokenProcessPool
+    error = future.exception()
+    if isinstance(error, BrokenProcessPool):
+        _disable_process_pool(error)
+
+def submit_cpu_task(name, args, config):
+    """Soumet CPU_TASKS[name](*args) au pool et retourne un concurrent.futures.Future"""
+    executor, processes = _cpu_executor(config)
+    if processes:
+        try:
+            future = executor.submit(_cpu_worker().run, name, tuple(args))
+            future.add_done_callback(_on_cpu_task_done)
+            return future
+        except Exception as e:
+            # Interpréteur introuvable, pool déjà cassé...: cette tâche et les suivantes en threads
+            _disable_process_pool(e)
+            executor, _ = _cpu_executor(config)
+    return executor.submit(CPU_TASKS[name], *args)
+
+def shutdown_cpu_pool():
+    """Arrête le pool (les tâches en attente sont annulées); il sera recréé au prochain usage"""
+    with cpu_pool_lock:
+        executor = cpu_pool_state["executor"]
+        cpu_pool_state["executor"], cpu_pool_state["processes"] = None, False
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
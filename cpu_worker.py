@@ -0,0 +1,26 @@
+"""
+Point d'entrée des processus du pool de calcul (option process_pool, voir core.submit_cpu_task).
+
+Les workers n'importent ni aqt ni le paquet de l'add-on: l'initialiseur du pool ajoute seulement le
+dossier de l'add-on à sys.path pour ce module, qui charge core.py par son chemin sous un nom propre.
+"""
+import importlib.util
+import os
+import sys
+
+CORE_MODULE_NAME = "aki_scoring_core"
+
+def _load_core():
+    """core.py de l'add-on, chargé une fois par worker"""
+    module = sys.modules.get(CORE_MODULE_NAME)
+    if module is None:
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "core.py")
+        spec = importlib.util.spec_from_file_location(CORE_MODULE_NAME, path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        sys.modules[CORE_MODULE_NAME] = module
+    return module
+
+def run(name, args):
+    """Exécute core.CPU_TASKS[name](*args) dans le worker"""
+    return _load_core().CPU_TASKS[name](*args)
@@ -0,0 +1,204 @@
+"""
+Démon de notation partagé: expose le moteur de core.py en HTTP pour plusieurs profils Anki / machines.
+
+Un seul processus garde le cache persistant des analyses, le pool de connexions, la rotation des
+clés et la limite de concurrence. Les add-ons s'y connectent via l'option `daemon_url` et
+reviennent à l'analyse locale si le démon est injoignable.
+
+    python daemon.py --config daemon.json --host 0.0.0.0 --port 8765 --token secret
+
+Endpoints:
+    POST /analyze  {"question_text", "true_answer", "user_answer", "rubric", "language"} -> résultat
+    GET  /health
+    GET  /stats
+"""
+import argparse
+import hmac
+import json
+import os
+import sqlite3
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import core
+
+daemon_state = {
+    "config": dict(core.DEFAULT_CONFIG),
+    "token": "",
+    "conn": None,
+    "semaphore": threading.BoundedSemaphore(4),
+    "min_interval": 0.0,  # secondes entre deux appels au fournisseur (--max-rpm)
+    "next_call": 0.0,
+}
+daemon_lock = threading.Lock()  # cache SQLite et espacement des appels
+daemon_stats = {"requests": 0, "cache_hits": 0, "joined": 0, "join_timeouts": 0, "provider_calls": 0, "errors": 0}
+
+# Analyses en cours par empreinte: les requêtes identiques attendent la première au lieu de la refaire
+inflight = {}  # digest -> {"event": threading.Event, "result": dict | None, "error": Exception | None}
+inflight_lock = threading.Lock()
+
+def _bump(name):
+    with daemon_lock:
+        daemon_stats[name] += 1
+
+def _wait_for_rate_limit():
+    """Espace les appels au fournisseur selon --max-rpm (les requêtes attendent leur tour)"""
+    if not daemon_state["min_interval"]:
+        return
+    with daemon_lock:
+        now = time.monotonic()
+        start = max(now, daemon_state["next_call"])
+        daemon_state["next_call"] = start + daemon_state["min_interval"]
+    if start > now:
+        time.sleep(start - now)
+
+def _analyze(args, rubric, config, digest):
+    """Appel au fournisseur sous la limite de concurrence et l'espacement, puis mise en cache"""
+    with daemon_state["semaphore"]:
+        _wait_for_rate_limit()
+        _bump("provider_calls")
+        result = core.analyze_answer_with_ai(*args, rubric=rubric, config=config)
+    with daemon_lock:
+        core.cache_store(daemon_state["conn"], digest, result)
+    return result
+
+def _grade(payload):
+    """Cache partagé, puis analyse unique par empreinte sous la limite de concurrence"""
+    config = dict(daemon_state["config"])
+    config["language"] = payload.get("language") or config.get("language", "english")
+    if payload.get("budget") == "cheap":
+        config["budget_floor"] = "cheap"  # budget du client presque atteint: modèle rapide seulement
+    args = (payload.get("question_text", ""), payload.get("true_answer", ""), payload.get("user_answer", ""))
+    rubric = payload.get("rubric")
+    digest = core.analysis_digest(*args, rubric, config["language"], core.analysis_model_tag(config))
+
+    with daemon_lock:
+        cached = core.cache_lookup(daemon_state["conn"], digest)
+    if cached:
+        _bump("cache_hits")
+        return cached
+
+    with inflight_lock:
+        entry = inflight.get(digest)
+        owner = entry is None
+        if owner:
+            entry = inflight[digest] = {"event": threading.Event(), "result": None, "error": None}
+    if not owner:
+        _bump("joined")
+        # Attente bornée (file du sémaphore comprise): si la première requête ne finit pas, on note soi-même
+        if not entry["event"].wait(2 * float(config.get("analysis_deadline_ms", 30000)) / 1000):
+            _bump("join_timeouts")
+            return _analyze(args, rubric, config, digest)
+        # Échec de la première requête: même erreur (500) pour celles qui l'attendaient
+        if entry["error"] is not None:
+            raise Exception(str(entry["error"]))
+        # Tokens déjà comptés par le client de la première requête
+        return {key: value for key, value in entry["result"].items() if key not in core.USAGE_FIELDS}
+
+    try:
+        result = _analyze(args, rubric, config, digest)
+        entry["result"] = result
+        return result
+    except Exception as e:
+        entry["error"] = e
+        raise
+    finally:
+        with inflight_lock:
+            inflight.pop(digest, None)
+        entry["event"].set()
+
+def format_daemon_stats():
+    with daemon_lock:
+        stats = dict(daemon_stats)
+    lines = [f"{name}: {value}" for name, value in stats.items()]
+    return "\n".join(lines) + "\n" + core.format_stats(daemon_state["config"])
+
+class GradingHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def _send_json(self, status, data):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _authorized(self):
+        token = daemon_state["token"]
+        # Comparaison en temps constant
+        return not token or hmac.compare_digest(self.headers.get("X-AKI-Token", "").encode("utf-8"),
+                                                token.encode("utf-8"))
+
+    def do_GET(self):
+        if not self._authorized():
+            self._send_json(401, {"error": {"message": "invalid token"}})
+        elif self.path == "/health":
+            self._send_json(200, {"ok": True})
+        elif self.path == "/stats":
+            self._send_json(200, {"stats": format_daemon_stats()})
+        else:
+            self._send_json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        if not self._authorized():
+            self._send_json(401, {"error": {"message": "invalid token"}})
+            return
+        if self.path != "/analyze":
+            self._send_json(404, {"error": {"message": "not found"}})
+            return
+        _bump("requests")
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            payload = json.loads(self.rfile.read(length) or b"{}")
+            self._send_json(200, _grade(payload))
+        except Exception as e:
+            _bump("errors")
+            print(f"Daemon analysis error: {e}")
+            self._send_json(500, {"error": {"message": str(e)}})
+
+    def log_message(self, format, *args):
+        pass
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Shared grading daemon for the AI Answer Scorer add-on")
+    parser.add_argument("--config", help="JSON file with the add-on settings (provider, API keys, ...)")
+    parser.add_argument("--host", default="127.0.0.1", help="use 0.0.0.0 to serve the LAN")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--cache", default="grading_cache.sqlite3", help="SQLite file of the shared analysis cache")
+    parser.add_argument("--import-cache", action="append", default=[], metavar="FILE",
+                        help="merge an exported analysis cache (.akicache.gz) at startup; repeatable")
+    parser.add_argument("--max-concurrency", type=int, default=4, help="simultaneous provider calls")
+    parser.add_argument("--max-rpm", type=float, default=0, help="provider calls per minute (0 = unlimited)")
+    parser.add_argument("--token", default=os.environ.get("AKI_DAEMON_TOKEN", ""),
+                        help="shared secret expected in the X-AKI-Token header")
+    args = parser.parse_args(argv)
+
+    if args.config:
+        with open(args.config, encoding="utf-8") as f:
+            daemon_state["config"] = core.resolve_config(json.load(f))
+    daemon_state["token"] = args.token
+    daemon_state["semaphore"] = threading.BoundedSemaphore(max(1, args.max_concurrency))
+    daemon_state["min_interval"] = 60.0 / args.max_rpm if args.max_rpm > 0 else 0.0
+
+    conn = sqlite3.connect(args.cache, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(core.ANALYSIS_CACHE_SCHEMA)
+    for path in args.import_cache:
+        counts = core.import_analysis_cache(conn, path)
+        print(f"Imported {path}: " + ", ".join(f"{value} {name}" for name, value in counts.items()))
+    daemon_state["conn"] = conn
+
+    server = ThreadingHTTPServer((args.host, args.port), GradingHandler)
+    print(f"Grading daemon listening on http://{args.host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        conn.close()
+
+if __name__ == "__main__":
+    main()